@@ -1,8 +1,22 @@
 import streamlit as st
 from streamlit_extras.stylable_container import stylable_container
-from langchain.schema import HumanMessage, AIMessage
-from graphs import graph
-import time
+from langchain.schema import HumanMessage
+from langchain_core.messages import AIMessageChunk
+from graphs import get_graph, get_checkpointer, warm_up, STREAMED_NODES
+from rate_limiter import provider_gate_stats, rate_limiter_stats
+from model_router import router_stats
+from story_context import prompt_token_log
+from speculation import speculative_writer
+from running_summary import running_summaries
+from llm_cache import llm_cache_stats
+from chain_registry import chain_registry
+from metrics import get_metrics_handler, graph_callbacks, start_metrics_server
+from sessions import SessionRegistry
+from manuscript_store import manuscript_store
+from passage_index import passage_indexes
+from background_loop import iterate_async
+from story_view import StoryView, HistoryView, characters_markdown, structure_markdown, generate_dynamic_markdown
+import os
 
 
 st.set_page_config(page_title="InkreaLLM", page_icon="📝",layout="wide")
@@ -10,88 +24,203 @@ st.set_page_config(page_title="InkreaLLM", page_icon="📝",layout="wide")
 if 'first_page' not in st.session_state:
     st.session_state.first_page = True
 
+# forward paragraph tokens to the chat while they are generated
+STREAM_PARAGRAPHS = os.getenv("INKREALLM_STREAM_PARAGRAPHS", "1") == "1"
+# run the graph with astream on the shared event loop (0 -> graph.stream in the script thread)
+ASYNC_GRAPH = os.getenv("INKREALLM_ASYNC_GRAPH", "1") == "1"
+
+@st.cache_resource
+def get_session_registry():
+    # one registry for all the sessions of the process
+    metrics_handler = get_metrics_handler()
+
+    def on_evict(thread_id):
+        manuscript_store.delete(thread_id)
+        passage_indexes.delete(thread_id)
+        if metrics_handler is not None:
+            metrics_handler.drop_thread(thread_id)
+    return SessionRegistry(get_checkpointer(), on_evict=on_evict)
+
+@st.cache_resource
+def warm_up_process():
+    # once per process: checkpointer, LLM clients, chains, graphs and provider connections
+    return warm_up()
+
+@st.cache_resource
+def start_metrics():
+    # Prometheus endpoint, when INKREALLM_METRICS_PORT is set
+    return start_metrics_server()
+
+def get_thread_config():
+    """
+    Return the graph config of this browser session, with its own thread id.
+    A session whose thread was evicted while it was idle starts a new writing.
+    """
+    registry = get_session_registry()
+    if "thread_id" not in st.session_state or not registry.is_live(st.session_state.thread_id):
+        st.session_state.thread_id = registry.new_thread()
+        st.session_state.pop("last_event", None)
+        st.session_state.pop("story_view", None)
+        st.session_state.pop("history_view", None)
+    registry.touch(st.session_state.thread_id)
+    return {"configurable": {"thread_id": st.session_state.thread_id, "recursion_limit": 1000},
+            "callbacks": graph_callbacks()}
+
+def run_graph(graph_input, config, stream_mode):
+    """Stream the graph events, with astream on the shared event loop when ASYNC_GRAPH is set."""
+    if ASYNC_GRAPH:
+        return iterate_async(get_graph().astream(graph_input, config, stream_mode=stream_mode, subgraphs=True))
+    return get_graph().stream(graph_input, config, stream_mode=stream_mode, subgraphs=True)
+
+def stream_graph(graph_input, config, container=None):
+    """
+    Run the graph and return its latest "values" event, rendering the tokens of the
+    paragraph writer nodes into an assistant message of the container as they arrive.
+    The message is created on the first token, so the steps that stream nothing do not
+    show an empty message.
+    Only the latest state is kept: the session memory does not grow with the number of steps.
+
+    Args:
+        graph_input: input for graph.stream (None to resume)
+        config (dict): the thread config
+        container: the Streamlit container of the chat history, if any
+
+    Returns:
+        tuple: the latest (namespace, state) event of stream_mode="values", None if there was none
+    """
+    last_event = None
+    if not STREAM_PARAGRAPHS or container is None:
+        for last_event in run_graph(graph_input, config, "values"):
+            pass
+        return last_event
+
+    placeholder = None
+    streamed_id = None
+    streamed_text = ""
+    for namespace, mode, chunk in run_graph(graph_input, config, ["values", "messages"]):
+        if mode == "values":
+            last_event = (namespace, chunk)
+            continue
+        message, metadata = chunk
+        if not isinstance(message, AIMessageChunk) or metadata.get("langgraph_node") not in STREAMED_NODES:
+            continue
+        # a new LLM run (e.g. the first paragraph of the next unit) starts a new text
+        if message.id != streamed_id:
+            streamed_id = message.id
+            streamed_text = ""
+        streamed_text += message.content
+        if placeholder is None:
+            with container:
+                placeholder = st.chat_message("assistant").empty()
+        placeholder.markdown(streamed_text)
+    return last_event
+
 def get_message_key(last_event):
     message_key = [key for key in last_event.keys() if "messages" in key][0]
     return message_key
 
 def graph_messages_to_streamlit(last_event):
-    message_key = get_message_key(last_event)
-    messages = last_event[message_key]
-    result = []
-    for message in messages:
-        if hasattr(message, "content"):
-            if message.type == "human":
-                result.append({"role": "user", "content": message.content})
-            else:
-                result.append({"role": "assistant", "content": message.content})
-    return result
-
-def generate_dynamic_markdown(data):
-    markdown = "### Character Information\n\n"
-
-    # Find the key containing the list of characters dynamically
-    characters_key = next((key for key, value in data.items() if isinstance(value, list)), None)
-    if not characters_key:
-        return "No character data found."
-
-    # Process each character in the dynamically found list
-    for char in data[characters_key]:
-        # Dynamically find the 'character_attributes' key
-        attributes_key = next((key for key in char if isinstance(char[key], dict)), None)
-        if not attributes_key:
-            continue  # Skip this character if 'character_attributes' is not found
-
-        attributes = char[attributes_key]
-        
-        # Dynamically extract the character's name (if it exists)
-        name = attributes.get("name", "Unknown")
-        markdown += f"## {name}\n"
-        
-        # Iterate through the character's attributes
-        for key, value in attributes.items():
-            # Handle nested dictionaries (e.g., 'appearance') and lists (e.g., 'skills')
-            if isinstance(value, dict):
-                markdown += f"- **{key.replace('_', ' ').capitalize()}**:\n"
-                for sub_key, sub_value in value.items():
-                    markdown += f"  - {sub_key.replace('_', ' ').capitalize()}: {sub_value}\n"
-            elif isinstance(value, list):
-                markdown += f"- **{key.replace('_', ' ').capitalize()}**: {', '.join(value)}\n"
-            else:
-                markdown += f"- **{key.replace('_', ' ').capitalize()}**: {value}\n"
-        markdown += "\n"  # Add spacing between characters
-
-    return markdown
-
-def generate_dynamic_markdown_story(data):
     """
-    Generate a Markdown representation of writing units from a structured dictionary.
-    
-    Args:
-        data (dict): A dictionary containing unit information
-    
+    The chat history of the latest state, converted incrementally: only the messages
+    added since the last rerun are converted (see story_view.HistoryView).
+
     Returns:
-        str: A Markdown-formatted string describing the writing's units
+        tuple: the markdown blocks of the older messages and the {"role", "content", "id"}
+            entries of the latest messages
     """
+    if "history_view" not in st.session_state:
+        st.session_state.history_view = HistoryView()
+    return st.session_state.history_view.update(last_event[get_message_key(last_event)])
 
-    markdown = "### Character Information\n\n"
-    # Find the key containing the list of units dynamically
-    units_key = next((key for key, value in data.items() if isinstance(value, list)), None)
-    if not units_key:
-        return "No unit data found."
+def block_labels(name, blocks, block_size, count):
+    """The labels of the blocks of <count> items, e.g. "Paragraphs 21-40"."""
+    return [f"{name} {number * block_size + 1}-{min((number + 1) * block_size, count)}" for number in range(blocks)]
 
-    # Process each chapter in the dynamically found list
-    for index, unit in enumerate(data[units_key], 1):
-        # Extract chapter details
-        chapter_name = unit.get('unit_name', f'Chapter {index}')
-        chapter_length = unit.get('unit_length', 'Unknown length')
-        chapter_summary = unit.get('unit_summary', 'No summary available')
-
-        # Create Markdown for each chapter
-        markdown += f"## {chapter_name}\n\n"
-        markdown += f"**Length:** {chapter_length}\n\n"
-        markdown += f"**Summary:** {chapter_summary}\n\n"
+def render_history(last_event):
+    """
+    Show the chat history: the latest messages as chat messages and, on demand, one block
+    of older messages, so a rerun sends the same number of elements at any story length.
+    """
+    blocks, messages = graph_messages_to_streamlit(last_event)
+    if blocks:
+        view = st.session_state.history_view
+        labels = block_labels("Messages", len(blocks), view.block_size, len(view.ids))
+        shown = st.selectbox("Earlier messages", ["Latest only"] + labels)
+        if shown in labels:
+            st.markdown(blocks[labels.index(shown)])
+    for message in messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 
-    return markdown
+def render_story_content(story_content):
+    """
+    Show the accepted paragraphs one block at a time, the latest block first, rendering only
+    the paragraphs accepted since the last rerun.
+    """
+    if "story_view" not in st.session_state:
+        st.session_state.story_view = StoryView()
+    view = st.session_state.story_view
+    blocks = view.update(story_content)
+    if len(blocks) > 1:
+        labels = block_labels("Paragraphs", len(blocks), view.block_size, len(view.ids))
+        shown = st.select_slider("Paragraphs", labels, value=labels[-1], label_visibility="collapsed")
+        st.markdown(blocks[labels.index(shown)])
+    else:
+        for block in blocks:
+            st.markdown(block)
+
+@st.fragment
+def send_message(config, history_container):
+    """
+    The message box and the Send button. Typing only reruns this fragment, so the chat
+    history and the story panels are not rendered again; sending reruns the whole app.
+    """
+    user_message = st.text_area("Type your message:", height=70)
+    if st.button("Send"):
+        # Update the state with the new human message
+        graph_state = get_graph().get_state(config, subgraphs=True)
+        subgraph_config = graph_state.tasks[0].state.config
+        subgraph_config["configurable"]['recursion_limit'] = 1000
+        message_key = get_message_key(st.session_state.last_event[1])
+
+        subgraph_name = subgraph_config.get("configurable").get("checkpoint_ns").split(':')[0]
+        if subgraph_name == "story_writer":
+            # the paragraph draft is sent back with the answer (the characters and
+            # structure drafts are already in the state)
+            draft = st.session_state.last_event[1][message_key][-1]
+            message_to_send = [draft, HumanMessage(content=user_message)]
+        else:
+            message_to_send = [HumanMessage(content=user_message)]
+        # change value of need_answer based on the subgraph
+        if subgraph_name == "story_structure_creator":
+            story_structure_has_answer = True
+        else:
+            story_structure_has_answer = False
+        if subgraph_name == "character_supervisor":
+            characters_strcture_has_answer = True
+        else:
+            characters_strcture_has_answer = False
+
+        get_graph().update_state(
+            config=subgraph_config, 
+            values={
+                message_key: message_to_send, 
+                "agent_007_need_answer": False,
+                "additional_info_gatherer_need_answer": False,
+                "next_paragraph_writer_has_answer": True,
+                "paragraph_rewriter_has_answer": True,
+                "characters_strcture_has_answer": characters_strcture_has_answer,
+                "story_structure_has_answer": story_structure_has_answer
+            }
+        )
+
+        # Get new events after update, showing the paragraph while it is written
+        new_event = stream_graph(None, config, history_container)
+        if new_event is not None:
+            st.session_state.last_event = new_event
+
+        # Rerun the app to refresh the display
+        st.rerun()
 
 def first_page():
     # Create a placeholder for the GIF
@@ -100,18 +229,9 @@ def first_page():
     # Display the loading GIF
     gif_placeholder.image("https://cdn.dribbble.com/users/154752/screenshots/1244719/book.gif", width=800)
     
-    # Loading stages with spinners
-    with st.spinner('Preparing pencil and paper...'):
-        time.sleep(2)  # Simulate the first stage of loading
-    
-    with st.spinner('Sharpening the pencil...'):
-        time.sleep(2)  # Simulate sharpening the pencil
-    
-    with st.spinner('Getting the paper ready...'):
-        time.sleep(2)  # Simulate preparing the paper
-    
+    # Prepare the graph, the chains and the connections (only the first session of the process waits)
     with st.spinner('Setting up your workspace...'):
-        time.sleep(2)  # Simulate final preparation steps
+        warm_up_process()
     
     # Clear the GIF placeholder
     gif_placeholder.empty()
@@ -127,19 +247,14 @@ def main():
     if st.session_state.first_page:
         first_page()
 
+    config = get_thread_config()
     # Initialize session state variables if they don't exist
-    if 'events' not in st.session_state:
-        config = {"configurable": {"thread_id": "13", "recursion_limit": 1000}}
-        st.session_state.events = list(graph.stream(
-            {"messages": [], "story_info": []}, 
-            config, 
-            stream_mode="values",
-            subgraphs=True
-        ))
+    if 'last_event' not in st.session_state:
+        st.session_state.last_event = stream_graph({"messages": [], "story_info": []}, config)
 
 
      # Ensure last_event is defined by getting the last event from session state
-    last_event = st.session_state.events[-1] if st.session_state.events else None
+    last_event = st.session_state.last_event
 
 
     # page_by_img ="""
@@ -158,6 +273,50 @@ def main():
     # st.markdown(page_by_img, unsafe_allow_html=True)
 
     
+    # how long the LLM calls waited for the provider budgets
+    with st.sidebar.expander("Rate limits"):
+        st.json(rate_limiter_stats())
+        st.json(provider_gate_stats())
+    # rolling latency and error rate of the models of every route
+    with st.sidebar.expander("Model routing"):
+        st.json(router_stats())
+    # time spent preparing the process and the chains built so far
+    with st.sidebar.expander("Startup"):
+        st.json({"warm_up_s": {step: round(seconds, 3) for step, seconds in warm_up_process().items()},
+                 **chain_registry.stats()})
+    # threads of all the sessions served by this process
+    with st.sidebar.expander("Sessions"):
+        st.json(get_session_registry().stats())
+        st.json(manuscript_store.stats())
+    # prompt size of the paragraph writer calls
+    with st.sidebar.expander("Prompt tokens"):
+        paragraph_prompts = [entry for entry in prompt_token_log
+                             if entry["node"] in ("next_paragraph_writer", "paragraph_rewriter")]
+        if len(paragraph_prompts) > 0:
+            # tokens saved by sending the records of the mentioned characters only (INKREALLM_RELEVANT_CHARACTERS)
+            st.line_chart({"prompt_tokens": [entry["prompt_tokens"] for entry in paragraph_prompts],
+                           "saved_tokens": [entry["saved_tokens"] for entry in paragraph_prompts]})
+    # paragraphs written ahead while the author reads (INKREALLM_SPECULATIVE=1)
+    with st.sidebar.expander("Speculative writing"):
+        st.json(speculative_writer.stats())
+    # unit summaries folded paragraph by paragraph (INKREALLM_RUNNING_SUMMARY)
+    with st.sidebar.expander("Running summary"):
+        st.json(running_summaries.stats())
+    # BM25 indexes of the accepted paragraphs and unit summaries (INKREALLM_PASSAGE_RETRIEVAL)
+    with st.sidebar.expander("Passage index"):
+        st.json(passage_indexes.stats())
+    # responses of the deterministic chains served from the on-disk cache
+    with st.sidebar.expander("LLM cache"):
+        st.json(llm_cache_stats())
+    # latency, tokens and cost of every node of this session's thread
+    metrics_handler = get_metrics_handler()
+    if metrics_handler is not None:
+        start_metrics()
+        with st.sidebar.expander("Metrics"):
+            node_metrics = metrics_handler.snapshot(config["configurable"]["thread_id"])
+            st.dataframe([{"node": node, **values} for node, values in node_metrics.items()])
+            st.download_button("Prometheus metrics", metrics_handler.prometheus_text(), file_name="metrics.prom")
+
     col1, col2 = st.columns(2)
     
 
@@ -177,58 +336,12 @@ def main():
         history_container = st.container(height=320)
         
         # Get the last event and messages
-        last_event = st.session_state.events[-1]
-        messages_list = graph_messages_to_streamlit(last_event[1])
+        last_event = st.session_state.last_event
         
         with history_container:
-            for message in messages_list:
-                with st.chat_message(message["role"]):
-                    st.markdown(message["content"])
+            render_history(last_event[1])
         
-        user_message = st.text_area("Type your message:", height=70)
-        if st.button("Send"):
-            # Update the state with the new human message
-            config = {"configurable": {"thread_id": "13", "recursion_limit": 1000}}
-            graph_state = graph.get_state(config, subgraphs=True)
-            subgraph_config = graph_state.tasks[0].state.config
-            subgraph_config["configurable"]['recursion_limit'] = 1000
-            message_key = get_message_key(last_event[1])
-            
-            subgraph_name = subgraph_config.get("configurable").get("checkpoint_ns").split(':')[0]
-            if subgraph_name in ["story_writer", "character_supervisor", "story_structure_creator"]:
-                message_to_send = [AIMessage(content=messages_list[-1]["content"]), HumanMessage(content=user_message)]
-            else:
-                message_to_send = [HumanMessage(content=user_message)]
-            # change value of need_answer based on the subgraph
-            if subgraph_name == "story_structure_creator":
-                story_structure_has_answer = True
-            else:
-                story_structure_has_answer = False
-            if subgraph_name == "character_supervisor":
-                characters_strcture_has_answer = True
-            else:
-                characters_strcture_has_answer = False
-
-            graph.update_state(
-                config=subgraph_config, 
-                values={
-                    message_key: message_to_send, 
-                    "agent_007_need_answer": False,
-                    "additional_info_gatherer_need_answer": False,
-                    "next_paragraph_writer_has_answer": True,
-                    "paragraph_rewriter_has_answer": True,
-                    "characters_strcture_has_answer": characters_strcture_has_answer,
-                    "story_structure_has_answer": story_structure_has_answer
-                }
-            )
-            
-            # Get new events after update
-            st.session_state.events = list(graph.stream(None, config, 
-                                                        stream_mode="values", 
-                                                        subgraphs=True))
-            
-            # Rerun the app to refresh the display
-            st.rerun()
+        send_message(config, history_container)
 
     with col2:
         ch_i_height = 150
@@ -244,11 +357,10 @@ def main():
         with character_container:
             if ('character_structured_info' in last_event[1]) or ("characters_changed" in last_event[1]):
                 message_key = get_message_key(last_event[1])
-                try:
-                    to_present = eval(last_event[1].get(message_key)[-1].content)
-                except:
-                    to_present = last_event[1].get("character_structured_info")
-                st.markdown(generate_dynamic_markdown(to_present))
+                messages = last_event[1].get(message_key)
+                # rendered once per message, the reruns showing the same message hit the cache
+                markdown = characters_markdown(last_event[1].get("character_structured_info"), messages[-1] if messages else None)
+                st.markdown(markdown if markdown is not None else generate_dynamic_markdown({}))
         # Display story content in a container
         if len(last_event[1].get("story_content", [])) > 0:
             st.header("Story content")
@@ -257,22 +369,16 @@ def main():
         story_content_container = st.container(height=st_c_height)
         with story_content_container:
             if len(last_event[1].get("story_content", [])) > 0:
-                if 'story_content' in last_event[1]:
-                    story_content = last_event[1].get("story_content")
-                    try:
-                        story_content = [element.content for element in story_content] if len(story_content) > 0 else ""
-                        story_content = "\n\n".join(story_content) if isinstance(story_content, list) else story_content
-                        st.markdown(story_content)
-                    except Exception as e:
-                        pass
+                # only the paragraphs accepted since the last rerun are rendered
+                try:
+                    render_story_content(last_event[1]["story_content"])
+                except Exception as e:
+                    pass
             else:
                 if last_event[0][0].split(':')[0] == "story_structure_creator":
                     message_key = get_message_key(last_event[1])
-                    try:
-                        to_present = eval(last_event[1].get(message_key)[-1].content)
-                    except:
-                        to_present = ""
-                    st.markdown(generate_dynamic_markdown_story(to_present))
+                    messages = last_event[1].get(message_key)
+                    st.markdown(structure_markdown(last_event[1].get("story_structured_info"), messages[-1] if messages else None))
 
 
 if __name__ == "__main__":
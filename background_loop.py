@@ -0,0 +1,92 @@
+import queue
+import asyncio
+import threading
+from langchain_core.callbacks import BaseCallbackManager
+from langchain_core.runnables.config import ensure_config
+from langgraph.pregel.messages import StreamMessagesHandler
+
+_loop = None
+_loop_lock = threading.Lock()
+_DONE = object()
+
+def get_event_loop():
+    """
+    Return the event loop shared by the process, running in a daemon thread.
+
+    All the sessions run their graphs on this loop, so the LLM calls of concurrent
+    sessions wait on the network together instead of holding a thread each.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="inkrea-event-loop", daemon=True).start()
+        return _loop
+
+def background_config(config, node, priority_offset=0):
+    """
+    The config of the LLM calls a node run starts in the background (unit summary folds,
+    speculative paragraphs): the callbacks of the graph run (e.g. the metrics handler)
+    without the streaming of the chat, and the thread and priority of the run for the
+    provider gates. The calls are reported as <node> of the thread.
+
+    Args:
+        config (dict): the config of the node run
+        node (str): the node the calls are reported as
+        priority_offset (int): added to the priority of the run (e.g. -1 to let the calls
+            the author waits for go first)
+
+    Returns:
+        dict: the config of the background calls
+    """
+    config = ensure_config(config)
+    callbacks = config.get("callbacks")
+    handlers = callbacks.inheritable_handlers if isinstance(callbacks, BaseCallbackManager) else list(callbacks or [])
+    configurable = config.get("configurable") or {}
+    background_configurable = {key: configurable[key] for key in ("thread_id", "priority") if key in configurable}
+    if priority_offset:
+        background_configurable["priority"] = background_configurable.get("priority", 0) + priority_offset
+    return {
+        "callbacks": [handler for handler in handlers if not isinstance(handler, StreamMessagesHandler)],
+        "configurable": background_configurable,
+        "metadata": {"thread_id": configurable.get("thread_id"), "langgraph_node": node},
+    }
+
+def run_async(coroutine):
+    """Run a coroutine on the shared loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+def iterate_async(async_iterator):
+    """
+    Consume an async iterator (e.g. graph.astream(...)) on the shared loop and
+    yield its items in the calling thread, as soon as they are produced.
+
+    Args:
+        async_iterator: the async iterator to consume
+
+    Yields:
+        the items of the iterator; an exception raised by the iterator is raised here
+    """
+    items = queue.Queue()
+
+    async def consume():
+        try:
+            async for item in async_iterator:
+                items.put(item)
+        except BaseException as error:
+            items.put(error)
+        finally:
+            items.put(_DONE)
+
+    future = asyncio.run_coroutine_threadsafe(consume(), get_event_loop())
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # the caller stopped early (e.g. the Streamlit script was rerun)
+        future.cancel()
@@ -0,0 +1,281 @@
+"""
+Write stories unattended from JSON briefs.
+
+Every brief drives the compiled graph to the end, answering its interrupts like an author
+in app1.py: the questions of the info gatherer are answered from the brief, the characters
+and the structure are accepted (after the revisions asked for in the brief, if any) and
+the paragraphs are accepted (with an optional rewrite of every N-th paragraph). The
+writing is saved by story_saver in the output directory.
+
+A brief is a JSON file:
+    {
+        "name": "flooded-village",
+        "writing_type": "a fantasy short story",
+        "answers": ["The river will not stop rising.", "Mara, a young ferrywoman."],
+        "additional_info": "Keep it under ten paragraphs per chapter.",
+        "characters": {"revisions": ["Make Mara older."]},
+        "structure": {"revisions": []},
+        "paragraphs": {"rewrite_every": 0, "rewrite_request": "Make it shorter."}
+    }
+Only "writing_type" is required. The questions after the given answers are answered with
+DEFAULT_ANSWER.
+
+Run from the repository root:
+    python batch_runner.py briefs/ [--workers 4] [--output-dir manuscripts]
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import logging
+from uuid import uuid4
+from langchain.schema import HumanMessage
+import graphs
+from background_loop import run_async
+from metrics import get_metrics_handler, graph_callbacks
+from manuscript_store import manuscript_store
+from passage_index import passage_indexes
+
+logger = logging.getLogger(__name__)
+
+# stories written at the same time
+BATCH_WORKERS = int(os.getenv("INKREALLM_BATCH_WORKERS", 4))
+# answer to the questions of the info gatherer not covered by the brief
+DEFAULT_ANSWER = "No preference, choose what fits the story best."
+# interrupts answered before a story is abandoned
+MAX_TURNS = 10000
+
+START_INPUT = {"messages": [], "story_info": []}
+
+
+def load_brief(path):
+    """
+    Read a brief and fill in the defaults.
+
+    Args:
+        path (str): the JSON file of the brief
+
+    Returns:
+        dict: the brief
+    """
+    with open(path, encoding="utf-8") as brief_file:
+        brief = json.load(brief_file)
+    if not isinstance(brief, dict) or not str(brief.get("writing_type", "")).strip():
+        raise ValueError(f"{path}: a brief is a JSON object with at least a writing_type")
+    brief.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    brief.setdefault("answers", [])
+    brief.setdefault("additional_info", "")
+    for key in ("characters", "structure"):
+        brief[key] = {"revisions": [], **brief.get(key, {})}
+    brief["paragraphs"] = {"rewrite_every": 0, "rewrite_request": "", **brief.get("paragraphs", {})}
+    return brief
+
+
+def load_briefs(path):
+    """The briefs of a JSON file or of all the JSON files of a directory, sorted by file name."""
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json"))
+    else:
+        paths = [path]
+    return [load_brief(brief_path) for brief_path in paths]
+
+
+class BriefAuthor:
+    """
+    Answers the interrupts of the graph from a brief.
+
+    Args:
+        brief (dict): the brief, as returned by load_brief
+        progress (dict): the progress of an author of the same brief (see progress), to
+            go on answering where it stopped
+    """
+
+    def __init__(self, brief, progress=None):
+        self.brief = brief
+        self.questions = 0
+        self.additional_info_asked = False
+        self.revisions = {"character_supervisor": list(brief["characters"]["revisions"]),
+                          "story_structure_creator": list(brief["structure"]["revisions"])}
+        self.paragraphs = 0
+        self.rewrote = False
+        if progress:
+            self.__dict__.update(progress)
+
+    def progress(self):
+        """The answers given so far, as a JSON-serializable dict."""
+        return {key: value for key, value in self.__dict__.items() if key != "brief"}
+
+    def answer(self, subgraph_name, node, draft):
+        """The text the author sends for the draft shown by <node> of <subgraph_name>."""
+        if subgraph_name == "info_gatherer":
+            if node == "additional_info":
+                if self.additional_info_asked:
+                    return ""
+                self.additional_info_asked = True
+                return self.brief["additional_info"]
+            self.questions += 1
+            if self.questions == 1:
+                return f"I want to write {self.brief['writing_type']}."
+            answers = self.brief["answers"]
+            return answers[self.questions - 2] if self.questions - 2 < len(answers) else DEFAULT_ANSWER
+        if subgraph_name in self.revisions:
+            return self.revisions[subgraph_name].pop(0) if self.revisions[subgraph_name] else ""
+        if subgraph_name != "story_writer" or draft.content == "FINISH":
+            return ""
+        if self.rewrote:
+            self.rewrote = False
+            return ""
+        self.paragraphs += 1
+        rewrite_every = self.brief["paragraphs"]["rewrite_every"]
+        if rewrite_every and self.paragraphs % rewrite_every == 0:
+            self.rewrote = True
+            return self.brief["paragraphs"]["rewrite_request"] or "Rewrite the paragraph."
+        return ""
+
+    def update(self, subgraph_name, node, message_key, draft):
+        """The values sent with update_state, the same as the Send button of app1.py."""
+        user_message = HumanMessage(content=self.answer(subgraph_name, node, draft))
+        if subgraph_name == "story_writer":
+            message_to_send = [draft, user_message]
+        else:
+            message_to_send = [user_message]
+        return {
+            message_key: message_to_send,
+            "agent_007_need_answer": False,
+            "additional_info_gatherer_need_answer": False,
+            "next_paragraph_writer_has_answer": True,
+            "paragraph_rewriter_has_answer": True,
+            "characters_strcture_has_answer": subgraph_name == "character_supervisor",
+            "story_structure_has_answer": subgraph_name == "story_structure_creator",
+        }
+
+
+def message_key(values):
+    return [key for key in values.keys() if "messages" in key][0]
+
+
+async def write_story(brief, output_dir, keep_checkpoints=False, thread_id=None, author=None, priority=0, on_turn=None):
+    """
+    Write the story of a brief to the end.
+
+    With the <thread_id> of a story stopped halfway (and the <author> that answered it),
+    the story goes on from its last checkpoint. The checkpoints of a story given a
+    <thread_id> are kept when it fails, so it can be resumed.
+
+    Args:
+        brief (dict): the brief
+        output_dir (str): directory where story_saver saves the writing
+        keep_checkpoints (bool): keep the thread in the checkpointer after the story
+        thread_id (str): thread of the story (a new one if None)
+        author (BriefAuthor): the author answering the interrupts (a new one if None)
+        priority (int): priority of the LLM calls of the story at the provider gates
+        on_turn (callable): called with the author after every answer
+
+    Returns:
+        dict: the result of the story (saved file, turns, paragraphs, seconds, LLM usage)
+    """
+    graph = graphs.get_graph()
+    resumable = thread_id is not None
+    thread_id = thread_id or f"batch-{brief['name']}-{uuid4().hex[:8]}"
+    config = {"configurable": {"thread_id": thread_id, "output_dir": output_dir, "priority": priority},
+              "recursion_limit": 1000, "callbacks": graph_callbacks()}
+    author = author or BriefAuthor(brief)
+    start = time.perf_counter()
+    graph_input = START_INPUT
+    try:
+        if resumable and (await graph.aget_state(config)).values:
+            # the interrupted node runs again and shows its draft
+            graph_input = None
+        for turn in range(MAX_TURNS):
+            last_event = None
+            async for last_event in graph.astream(graph_input, graphs.stream_config(config), stream_mode="values", subgraphs=True):
+                pass
+            graph_state = await graph.aget_state(config, subgraphs=True)
+            if not graph_state.next:
+                break
+            subgraph_state = graph_state.tasks[0].state
+            subgraph_name = subgraph_state.config["configurable"]["checkpoint_ns"].split(":")[0]
+            node = subgraph_state.next[0] if subgraph_state.next else ""
+            # the draft is read from the streamed state, the checkpoint can miss it
+            values = last_event[1]
+            key = message_key(values)
+            await graph.aupdate_state(subgraph_state.config, author.update(subgraph_name, node, key, values[key][-1]))
+            if on_turn is not None:
+                on_turn(author)
+            graph_input = None
+        else:
+            raise RuntimeError(f"the story was not finished after {MAX_TURNS} turns")
+        final_state = (await graph.aget_state(config)).values
+        result = {"name": brief["name"], "status": "ok", "saved_file": final_state.get("saved_file"),
+                  "turns": turn, "paragraphs": author.paragraphs}
+    except Exception as error:
+        logger.exception("brief %s failed", brief["name"])
+        result = {"name": brief["name"], "status": "error", "error": f"{type(error).__name__}: {error}"}
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    metrics_handler = get_metrics_handler()
+    if metrics_handler is not None:
+        nodes = metrics_handler.snapshot(thread_id).values()
+        result["llm_calls"] = sum(node["llm_calls"] for node in nodes)
+        result["prompt_tokens"] = sum(node["prompt_tokens"] for node in nodes)
+        result["completion_tokens"] = sum(node["completion_tokens"] for node in nodes)
+        result["cost_usd"] = round(sum(node["cost_usd"] for node in nodes), 5)
+        metrics_handler.drop_thread(thread_id)
+    if not keep_checkpoints and (result["status"] == "ok" or not resumable):
+        graphs.get_checkpointer().delete_thread(thread_id)
+        manuscript_store.delete(thread_id)
+    passage_indexes.delete(thread_id)
+    return result
+
+
+async def run_batch(briefs, output_dir, workers=BATCH_WORKERS, keep_checkpoints=False):
+    """
+    Write the stories of the briefs, at most <workers> at the same time.
+
+    Returns:
+        dict: the results of the stories and the throughput in stories per hour
+    """
+    semaphore = asyncio.Semaphore(workers)
+
+    async def bounded(brief):
+        async with semaphore:
+            result = await write_story(brief, output_dir, keep_checkpoints)
+            logger.info("%s: %s in %.1f s", brief["name"], result["status"], result["seconds"])
+            return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(bounded(brief) for brief in briefs))
+    wall_seconds = time.perf_counter() - start
+    finished = sum(1 for result in results if result["status"] == "ok")
+    return {
+        "briefs": len(briefs),
+        "finished": finished,
+        "failed": len(briefs) - finished,
+        "workers": workers,
+        "wall_seconds": round(wall_seconds, 3),
+        "stories_per_hour": round(finished / wall_seconds * 3600, 1) if wall_seconds > 0 else None,
+        "stories": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("briefs", help="a brief (JSON file) or a directory of briefs")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="stories written at the same time")
+    parser.add_argument("--output-dir", default="manuscripts", help="directory of the saved writings and of the report")
+    parser.add_argument("--keep-checkpoints", action="store_true", help="keep the threads of the stories in the checkpointer")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    briefs = load_briefs(args.briefs)
+    os.makedirs(args.output_dir, exist_ok=True)
+    graphs.warm_up()
+    # on the shared event loop, where the warm-up opened the connections of the async clients
+    report = run_async(run_batch(briefs, args.output_dir, args.workers, args.keep_checkpoints))
+    with open(os.path.join(args.output_dir, "batch_report.json"), "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(json.dumps({key: value for key, value in report.items() if key != "stories"}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compare the throughput of concurrent sessions with the sync and the async graph.
+
+Every simulated session starts a writing and answers the questions of the info gatherer
+(an update_state with the answer and a resume, like the Send button of app1.py).
+The LLMs are replaced by a fake model that waits <latency> seconds per call, so the
+numbers show how well each mode overlaps the time spent waiting on the model:
+  - sync: the sessions run one after another with graph.stream
+  - threads: one thread per session with graph.stream
+  - async: one task per session with graph.astream on a single event loop
+
+Run from the repository root:
+    python -m benchmarks.async_benchmark [--sessions 20] [--turns 3] [--latency 0.2]
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ["INKREALLM_CHECKPOINT_DB"] = os.path.join(tempfile.mkdtemp(), "checkpoints.sqlite")
+os.environ["INKREALLM_MANUSCRIPT_DIR"] = os.path.join(tempfile.mkdtemp(), "manuscripts")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from langchain.schema import HumanMessage
+import graphs
+from chain_registry import chain_registry
+from benchmarks.fake_llm import FakeChatModel
+
+START_INPUT = {"messages": [], "story_info": []}
+ANSWER = {"agent_007_need_answer": False, "additional_info_gatherer_need_answer": False}
+
+
+def use_fake_llms(latency):
+    fake_llm = FakeChatModel(latency=latency)
+    chain_registry.override_llms(fake_llm)
+    return fake_llm
+
+
+def answer_values(turn):
+    return {"temp_messages": [HumanMessage(content=f"Answer number {turn}")], **ANSWER}
+
+
+def sync_session(session, turns):
+    config = {"configurable": {"thread_id": f"sync-{session}-{time.monotonic_ns()}"}}
+    for _ in graphs.get_graph().stream(START_INPUT, config, stream_mode="values", subgraphs=True):
+        pass
+    for turn in range(turns):
+        subgraph_config = graphs.get_graph().get_state(config, subgraphs=True).tasks[0].state.config
+        graphs.get_graph().update_state(subgraph_config, answer_values(turn))
+        for _ in graphs.get_graph().stream(None, graphs.stream_config(config), stream_mode="values", subgraphs=True):
+            pass
+
+
+async def async_session(session, turns):
+    config = {"configurable": {"thread_id": f"async-{session}-{time.monotonic_ns()}"}}
+    async for _ in graphs.get_graph().astream(START_INPUT, config, stream_mode="values", subgraphs=True):
+        pass
+    for turn in range(turns):
+        subgraph_config = (await graphs.get_graph().aget_state(config, subgraphs=True)).tasks[0].state.config
+        await graphs.get_graph().aupdate_state(subgraph_config, answer_values(turn))
+        async for _ in graphs.get_graph().astream(None, graphs.stream_config(config), stream_mode="values", subgraphs=True):
+            pass
+
+
+def run_sync(sessions, turns):
+    for session in range(sessions):
+        sync_session(session, turns)
+
+
+def run_threads(sessions, turns):
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        list(executor.map(lambda session: sync_session(session, turns), range(sessions)))
+
+
+def run_async(sessions, turns):
+    async def run():
+        await asyncio.gather(*(async_session(session, turns) for session in range(sessions)))
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per LLM call")
+    args = parser.parse_args()
+
+    fake_llm = use_fake_llms(args.latency)
+    results = []
+    for mode, runner in (("sync", run_sync), ("threads", run_threads), ("async", run_async)):
+        calls = fake_llm.usage["calls"]
+        start = time.perf_counter()
+        runner(args.sessions, args.turns)
+        elapsed = time.perf_counter() - start
+        # every session calls the model once at the start and once per answered question
+        assert fake_llm.usage["calls"] - calls == args.sessions * (args.turns + 1)
+        results.append({
+            "mode": mode,
+            "sessions": args.sessions,
+            "turns": args.turns,
+            "llm_latency_s": args.latency,
+            "seconds": round(elapsed, 2),
+            "turns_per_second": round(args.sessions * (args.turns + 1) / elapsed, 2),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
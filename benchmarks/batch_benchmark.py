@@ -0,0 +1,67 @@
+"""
+Measure the throughput of the batch runner (stories per hour) with a growing worker pool.
+
+The same briefs are written with 1 worker and with more workers. The LLMs are replaced
+by the fake model of benchmarks.story_benchmark (a scripted story) that waits <latency>
+seconds per call, so the numbers show how well the workers overlap the time spent
+waiting on the model.
+
+Run from the repository root:
+    python -m benchmarks.batch_benchmark [--briefs 8] [--workers 1 4 8] [--latency 0.05]
+"""
+import os
+import json
+import asyncio
+import argparse
+import tempfile
+
+WORK_DIR = tempfile.mkdtemp()
+os.environ["INKREALLM_CHECKPOINT_DB"] = os.path.join(WORK_DIR, "checkpoints.sqlite")
+os.environ["INKREALLM_LLM_CACHE_DB"] = os.path.join(WORK_DIR, "llm_cache.sqlite")
+os.environ["INKREALLM_MANUSCRIPT_DIR"] = os.path.join(WORK_DIR, "manuscripts")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from chain_registry import chain_registry
+from batch_runner import load_briefs, run_batch
+from benchmarks.fake_llm import FakeChatModel, StoryScript
+
+
+def write_briefs(directory, count):
+    for number in range(count):
+        brief = {"writing_type": "a fantasy short story",
+                 "answers": ["A village flooded by a river that will not stop rising.", "Mara, a young ferrywoman."],
+                 "additional_info": "Keep the chapters short." if number % 2 else "",
+                 "characters": {"revisions": ["Make Mara older."] if number % 3 == 0 else []},
+                 "paragraphs": {"rewrite_every": 4, "rewrite_request": "Make it darker."}}
+        with open(os.path.join(directory, f"brief-{number:03d}.json"), "w") as brief_file:
+            json.dump(brief, brief_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--briefs", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per LLM call")
+    parser.add_argument("--units", type=int, default=3)
+    parser.add_argument("--unit-length", type=int, default=4, help="paragraphs per unit")
+    args = parser.parse_args()
+
+    briefs_dir = os.path.join(WORK_DIR, "briefs")
+    os.makedirs(briefs_dir)
+    write_briefs(briefs_dir, args.briefs)
+    briefs = load_briefs(briefs_dir)
+    chain_registry.override_llms(FakeChatModel(latency=args.latency,
+                                               responder=StoryScript(units=args.units, unit_length=args.unit_length)))
+    results = []
+    for workers in args.workers:
+        output_dir = os.path.join(WORK_DIR, f"manuscripts-{workers}")
+        report = asyncio.run(run_batch(briefs, output_dir, workers))
+        assert report["failed"] == 0, [story for story in report["stories"] if story["status"] != "ok"]
+        results.append({key: value for key, value in report.items() if key != "stories"}
+                       | {"saved_files": len(os.listdir(output_dir)), "llm_latency_s": args.latency})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Measure the prompts of the paragraph writer and rewriter with every character record and with the mentioned ones only.
+
+Every story is written by benchmarks.story_benchmark (the whole graph, with the fake
+model) in its own process, with INKREALLM_RELEVANT_CHARACTERS=0 (the whole
+character_structured_info in every prompt) and =1 (the records of the characters
+mentioned in the current unit and the latest paragraphs, a stub line for the others, see
+character_index.CharacterIndex), for every --casts. The report has the mean and max prompt
+tokens of next_paragraph_writer and paragraph_rewriter and the tokens saved per call.
+The fake cast is described like the real one: {"characters": [{"character_attributes":
+{...}}]}, with the attributes of the character structure, one call per character (or
+the whole cast at once with INKREALLM_CHARACTER_FAN_OUT=0).
+
+Run from the repository root:
+    python -m benchmarks.character_benchmark [--casts 3 10 30] [--units 2] [--unit-length 6] [--rewrite-every 3]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+NODES = ("next_paragraph_writer", "paragraph_rewriter")
+
+
+def write_story(characters, args, relevant_characters):
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", "-m", "benchmarks.story_benchmark",
+         "--units", str(args.units), "--unit-length", str(args.unit_length),
+         "--characters", str(characters), "--rewrite-every", str(args.rewrite_every)],
+        capture_output=True, text=True, check=True,
+        env={**os.environ, "INKREALLM_RELEVANT_CHARACTERS": "1" if relevant_characters else "0"},
+    ).stdout
+    report = json.loads(output)
+    return {
+        "prompt_tokens": {node: report["prompt_tokens"][node] for node in NODES if node in report["prompt_tokens"]},
+        "llm_prompt_tokens": report["llm"].get("prompt_tokens"),
+        "saved_story_bytes": report["saved_story_bytes"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--casts", type=int, nargs="+", default=[3, 10, 30], help="characters in the story")
+    parser.add_argument("--units", type=int, default=2)
+    parser.add_argument("--unit-length", type=int, default=6, help="paragraphs per unit")
+    parser.add_argument("--rewrite-every", type=int, default=3, help="ask to rewrite every N-th paragraph once")
+    args = parser.parse_args()
+
+    report = []
+    for characters in args.casts:
+        every_record = write_story(characters, args, relevant_characters=False)
+        mentioned = write_story(characters, args, relevant_characters=True)
+        report.append({
+            "characters": characters,
+            "every_record": every_record,
+            "mentioned_records": mentioned,
+            "prompt_tokens_change": {
+                node: f"{mentioned['prompt_tokens'][node]['mean'] / every_record['prompt_tokens'][node]['mean'] - 1:+.1%}"
+                for node in mentioned["prompt_tokens"]},
+            "same_story": every_record["saved_story_bytes"] == mentioned["saved_story_bytes"],
+        })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
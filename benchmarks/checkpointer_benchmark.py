@@ -0,0 +1,110 @@
+"""
+Compare MemorySaver and SqliteCheckpointer on a 200-paragraph story.
+
+A small graph shaped like the story writer appends one paragraph per run (like an accepted
+paragraph), so every checkpoint carries the growing story. Each checkpointer runs in its own
+process to measure its resident memory.
+
+Run from the repository root:
+    python -m benchmarks.checkpointer_benchmark [--paragraphs 200]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from typing import Annotated
+from typing_extensions import TypedDict
+from langgraph.graph import StateGraph, START, END
+from langgraph.graph.message import add_messages
+from langgraph.checkpoint.memory import MemorySaver
+from langchain.schema import AIMessage
+from sqlite_checkpointer import SqliteCheckpointer
+
+PARAGRAPH = ("The rain had not stopped for three days and the river was already over the old stone bridge. "
+             "— We cannot wait any longer, said Mara, pulling the hood over her eyes. ") * 4
+
+
+class BenchmarkState(TypedDict):
+    temp_messages: Annotated[list, add_messages]
+    story_content: list
+    actual_unit: list
+
+
+def paragraph_writer(state: BenchmarkState):
+    paragraph = AIMessage(content=f"{len(state.get('story_content', []))}. {PARAGRAPH}")
+    return {"temp_messages": [paragraph],
+            "story_content": state.get("story_content", []) + [paragraph],
+            "actual_unit": state.get("actual_unit", []) + [paragraph]}
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run(checkpointer_name, paragraphs):
+    if checkpointer_name == "memory":
+        checkpointer = MemorySaver()
+    else:
+        checkpointer = SqliteCheckpointer(os.path.join(tempfile.mkdtemp(), "checkpoints.sqlite"))
+    builder = StateGraph(BenchmarkState)
+    builder.add_node("paragraph_writer", paragraph_writer)
+    builder.add_edge(START, "paragraph_writer")
+    builder.add_edge("paragraph_writer", END)
+    graph = builder.compile(checkpointer=checkpointer)
+    config = {"configurable": {"thread_id": "benchmark"}}
+
+    rss_start = rss_mb()
+    write_latencies, read_latencies = [], []
+    for _ in range(paragraphs):
+        start = time.perf_counter()
+        graph.invoke({"temp_messages": []}, config)
+        write_latencies.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        state = graph.get_state(config)
+        read_latencies.append((time.perf_counter() - start) * 1000)
+    assert len(state.values["story_content"]) == paragraphs
+
+    return {
+        "checkpointer": checkpointer_name,
+        "paragraphs": paragraphs,
+        "write_ms_p50": round(statistics.median(write_latencies), 3),
+        "write_ms_p95": round(percentile(write_latencies, 95), 3),
+        "read_ms_p50": round(statistics.median(read_latencies), 3),
+        "read_ms_p95": round(percentile(read_latencies, 95), 3),
+        "rss_growth_mb": round(rss_mb() - rss_start, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--paragraphs", type=int, default=200)
+    parser.add_argument("--checkpointer", choices=["memory", "sqlite"])
+    args = parser.parse_args()
+
+    if args.checkpointer:
+        print(json.dumps(run(args.checkpointer, args.paragraphs)))
+        return
+
+    results = []
+    for checkpointer_name in ("memory", "sqlite"):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.checkpointer_benchmark",
+             "--checkpointer", checkpointer_name, "--paragraphs", str(args.paragraphs)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
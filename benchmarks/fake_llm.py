@@ -0,0 +1,197 @@
+"""
+Chat model that answers without a network call, for the offline benchmarks.
+
+The answer is computed from the prompt by <responder> and returned after <latency>
+seconds (time.sleep for invoke, asyncio.sleep for ainvoke), like a remote model
+that spends most of its time waiting on the network. A degraded provider is played with
+<latency_fn> (the latency of the next call) and <fail_fn> (True -> the next call fails).
+"""
+import re
+import json
+import time
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
+from pydantic import Field
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.output_parsers import JsonOutputParser
+from story_context import count_tokens
+
+
+def default_responder(prompt):
+    return "What would you like to write about?"
+
+
+class FakeChatModel(BaseChatModel):
+    latency: float = 0.0
+    responder: Callable[[str], str] = default_responder
+    latency_fn: Optional[Callable[[], float]] = None
+    fail_fn: Optional[Callable[[], bool]] = None
+    # answers longer than this are cut (about a token per word), like a capped provider
+    max_tokens: Optional[int] = None
+    # calls and tokens, shared with the copies of the model (e.g. the cached ones)
+    usage: Dict[str, int] = Field(default_factory=lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+
+    @property
+    def _llm_type(self):
+        return "fake-chat-model"
+
+    def _respond(self, messages: List[BaseMessage]):
+        if self.fail_fn is not None and self.fail_fn():
+            raise RuntimeError("fake provider error")
+        prompt = "\n".join(str(message.content) for message in messages)
+        content = self.responder(prompt)
+        if self.max_tokens is not None:
+            content = " ".join(content.split(" ")[:self.max_tokens])
+        usage = {"input_tokens": count_tokens(prompt), "output_tokens": count_tokens(content)}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        self.usage["calls"] += 1
+        self.usage["prompt_tokens"] += usage["input_tokens"]
+        self.usage["completion_tokens"] += usage["output_tokens"]
+        return content, usage
+
+    def _latency(self):
+        return self.latency_fn() if self.latency_fn is not None else self.latency
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any):
+        content, usage = self._respond(messages)
+        time.sleep(self._latency())
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any):
+        content, usage = self._respond(messages)
+        await asyncio.sleep(self._latency())
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any):
+        content, usage = self._respond(messages)
+        words = content.split(" ")
+        latency = self._latency()
+        for position, word in enumerate(words):
+            time.sleep(latency / len(words))
+            text = word if position == 0 else " " + word
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content=text, usage_metadata=usage if position == len(words) - 1 else None))
+            if run_manager:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any):
+        content, usage = self._respond(messages)
+        words = content.split(" ")
+        latency = self._latency()
+        for position, word in enumerate(words):
+            await asyncio.sleep(latency / len(words))
+            text = word if position == 0 else " " + word
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content=text, usage_metadata=usage if position == len(words) - 1 else None))
+            if run_manager:
+                await run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    def with_structured_output(self, schema=None, *, method="json_mode", **kwargs):
+        # the graphs only use json_mode with TypedDict schemas, which parse to dicts
+        return self | JsonOutputParser()
+
+
+PARAGRAPH_SENTENCES = [
+    "The rain had not stopped for three days and the river was already over the old stone bridge.",
+    "— We cannot wait any longer, said Mara, pulling the hood over her eyes.",
+    "Tom looked at the dark water and for a moment he thought he saw a light moving under it.",
+    "Nobody in the village remembered the last time the bells had rung at night.",
+    "The wind carried the smell of wet leaves and smoke from the chimneys on the hill.",
+]
+
+# the first characters of the cast, the first two are in PARAGRAPH_SENTENCES
+CHARACTER_NAMES = ["Mara", "Tom", "Elias", "Ines", "Bruno", "Lena", "Odile", "Victor"]
+
+
+class StoryScript:
+    """
+    Responder of FakeChatModel that plays every LLM of graphs.py through a whole story.
+
+    The node is recognised from its prompt; the answers are valid for the node
+    (questions, JSON structures, paragraphs, FINISH at the end of a unit, a file name).
+
+    Args:
+        units (int): number of units in the story structure
+        unit_length (int): paragraphs per unit
+        characters (int): number of characters
+        paragraph_tokens (int): approximate length of a paragraph in tokens
+    """
+
+    def __init__(self, units=3, unit_length=4, characters=3, paragraph_tokens=150):
+        self.units = units
+        self.unit_length = unit_length
+        self.characters = [CHARACTER_NAMES[number] if number < len(CHARACTER_NAMES) else f"Character {number + 1}"
+                           for number in range(characters)]
+        self.paragraph_tokens = paragraph_tokens
+        self.paragraphs = 0
+
+    def paragraph(self):
+        self.paragraphs += 1
+        sentences = []
+        while count_tokens(" ".join(sentences)) < self.paragraph_tokens:
+            sentences.append(PARAGRAPH_SENTENCES[(self.paragraphs + len(sentences)) % len(PARAGRAPH_SENTENCES)])
+        return f"{self.paragraphs}. " + " ".join(sentences)
+
+    def structure(self):
+        return {"units": [{"unit_type": "Chapter", "unit_name": f"Chapter {number + 1}",
+                           "unit_length": str(self.unit_length),
+                           "unit_summary": f"What happens in chapter {number + 1}: {self.characters[number % len(self.characters)]} "
+                                           "watches the river keep rising over the village."}
+                          for number in range(self.units)]}
+
+    def __call__(self, prompt):
+        # info gatherer
+        if "You must ask EXACTLY 5 QUESTIONS" in prompt:
+            asked = re.search(r"You have asked (\d+) questions", prompt)
+            return "FINISH" if asked and int(asked.group(1)) >= 5 else "What is the main conflict of the story?"
+        if "Prompt the user by asking" in prompt:
+            return "Do you have any additional details or information you would like to provide for this writing project?"
+        if "extract from" in prompt and "all the information provided by the user" in prompt:
+            return '["type: short story", "genre: fantasy", "setting: a flooded village"]'
+        # character supervisor
+        if "create a set of atributes or traits" in prompt:
+            return json.dumps({"character_attributes": {"name": "", "age": "", "appearance": "", "personality": "", "goal": ""}})
+        if "extract from the information provided by user the characters" in prompt:
+            return json.dumps({"characters": [{"name": name, "description": ""} for name in self.characters]})
+        if "with the description of this character only" in prompt:
+            # the attributes of the character structure above, as a description follows them
+            return json.dumps({"character_attributes": {
+                "name": "", "age": "30", "appearance": "tall, dark hair, a long coat patched at the elbows",
+                "personality": "stubborn, loyal to the old families, quick to anger and quick to forgive",
+                "goal": "save the village from the flood before the spring, whatever the elders say"}})
+        if "describe each character" in prompt or "Rewrite the Characters Information" in prompt:
+            return json.dumps({"characters": [{"character_attributes": {"name": name, "age": "30", "personality": "stubborn"}}
+                                              for name in self.characters]})
+        # story structure
+        if "please create a structure for the writing" in prompt or "Rewrite the Story Structure" in prompt:
+            return json.dumps(self.structure())
+        # story writer
+        if "You are an advanced narrative writer" in prompt:
+            progress = re.search(r"Current Progress: (-?\d+) of (\d+)", prompt)
+            if progress and int(progress.group(1)) >= int(progress.group(2)):
+                return "FINISH"
+            return self.paragraph()
+        if "Rewrite the paragraph" in prompt:
+            return self.paragraph()
+        # structure supervisor (the LLM fallbacks are used only for malformed structures)
+        if "Please summarize the writing" in prompt:
+            return "Previous unit: the river rose and the villagers left their houses."
+        # running summary of the unit, folded after every accepted paragraph
+        if "Please update the summary so it also covers" in prompt:
+            return "Previous unit: the river rose and the villagers left their houses."
+        if "precise title selection assistant" in prompt:
+            return "FINISH"
+        if "Please provide unit_length" in prompt:
+            return str(self.unit_length)
+        # story saver
+        if "give me a name for the file" in prompt:
+            return "benchmark_story.txt"
+        return "OK"
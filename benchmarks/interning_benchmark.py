@@ -0,0 +1,60 @@
+"""
+Measure the checkpoint bytes of long stories with and without message interning.
+
+Every story is written by benchmarks.story_benchmark (the whole graph, with the fake
+model) in its own process, with INKREALLM_INTERN_MESSAGES=0 (every checkpoint holds the
+messages of its channel values and writes) and =1 (the messages are stored once, by
+digest, see sqlite_checkpointer.SqliteCheckpointer). The checkpoint bytes include the
+interned messages.
+
+Run from the repository root:
+    python -m benchmarks.interning_benchmark [--paragraphs 100 500] [--unit-length 25]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+def write_story(paragraphs, unit_length, intern_messages):
+    units = max(paragraphs // unit_length, 1)
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", "-m", "benchmarks.story_benchmark",
+         "--units", str(units), "--unit-length", str(paragraphs // units)],
+        capture_output=True, text=True, check=True,
+        env={**os.environ, "INKREALLM_INTERN_MESSAGES": "1" if intern_messages else "0"},
+    ).stdout
+    report = json.loads(output)
+    return {
+        "paragraphs": report["paragraphs_accepted"],
+        "checkpoints": report["checkpoints"]["count"],
+        "checkpoint_bytes": report["checkpoints"]["bytes"],
+        "bytes_per_paragraph": round(report["checkpoints"]["bytes"] / report["paragraphs_accepted"]),
+        "saved_story_bytes": report["saved_story_bytes"],
+        "wall_seconds": report["wall_seconds"],
+        "peak_rss_mb": report["peak_rss_mb"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--paragraphs", type=int, nargs="+", default=[100, 500], help="paragraphs of the stories")
+    parser.add_argument("--unit-length", type=int, default=25, help="paragraphs per unit")
+    args = parser.parse_args()
+
+    report = []
+    for paragraphs in args.paragraphs:
+        inline = write_story(paragraphs, args.unit_length, intern_messages=False)
+        interned = write_story(paragraphs, args.unit_length, intern_messages=True)
+        report.append({
+            "paragraphs": paragraphs,
+            "inline": inline,
+            "interned": interned,
+            "checkpoint_bytes_ratio": round(inline["checkpoint_bytes"] / interned["checkpoint_bytes"], 2),
+        })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
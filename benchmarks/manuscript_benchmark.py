@@ -0,0 +1,146 @@
+"""
+Measure the manuscript store: appends, random reads, export and crash recovery.
+
+A manuscript of --units units of --unit-length paragraphs (about --paragraph-bytes each)
+is appended entry by entry, like the graph does while the story is written, with and
+without fsync. Then random paragraphs are read through the offset index and a memory
+map, against reading the exported file and splitting it (what a reader of the old
+one-shot save had to do), and the manuscript is exported.
+
+Crash recovery: a child process appends paragraphs until it is killed (SIGKILL), then
+a torn entry (text without its index record and half a record) is added by hand. The
+manuscript is opened again and every indexed paragraph is checked.
+
+Run from the repository root:
+    python -m benchmarks.manuscript_benchmark [--units 20] [--unit-length 25] [--reads 20000]
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import tempfile
+import subprocess
+from manuscript_store import Manuscript, INDEX_RECORD
+from model_router import percentile
+
+
+def paragraph_text(unit, paragraph, size):
+    words = f"unit {unit} paragraph {paragraph} — the river kept rising over the village "
+    return (words * (size // len(words) + 1))[:size]
+
+
+def append_manuscript(path, units, unit_length, size, fsync):
+    manuscript = Manuscript(path, fsync)
+    times = []
+    for unit in range(1, units + 1):
+        for paragraph in range(unit_length + 1):
+            start = time.perf_counter()
+            manuscript.append(unit, paragraph, paragraph_text(unit, paragraph, size))
+            times.append(time.perf_counter() - start)
+    times.sort()
+    return manuscript, {"entries": len(times), "p50_us": round(percentile(times, 0.5) * 1e6, 1),
+                        "p99_us": round(percentile(times, 0.99) * 1e6, 1),
+                        "total_ms": round(sum(times) * 1000, 1)}
+
+
+def random_reads(manuscript, export_path, units, unit_length, reads):
+    positions = [(random.randint(1, units), random.randint(0, unit_length)) for _ in range(reads)]
+    start = time.perf_counter()
+    for unit, paragraph in positions:
+        manuscript.read(unit, paragraph)
+    indexed_seconds = time.perf_counter() - start
+    # without an index: read the saved writing and split it into its entries
+    scan_reads = max(reads // 100, 1)
+    start = time.perf_counter()
+    for unit, paragraph in positions[:scan_reads]:
+        with open(export_path, encoding="utf-8") as export_file:
+            export_file.read().split("\n")[(unit - 1) * (unit_length + 1) + paragraph]
+    scan_seconds = time.perf_counter() - start
+    return {"indexed_mmap_us": round(indexed_seconds / reads * 1e6, 2),
+            "scan_export_us": round(scan_seconds / scan_reads * 1e6, 2)}
+
+
+def crash_writer(path, size):
+    """Child process: append paragraphs until killed."""
+    manuscript = Manuscript(path, fsync=True)
+    unit, paragraph = 1, 0
+    while True:
+        manuscript.append(unit, paragraph, paragraph_text(unit, paragraph, size))
+        paragraph += 1
+        if paragraph > 25:
+            unit, paragraph = unit + 1, 0
+
+
+def crash_recovery(directory, size, seconds):
+    path = os.path.join(directory, "crashed")
+    child = subprocess.Popen([sys.executable, "-m", "benchmarks.manuscript_benchmark",
+                              "--crash-writer", path, "--paragraph-bytes", str(size)])
+    # let the child start writing, then kill it halfway through its appends
+    while not os.path.exists(path + ".idx") or os.path.getsize(path + ".idx") == 0:
+        time.sleep(0.01)
+    time.sleep(seconds)
+    child.send_signal(signal.SIGKILL)
+    child.wait()
+    # a torn entry: its text reached the disk, only half of its index record did
+    with open(path + ".txt", "ab") as text_file:
+        text_file.write(b"torn paragraph without its index record\n")
+    with open(path + ".idx", "ab") as index_file:
+        index_file.write(INDEX_RECORD.pack(999, 0, 0, 0)[:INDEX_RECORD.size // 2])
+    start = time.perf_counter()
+    manuscript = Manuscript(path)
+    open_ms = (time.perf_counter() - start) * 1000
+    corrupted = 0
+    for unit in sorted(manuscript.units):
+        for paragraph in range(manuscript.paragraphs(unit)):
+            corrupted += manuscript.read(unit, paragraph) != paragraph_text(unit, paragraph, size)
+    # the next paragraph goes on after the last whole entry
+    last_unit = max(manuscript.units)
+    next_paragraph = manuscript.paragraphs(last_unit)
+    manuscript.append(last_unit, next_paragraph, paragraph_text(last_unit, next_paragraph, size))
+    resumed = manuscript.read(last_unit, next_paragraph) == paragraph_text(last_unit, next_paragraph, size)
+    text_consistent = os.path.getsize(path + ".txt") == manuscript.size
+    manuscript.close()
+    return {"entries_recovered": manuscript.entries, "corrupted_entries": corrupted,
+            "open_ms": round(open_ms, 2), "append_after_recovery_ok": resumed,
+            "text_cut_to_index": text_consistent}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--units", type=int, default=20)
+    parser.add_argument("--unit-length", type=int, default=25, help="paragraphs per unit")
+    parser.add_argument("--paragraph-bytes", type=int, default=800)
+    parser.add_argument("--reads", type=int, default=20000, help="random paragraph reads")
+    parser.add_argument("--crash-seconds", type=float, default=0.5, help="seconds of appends before the writer is killed")
+    parser.add_argument("--crash-writer", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.crash_writer:
+        crash_writer(args.crash_writer, args.paragraph_bytes)
+        return
+
+    directory = tempfile.mkdtemp()
+    report = {"config": {"units": args.units, "unit_length": args.unit_length,
+                         "paragraph_bytes": args.paragraph_bytes}, "append": {}}
+    for fsync in (False, True):
+        manuscript, stats = append_manuscript(os.path.join(directory, f"fsync-{int(fsync)}"),
+                                              args.units, args.unit_length, args.paragraph_bytes, fsync)
+        report["append"]["fsync" if fsync else "flush"] = stats
+        if not fsync:
+            manuscript.close()
+    export_path = os.path.join(directory, "export.txt")
+    start = time.perf_counter()
+    manuscript.export(export_path)
+    report["export_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    report["manuscript"] = manuscript.stats()
+    report["random_read"] = random_reads(manuscript, export_path, args.units, args.unit_length, args.reads)
+    manuscript.close()
+    report["crash_recovery"] = crash_recovery(directory, args.paragraph_bytes, args.crash_seconds)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
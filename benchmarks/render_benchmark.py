@@ -0,0 +1,103 @@
+"""
+Compare the time of a Streamlit rerun of the chat history and story panels, rebuilt from
+the whole state (the former app1.py) or rendered by app1.py (story_view.HistoryView and
+StoryView: only the messages and paragraphs added since the last rerun are converted, and
+the older ones are shown one block at a time).
+
+The panels are run by streamlit.testing.v1.AppTest, so the time includes the Streamlit
+elements sent for every rerun. A story of <paragraphs> paragraphs is written one paragraph at
+a time, like the story writer subgraph does: the draft and the (empty) answer of the author
+are added to temp_messages and the paragraph to story_content. After every paragraph the
+app reruns <reruns> times (the Send rerun and the reruns of the sidebar widgets). The report
+gives the mean time and the markdown elements per rerun at a few story lengths: they grow
+with the length of the story when the panels are rebuilt and stay flat when they are
+rendered incrementally.
+
+Run from the repository root:
+    python -m benchmarks.render_benchmark [--paragraphs 300] [--reruns 3]
+"""
+import os
+import json
+import time
+import argparse
+from uuid import uuid4
+from langchain.schema import AIMessage, HumanMessage
+from streamlit.testing.v1 import AppTest
+from benchmarks.fake_llm import StoryScript
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+REPORT_AT = (10, 50, 100, 200, 300, 500)
+
+
+def full_panels():
+    """The panels as rendered before: a chat message per message and the whole story joined."""
+    import streamlit as st
+    values = st.session_state["graph_state"]
+    with st.container(height=320):
+        for message in values["temp_messages"]:
+            with st.chat_message("user" if message.type == "human" else "assistant"):
+                st.markdown(message.content)
+    with st.container(height=450):
+        st.markdown("\n\n".join(message.content for message in values["story_content"]))
+
+
+def incremental_panels():
+    """The panels of app1.py."""
+    import streamlit as st
+    from app1 import render_history, render_story_content
+    values = st.session_state["graph_state"]
+    with st.container(height=320):
+        render_history(values)
+    with st.container(height=450):
+        render_story_content(values["story_content"])
+
+
+def run(paragraphs, reruns):
+    script = StoryScript(characters=6)
+    apps = {"full": AppTest.from_function(full_panels), "incremental": AppTest.from_function(incremental_panels)}
+    values = {"temp_messages": [], "story_content": []}
+    for app in apps.values():
+        # the first run imports app1.py and the graphs
+        app.session_state["graph_state"] = values
+        app.run(timeout=120)
+    timings = {mode: {} for mode in apps}
+    elements = {mode: {} for mode in apps}
+    totals = {mode: 0.0 for mode in apps}
+    runs = 0
+    report_at = sorted({length for length in REPORT_AT if length <= paragraphs} | {paragraphs})
+    for length in range(1, paragraphs + 1):
+        paragraph = AIMessage(content=script.paragraph(), id=str(uuid4()))
+        # the lists of the graph state are new lists after every step
+        values = {"temp_messages": values["temp_messages"] + [paragraph, HumanMessage(content="", id=str(uuid4()))],
+                  "story_content": values["story_content"] + [paragraph]}
+        for _ in range(reruns):
+            for mode, app in apps.items():
+                app.session_state["graph_state"] = values
+                start = time.perf_counter()
+                app.run(timeout=60)
+                totals[mode] += time.perf_counter() - start
+                assert not app.exception, app.exception
+            runs += 1
+        if length in report_at:
+            # mean over the reruns since the previous reported length
+            for mode, app in apps.items():
+                timings[mode][length] = round(totals[mode] / runs * 1000, 3)
+                elements[mode][length] = len(app.markdown)
+            totals = {mode: 0.0 for mode in apps}
+            runs = 0
+    return {"paragraphs": paragraphs, "reruns_per_paragraph": reruns,
+            "ms_per_rerun_at_length": timings, "markdown_elements_at_length": elements}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--paragraphs", type=int, default=300)
+    parser.add_argument("--reruns", type=int, default=3, help="reruns after every accepted paragraph")
+    args = parser.parse_args()
+    print(json.dumps(run(args.paragraphs, args.reruns), indent=2))
+
+
+if __name__ == "__main__":
+    main()
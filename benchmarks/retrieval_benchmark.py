@@ -0,0 +1,121 @@
+"""
+Measure the passage index: incremental adds and BM25 searches at tens of thousands of passages.
+
+Paragraphs of --paragraph-words words are drawn from a Zipf distribution over a
+vocabulary of --vocabulary words whose most frequent words are the stopwords (like the
+words of a text), with the names of a few characters mixed in, and added to a
+passage_index.PassageIndex one by one, like the graph does as the paragraphs are accepted.
+When the index reaches each of --passages, queries made like the ones of the paragraph
+writer (the summary of a unit and the names of its characters) are searched with
+PassageIndex.search and exhaustively (every posting of every query term scored), and the
+top passages of both are compared.
+
+Run from the repository root:
+    python -m benchmarks.retrieval_benchmark [--passages 1000 10000 50000] [--queries 1000] [--k 3]
+"""
+import json
+import math
+import time
+import heapq
+import random
+import argparse
+import itertools
+from operator import itemgetter
+from passage_index import PassageIndex, RETRIEVED_PASSAGES, STOPWORDS, BM25_K1, BM25_B, tokenize
+from model_router import percentile
+
+CHARACTERS = ["Mara", "Tom", "Elias", "Ines", "Bruno", "Lena", "Odile", "Victor"]
+
+
+class Corpus:
+    """Paragraphs and queries drawn from a Zipf distribution over a synthetic vocabulary."""
+
+    def __init__(self, vocabulary, paragraph_words, seed=1):
+        self.random = random.Random(seed)
+        self.words = sorted(STOPWORDS) + [f"word{number}" for number in range(vocabulary - len(STOPWORDS))]
+        self.cumulative = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+        self.paragraph_words = paragraph_words
+
+    def text(self, words, characters):
+        text = self.random.choices(self.words, cum_weights=self.cumulative, k=words)
+        text += self.random.sample(CHARACTERS, characters)
+        self.random.shuffle(text)
+        return " ".join(text)
+
+    def paragraph(self):
+        return self.text(self.paragraph_words, 2)
+
+    def query(self):
+        return self.text(25, 2)
+
+
+def exhaustive_search(index, query, k):
+    """BM25 top k of <query>, every posting of every query term scored."""
+    passages = len(index.keys)
+    c1 = BM25_K1 * (1 - BM25_B)
+    c2 = BM25_K1 * BM25_B * passages / max(index.total_length, 1)
+    scores = {}
+    for term in set(tokenize(query)):
+        if term not in index.postings:
+            continue
+        ids, counts, _ = index.postings[term]
+        weight = math.log(1 + (passages - len(ids) + 0.5) / (len(ids) + 0.5)) * (BM25_K1 + 1)
+        for passage, count in zip(ids, counts):
+            scores[passage] = scores.get(passage, 0.0) + weight * count / (count + c1 + c2 * index.lengths[passage])
+    best = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+    return [(index.keys[passage], score) for passage, score in sorted(best)]
+
+
+def search_times(search, index, queries, k):
+    times, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(index, query, k))
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--passages", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=RETRIEVED_PASSAGES, help="passages per search")
+    parser.add_argument("--vocabulary", type=int, default=30000)
+    parser.add_argument("--paragraph-words", type=int, default=120)
+    args = parser.parse_args()
+
+    corpus = Corpus(args.vocabulary, args.paragraph_words)
+    queries = [corpus.query() for _ in range(args.queries)]
+    index = PassageIndex()
+    add_seconds = 0.0
+    report = []
+    for passages in sorted(args.passages):
+        while len(index.keys) < passages:
+            paragraph = corpus.paragraph()
+            start = time.perf_counter()
+            index.add(("paragraph", 1, len(index.keys) + 1), paragraph)
+            add_seconds += time.perf_counter() - start
+        search_seconds, search_results = search_times(PassageIndex.search, index, queries, args.k)
+        exhaustive_seconds, exhaustive_results = search_times(exhaustive_search, index, queries, args.k)
+        # share of the exhaustive top passages found by the index
+        found = sum(len({key for key, _ in result} & {key for key, _ in exhaustive})
+                    for result, exhaustive in zip(search_results, exhaustive_results))
+        expected = sum(len(exhaustive) for exhaustive in exhaustive_results)
+        report.append({
+            "passages": passages,
+            **index.stats(),
+            "add_us_mean": round(add_seconds / passages * 1e6, 1),
+            "search_us": {"p50": round(percentile(search_seconds, 0.5) * 1e6, 1),
+                          "p99": round(percentile(search_seconds, 0.99) * 1e6, 1)},
+            "exhaustive_search_us": {"p50": round(percentile(exhaustive_seconds, 0.5) * 1e6, 1),
+                                     "p99": round(percentile(exhaustive_seconds, 0.99) * 1e6, 1)},
+            "recall_at_k": round(found / expected, 3) if expected else None,
+        })
+    print(json.dumps({"config": {"queries": args.queries, "k": args.k, "vocabulary": args.vocabulary,
+                                 "paragraph_words": args.paragraph_words},
+                      "results": report}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
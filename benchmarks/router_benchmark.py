@@ -0,0 +1,93 @@
+"""
+Compare the latency of the LLM calls pinned to one model and routed by model_router.
+
+Two fake backends play the providers: "openai_llm" answers in --fast seconds, except in
+the middle third of the run where it is degraded (--degraded seconds and --error-rate
+failed calls), and "gemini_llm" always answers in --steady seconds. The same calls are
+sent through a ModelRouter with only openai_llm (pinned, as the nodes were) and with both
+models (routed). The routing decisions are written to a JSON lines log per mode and the
+p50 / p95 / p99 latencies and failed calls are computed from the logs, the same way as
+    python model_router.py route_log.jsonl
+
+Run from the repository root:
+    python -m benchmarks.router_benchmark [--calls 600] [--concurrency 8] [--explore 0]
+"""
+import os
+import json
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+
+import model_router
+from model_router import ModelRouter, clear_routing, summarize_decisions
+from benchmarks.fake_llm import FakeChatModel
+
+WORK_DIR = tempfile.mkdtemp()
+
+
+async def run(router, calls, concurrency, clock):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(number):
+        async with semaphore:
+            clock["issued"] = number
+            try:
+                await router.ainvoke(f"Write paragraph {number}.")
+            except RuntimeError:
+                pass
+
+    await asyncio.gather(*(call(number) for number in range(calls)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--calls", type=int, default=600)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--fast", type=float, default=0.02, help="seconds per call of the healthy openai_llm")
+    parser.add_argument("--degraded", type=float, default=0.2, help="seconds per call of the degraded openai_llm")
+    parser.add_argument("--error-rate", type=float, default=0.3, help="failed calls of the degraded openai_llm")
+    parser.add_argument("--steady", type=float, default=0.04, help="seconds per call of gemini_llm")
+    parser.add_argument("--explore", type=float, default=model_router.ROUTE_EXPLORE,
+                        help="fraction of the calls sent to the other model (INKREALLM_ROUTE_EXPLORE)")
+    args = parser.parse_args()
+    model_router.ROUTE_EXPLORE = args.explore
+    # the failed calls of the degraded backend are expected
+    logging.getLogger("model_router").setLevel(logging.ERROR)
+
+    clock = {"issued": 0}
+    generator = random.Random(7)
+
+    def degraded():
+        return args.calls // 3 <= clock["issued"] < 2 * args.calls // 3
+
+    def jitter(seconds):
+        return seconds * generator.uniform(0.8, 1.2)
+
+    openai = FakeChatModel(latency_fn=lambda: jitter(args.degraded if degraded() else args.fast),
+                           fail_fn=lambda: degraded() and generator.random() < args.error_rate)
+    gemini = FakeChatModel(latency_fn=lambda: jitter(args.steady))
+
+    report = {"calls": args.calls, "concurrency": args.concurrency, "explore": args.explore}
+    for mode, candidates in [("pinned", [("openai_llm", openai)]),
+                             ("routed", [("openai_llm", openai), ("gemini_llm", gemini)])]:
+        clear_routing()
+        random.seed(7)
+        model_router.ROUTE_LOG = os.path.join(WORK_DIR, f"route_log_{mode}.jsonl")
+        asyncio.run(run(ModelRouter("prose", candidates), args.calls, args.concurrency, clock))
+        with open(model_router.ROUTE_LOG, encoding="utf-8") as log_file:
+            decisions = [json.loads(line) for line in log_file]
+        reasons = {}
+        for decision in decisions:
+            reasons[decision["reason"]] = reasons.get(decision["reason"], 0) + 1
+        # the calls of every third of the run (healthy, degraded, recovered), in log order
+        thirds = [decisions[:args.calls // 3], decisions[args.calls // 3:2 * args.calls // 3], decisions[2 * args.calls // 3:]]
+        report[mode] = {**summarize_decisions(decisions)["prose"], "reasons": reasons,
+                        "by_phase": [summarize_decisions(phase)["prose"] for phase in thirds]}
+    report["p95_speedup"] = round(report["pinned"]["p95_s"] / report["routed"]["p95_s"], 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
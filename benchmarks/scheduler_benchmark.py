@@ -0,0 +1,110 @@
+"""
+Run a queue of story jobs through the job scheduler, stop it halfway and resume it.
+
+The briefs are queued with two priorities and written by the workers of
+job_scheduler.JobScheduler with the fake model of benchmarks.story_benchmark (<latency>
+seconds per call) behind the provider gates. The first scheduler runs in a child process
+that is killed after <crash-after> seconds; a new scheduler on the same queue file queues
+the jobs left running again and finishes them from their checkpoints.
+
+The report shows the throughput, the jobs recovered and resumed, the queue wait times by
+priority and the stats of the provider gates (the calls in flight never exceed the cap).
+
+Run from the repository root:
+    python -m benchmarks.scheduler_benchmark [--jobs 12] [--workers 6] [--openai-concurrency 4]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# shared with the child process running the first scheduler
+WORK_DIR = os.environ.setdefault("INKREALLM_BENCHMARK_DIR", tempfile.mkdtemp())
+os.environ["INKREALLM_CHECKPOINT_DB"] = os.path.join(WORK_DIR, "checkpoints.sqlite")
+os.environ["INKREALLM_LLM_CACHE_DB"] = os.path.join(WORK_DIR, "llm_cache.sqlite")
+os.environ["INKREALLM_MANUSCRIPT_DIR"] = os.path.join(WORK_DIR, "manuscripts")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from chain_registry import chain_registry
+from job_scheduler import JobQueue, JobScheduler
+from rate_limiter import get_provider_gate, get_rate_limiter
+from benchmarks.fake_llm import FakeChatModel, StoryScript
+
+
+def brief(number):
+    return {"name": f"story-{number:03d}", "writing_type": "a fantasy short story",
+            "answers": ["A village flooded by a river that will not stop rising."], "additional_info": "",
+            "characters": {"revisions": []}, "structure": {"revisions": []},
+            "paragraphs": {"rewrite_every": 5, "rewrite_request": "Make it darker."}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--jobs", type=int, default=12)
+    parser.add_argument("--workers", type=int, default=6)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per LLM call")
+    parser.add_argument("--openai-concurrency", type=int, default=4, help="OpenAI calls in flight")
+    parser.add_argument("--crash-after", type=float, default=2.0, help="seconds before the first scheduler is killed")
+    parser.add_argument("--child", action="store_true", help="run the first scheduler (in the child process)")
+    args = parser.parse_args()
+
+    fake = FakeChatModel(latency=args.latency, responder=StoryScript(units=2, unit_length=4))
+    # the copies share the usage counters of the fake model
+    chain_registry.override_llms(**{
+        name: fake.model_copy(update={"rate_limiter": get_rate_limiter(name), "callbacks": [get_rate_limiter(name).usage_handler]})
+        for name in ["openai_llm", "openai_strict_llm", "gemini_llm"]})
+    get_provider_gate("openai").max_concurrency = args.openai_concurrency
+
+    queue_path = os.path.join(WORK_DIR, "jobs.sqlite")
+    output_dir = os.path.join(WORK_DIR, "manuscripts")
+    if args.child:
+        asyncio.run(JobScheduler(JobQueue(queue_path), output_dir, args.workers).run())
+        return
+
+    queue = JobQueue(queue_path)
+    for number in range(args.jobs):
+        # every third job is urgent
+        queue.add(brief(number), priority=5 if number % 3 == 0 else 0)
+    child = subprocess.Popen([sys.executable, "-W", "ignore", "-m", "benchmarks.scheduler_benchmark", "--child"] + sys.argv[1:],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(args.crash_after)
+    # the process stops: the running jobs stay marked as running in the queue
+    child.kill()
+    child.wait()
+    stopped = queue.stats()["by_status"]
+    report = asyncio.run(JobScheduler(queue, output_dir, args.workers).run())
+    jobs = queue.jobs()
+    assert all(job["status"] == "done" for job in jobs), [(job["name"], job["status"], job["result"]) for job in jobs]
+    assert report["providers"]["openai"]["max_in_flight"] <= args.openai_concurrency
+    # the resumed stories are as long as the ones written in one go
+    lines = set()
+    for filename in os.listdir(output_dir):
+        with open(os.path.join(output_dir, filename), encoding="utf-8") as story_file:
+            lines.add(sum(1 for line in story_file if line.strip()))
+    assert len(lines) == 1, lines
+    waits = {}
+    for job in jobs:
+        waits.setdefault(job["priority"], []).append(job["wait_seconds"])
+    print(json.dumps({
+        "jobs": args.jobs,
+        "workers": args.workers,
+        "llm_latency_s": args.latency,
+        "at_stop": stopped,
+        "after_resume": {key: value for key, value in report.items() if key not in ("queue", "providers")},
+        "saved_files": len(os.listdir(output_dir)),
+        "lines_per_story": lines.pop(),
+        "llm_calls": fake.usage["calls"],
+        "mean_wait_s_by_priority": {str(priority): round(statistics.mean(values), 3) for priority, values in sorted(waits.items(), reverse=True)},
+        "queue": report["queue"],
+        "providers": report["providers"],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
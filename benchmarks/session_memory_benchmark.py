@@ -0,0 +1,94 @@
+"""
+Compare the memory kept per Streamlit session when the UI keeps every "values" event
+of a run (the former st.session_state.events) or only the latest one.
+
+Several sessions write a long story with the fake LLM of benchmarks.story_benchmark;
+after every turn each session keeps what app1.py keeps in its session state. Each mode
+runs in its own process and reports the RSS growth per session and the pickled size of
+what a session keeps, at the end of the story and at its largest during the story.
+
+Run from the repository root:
+    python -m benchmarks.session_memory_benchmark [--sessions 4] [--units 6] [--unit-length 20]
+"""
+import sys
+import json
+import pickle
+import argparse
+import subprocess
+from benchmarks.story_benchmark import Author, START_INPUT, MAX_TURNS, message_key, rss_mb
+from benchmarks.fake_llm import FakeChatModel, StoryScript
+import graphs
+from chain_registry import chain_registry
+
+
+def write_story(thread_id, keep_all_events, session_state):
+    """Write a story like a session of app1.py, return the largest size (bytes) kept in its session state."""
+    config = {"configurable": {"thread_id": thread_id}, "recursion_limit": 1000}
+    author = Author()
+    graph_input = START_INPUT
+    max_kept = 0
+    for _ in range(MAX_TURNS):
+        if keep_all_events:
+            session_state[thread_id] = list(graphs.get_graph().stream(graph_input, graphs.stream_config(config), stream_mode="values", subgraphs=True))
+            last_event = session_state[thread_id][-1]
+        else:
+            for last_event in graphs.get_graph().stream(graph_input, graphs.stream_config(config), stream_mode="values", subgraphs=True):
+                pass
+            session_state[thread_id] = last_event
+        max_kept = max(max_kept, len(pickle.dumps(session_state[thread_id])))
+        graph_state = graphs.get_graph().get_state(config, subgraphs=True)
+        if not graph_state.next:
+            return max_kept
+        subgraph_config = graph_state.tasks[0].state.config
+        subgraph_name = subgraph_config["configurable"]["checkpoint_ns"].split(":")[0]
+        values = last_event[1]
+        key = message_key(values)
+        graphs.get_graph().update_state(subgraph_config, author.update(subgraph_name, key, values[key][-1]))
+        graph_input = None
+
+
+def run(mode, sessions, units, unit_length):
+    script = StoryScript(units=units, unit_length=unit_length)
+    chain_registry.override_llms(FakeChatModel(responder=script))
+    # what st.session_state keeps for every session
+    session_state = {}
+    rss_start = rss_mb()
+    max_kept = [write_story(f"{mode}-{session}", mode == "events", session_state) for session in range(sessions)]
+    rss_growth = rss_mb() - rss_start
+    kept = [len(pickle.dumps(value)) for value in session_state.values()]
+    return {
+        "mode": mode,
+        "sessions": sessions,
+        "paragraphs_per_story": units * unit_length,
+        "events_kept_per_session": len(next(iter(session_state.values()))) if mode == "events" else 1,
+        "kept_kb_per_session": round(sum(kept) / len(kept) / 1024, 1),
+        "max_kept_kb_per_session": round(max(max_kept) / 1024, 1),
+        "rss_growth_mb_per_session": round(rss_growth / sessions, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--units", type=int, default=6)
+    parser.add_argument("--unit-length", type=int, default=20, help="paragraphs per unit")
+    parser.add_argument("--mode", choices=["events", "latest"])
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args.mode, args.sessions, args.units, args.unit_length)))
+        return
+
+    results = []
+    for mode in ("events", "latest"):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.session_memory_benchmark", "--mode", mode,
+             "--sessions", str(args.sessions), "--units", str(args.units), "--unit-length", str(args.unit_length)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measure the cold start of the app and the per-call overhead of the chains of the nodes.
+
+Cold start (in a fresh process): the time to import graphs.py and the time of every step
+of graphs.warm_up (checkpointer, LLM clients and chains, graph compilation). The
+connections to the providers are not opened, so the benchmark runs offline.
+
+Per-call overhead: the time to get the chain of every node from the registry (prebuilt,
+what the nodes do now) and to build it again, parsing its prompt template and wrapping
+the LLM (what the nodes did on every call before the registry).
+
+Run from the repository root:
+    python -m benchmarks.startup_benchmark [--calls 2000]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+os.environ["INKREALLM_CHECKPOINT_DB"] = os.path.join(tempfile.mkdtemp(), "checkpoints.sqlite")
+os.environ["INKREALLM_LLM_CACHE_DB"] = os.path.join(tempfile.mkdtemp(), "llm_cache.sqlite")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+
+def cold_start():
+    start = time.perf_counter()
+    import graphs
+    import_seconds = time.perf_counter() - start
+    client_libraries_imported = "langchain_openai" in sys.modules or "langchain_google_genai" in sys.modules
+    steps = graphs.warm_up(open_connections=False)
+    return {
+        "import_graphs_s": round(import_seconds, 3),
+        "client_libraries_imported_by_import": client_libraries_imported,
+        "warm_up_s": {step: round(seconds, 3) for step, seconds in steps.items()},
+        "total_s": round(import_seconds + sum(steps.values()), 3),
+    }
+
+
+def per_call_overhead(calls):
+    import graphs
+    from langchain.prompts import PromptTemplate
+    from chain_registry import chain_registry
+    from benchmarks.fake_llm import FakeChatModel
+
+    chain_registry.override_llms(FakeChatModel())
+    results = {}
+    for name, build in sorted(chain_registry.builders.items()):
+        template = chain_registry.get(name).first.template
+        prebuilt, rebuilt = [], []
+        for _ in range(calls):
+            start = time.perf_counter()
+            chain_registry.get(name)
+            middle = time.perf_counter()
+            PromptTemplate.from_template(template)
+            build()
+            end = time.perf_counter()
+            prebuilt.append(middle - start)
+            rebuilt.append(end - middle)
+        results[name] = {"prebuilt_us": round(statistics.median(prebuilt) * 1e6, 2),
+                         "rebuilt_us": round(statistics.median(rebuilt) * 1e6, 2)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--calls", type=int, default=2000, help="calls per chain for the per-call overhead")
+    parser.add_argument("--cold-start", action="store_true", help="only measure the cold start of this process")
+    args = parser.parse_args()
+
+    if args.cold_start:
+        print(json.dumps(cold_start()))
+        return
+
+    output = subprocess.run([sys.executable, "-W", "ignore", "-m", "benchmarks.startup_benchmark", "--cold-start"],
+                            capture_output=True, text=True, check=True).stdout
+    report = {"cold_start": json.loads(output.strip().splitlines()[-1]),
+              "per_call": per_call_overhead(args.calls)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Write a whole story offline and report where the time, the tokens and the memory go.
+
+openai_llm, openai_strict_llm and gemini_llm are replaced by a fake model playing a
+scripted story (benchmarks.fake_llm.StoryScript) with a configurable latency and
+paragraph length. The compiled graph is driven like app1.py: every interrupt is answered
+(questions, accepting the characters and the structure, accepting or rewriting every
+paragraph) until story_saver has saved the writing.
+
+The report (JSON) has the metrics of every node (metrics.MetricsHandler: wall time,
+interrupts, LLM calls, latency, prompt/completion tokens), the LLM call and token totals,
+the rendered prompt sizes (story_context.prompt_token_log), the running summaries, the
+number and size of the checkpoints and the peak memory. Save it with --output and
+compare a later run against it with --baseline.
+
+Run from the repository root:
+    python -m benchmarks.story_benchmark [--units 3] [--unit-length 4] [--latency 0]
+        [--rewrite-every 0] [--async] [--output baseline.json] [--baseline baseline.json]
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+
+WORK_DIR = tempfile.mkdtemp()
+os.environ["INKREALLM_CHECKPOINT_DB"] = os.path.join(WORK_DIR, "checkpoints.sqlite")
+os.environ["INKREALLM_LLM_CACHE_DB"] = os.path.join(WORK_DIR, "llm_cache.sqlite")
+os.environ["INKREALLM_MANUSCRIPT_DIR"] = os.path.join(WORK_DIR, "manuscripts")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from langchain.schema import HumanMessage
+import graphs
+from chain_registry import chain_registry
+from metrics import MetricsHandler
+from story_context import prompt_token_log
+from running_summary import running_summaries
+from story_view import generate_dynamic_markdown
+from benchmarks.fake_llm import FakeChatModel, StoryScript
+
+START_INPUT = {"messages": [], "story_info": []}
+INFO_ANSWER = "A fantasy short story about a village flooded by a river that will not stop rising."
+REWRITE_REQUEST = "Make it darker and shorter."
+MAX_TURNS = 10000
+
+
+class Author:
+    """Answers the interrupts like a user of app1.py."""
+
+    def __init__(self, rewrite_every=0):
+        self.rewrite_every = rewrite_every
+        self.paragraphs = 0
+        self.rewrote = False
+
+    def answer(self, subgraph_name, draft):
+        if subgraph_name == "info_gatherer":
+            return INFO_ANSWER if "additional details" not in draft.content else ""
+        if subgraph_name != "story_writer" or draft.content == "FINISH":
+            return ""
+        if self.rewrote:
+            self.rewrote = False
+            return ""
+        self.paragraphs += 1
+        if self.rewrite_every and self.paragraphs % self.rewrite_every == 0:
+            self.rewrote = True
+            return REWRITE_REQUEST
+        return ""
+
+    def update(self, subgraph_name, message_key, draft):
+        """The values sent with update_state, the same as the Send button of app1.py."""
+        user_message = HumanMessage(content=self.answer(subgraph_name, draft))
+        if subgraph_name == "story_writer":
+            message_to_send = [draft, user_message]
+        else:
+            message_to_send = [user_message]
+        return {
+            message_key: message_to_send,
+            "agent_007_need_answer": False,
+            "additional_info_gatherer_need_answer": False,
+            "next_paragraph_writer_has_answer": True,
+            "paragraph_rewriter_has_answer": True,
+            "characters_strcture_has_answer": subgraph_name == "character_supervisor",
+            "story_structure_has_answer": subgraph_name == "story_structure_creator",
+        }
+
+
+def message_key(values):
+    return [key for key in values.keys() if "messages" in key][0]
+
+
+def write_story(author, config):
+    graph = graphs.get_graph()
+    graph_input = START_INPUT
+    for turn in range(MAX_TURNS):
+        events = list(graph.stream(graph_input, graphs.stream_config(config), stream_mode="values", subgraphs=True))
+        graph_state = graph.get_state(config, subgraphs=True)
+        if not graph_state.next:
+            return turn
+        subgraph_config = graph_state.tasks[0].state.config
+        subgraph_name = subgraph_config["configurable"]["checkpoint_ns"].split(":")[0]
+        values = events[-1][1]
+        key = message_key(values)
+        graph.update_state(subgraph_config, author.update(subgraph_name, key, values[key][-1]))
+        graph_input = None
+    raise RuntimeError(f"the story was not finished after {MAX_TURNS} turns")
+
+
+async def awrite_story(author, config):
+    graph = graphs.get_graph()
+    graph_input = START_INPUT
+    for turn in range(MAX_TURNS):
+        events = [event async for event in graph.astream(graph_input, graphs.stream_config(config), stream_mode="values", subgraphs=True)]
+        graph_state = await graph.aget_state(config, subgraphs=True)
+        if not graph_state.next:
+            return turn
+        subgraph_config = graph_state.tasks[0].state.config
+        subgraph_name = subgraph_config["configurable"]["checkpoint_ns"].split(":")[0]
+        values = events[-1][1]
+        key = message_key(values)
+        await graph.aupdate_state(subgraph_config, author.update(subgraph_name, key, values[key][-1]))
+        graph_input = None
+    raise RuntimeError(f"the story was not finished after {MAX_TURNS} turns")
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def prompt_token_stats():
+    """
+    Calls, mean and max prompt tokens of every prompt recorded in story_context.prompt_token_log,
+    and the mean tokens left out of them (saved_mean).
+    """
+    tokens, saved = {}, {}
+    for entry in prompt_token_log:
+        tokens.setdefault(entry["node"], []).append(entry["prompt_tokens"])
+        saved.setdefault(entry["node"], []).append(entry["saved_tokens"])
+    return {node: {"calls": len(values), "mean": round(sum(values) / len(values), 1), "max": max(values),
+                   "saved_mean": round(sum(saved[node]) / len(values), 1)}
+            for node, values in tokens.items()}
+
+
+def run(args):
+    script = StoryScript(units=args.units, unit_length=args.unit_length,
+                         characters=args.characters, paragraph_tokens=args.paragraph_tokens)
+    fake_llm = FakeChatModel(latency=args.latency, responder=script)
+    chain_registry.override_llms(fake_llm)
+
+    metrics = MetricsHandler()
+    thread_id = "story-benchmark"
+    config = {"configurable": {"thread_id": thread_id}, "recursion_limit": 1000, "callbacks": [metrics]}
+    author = Author(args.rewrite_every)
+
+    # story_saver writes the story in the working directory
+    os.chdir(WORK_DIR)
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    turns = asyncio.run(awrite_story(author, config)) if args.use_async else write_story(author, config)
+    wall_seconds = time.perf_counter() - start
+
+    final_state = graphs.get_graph().get_state({"configurable": {"thread_id": thread_id}}).values
+    assert final_state["messages"][-1].content == "The writing was saved successfully!"
+    # the characters panel renders every character of the cast
+    characters_markdown = generate_dynamic_markdown(final_state.get("character_structured_info") or {})
+    assert all(f"## {name}\n" in characters_markdown for name in script.characters), characters_markdown
+    checkpoints = list(graphs.get_checkpointer().list({"configurable": {"thread_id": thread_id}}))
+    return {
+        "config": {"units": args.units, "unit_length": args.unit_length, "characters": args.characters,
+                   "paragraph_tokens": args.paragraph_tokens, "latency_s": args.latency,
+                   "rewrite_every": args.rewrite_every, "async": args.use_async},
+        "wall_seconds": round(wall_seconds, 3),
+        "turns": turns,
+        "paragraphs_accepted": author.paragraphs,
+        "nodes": metrics.snapshot(thread_id),
+        "llm": dict(fake_llm.usage),
+        "prompt_tokens": prompt_token_stats(),
+        "running_summary": running_summaries.stats(),
+        "checkpoints": {"count": len(checkpoints),
+                        "bytes": graphs.get_checkpointer().thread_sizes().get(thread_id, 0)},
+        "saved_story_bytes": os.path.getsize(os.path.join(WORK_DIR, "benchmark_story.txt")),
+        "rss_growth_mb": round(rss_mb() - rss_start, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def flatten(report, prefix=""):
+    values = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def compare(report, baseline):
+    """Relative change of every number of the report against the baseline."""
+    current, previous = flatten(report), flatten(baseline)
+    changes = {}
+    for key, value in current.items():
+        if key.startswith("config.") or key not in previous:
+            continue
+        before = previous[key]
+        changes[key] = {"baseline": before, "current": value,
+                        "change": f"{(value - before) / before:+.1%}" if before else None}
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--units", type=int, default=3)
+    parser.add_argument("--unit-length", type=int, default=4, help="paragraphs per unit")
+    parser.add_argument("--characters", type=int, default=3)
+    parser.add_argument("--paragraph-tokens", type=int, default=150)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per LLM call")
+    parser.add_argument("--rewrite-every", type=int, default=0, help="ask to rewrite every N-th paragraph once")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the graph with astream")
+    parser.add_argument("--output", help="save the report to this file")
+    parser.add_argument("--baseline", help="compare the report with a report saved with --output")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    report = run(args)
+    if baseline:
+        with open(baseline) as baseline_file:
+            report["comparison"] = compare(report, json.load(baseline_file))
+    if output:
+        with open(output, "w") as output_file:
+            json.dump({key: value for key, value in report.items() if key != "comparison"}, output_file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Measure the unit transitions with and without the running unit summary.
+
+Every story is written by benchmarks.story_benchmark (the whole graph, with the fake
+model and --latency seconds per LLM call) in its own process, with
+INKREALLM_RUNNING_SUMMARY=0 (structure_supervisor sends the whole unit to the
+summarization chain when the unit ends) and =1 (every accepted paragraph is folded into
+a running summary in the background, see running_summary.RunningSummaries). The report
+has the mean time of structure_supervisor (the unit transition the author waits for),
+the time spent waiting for the last fold, and the largest summarization prompt, for
+every --unit-lengths.
+
+Run from the repository root:
+    python -m benchmarks.summary_benchmark [--unit-lengths 5 20 40] [--units 2] [--latency 0.2]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+def write_story(units, unit_length, latency, running_summary):
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", "-m", "benchmarks.story_benchmark",
+         "--units", str(units), "--unit-length", str(unit_length), "--latency", str(latency)],
+        capture_output=True, text=True, check=True,
+        env={**os.environ, "INKREALLM_RUNNING_SUMMARY": "1" if running_summary else "0"},
+    ).stdout
+    report = json.loads(output)
+    summary_prompts = report["prompt_tokens"].get("unit_summary" if running_summary else "chapter_summary", {})
+    return {
+        "structure_supervisor_ms_mean": report["nodes"]["structure_supervisor"]["node_ms_mean"],
+        "fold_wait_ms_mean": report["running_summary"]["wait_ms_mean"],
+        "summary_calls": summary_prompts.get("calls", 0),
+        "summary_prompt_tokens_max": summary_prompts.get("max", 0),
+        "units_without_summary": report["running_summary"]["units_without_summary"],
+        "saved_story_bytes": report["saved_story_bytes"],
+        "wall_seconds": report["wall_seconds"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--unit-lengths", type=int, nargs="+", default=[5, 20, 40], help="paragraphs per unit")
+    parser.add_argument("--units", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per LLM call")
+    args = parser.parse_args()
+
+    report = []
+    for unit_length in args.unit_lengths:
+        whole_unit = write_story(args.units, unit_length, args.latency, running_summary=False)
+        running = write_story(args.units, unit_length, args.latency, running_summary=True)
+        report.append({
+            "unit_length": unit_length,
+            "whole_unit": whole_unit,
+            "running_summary": running,
+            "same_story": whole_unit["saved_story_bytes"] == running["saved_story_bytes"],
+        })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
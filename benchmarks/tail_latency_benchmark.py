@@ -0,0 +1,99 @@
+"""
+Measure the tail latency of the LLM calls with deadlines, output caps and hedged requests.
+
+A fake backend plays a provider with a heavy tail: most calls answer in --fast seconds,
+--slow-rate of them take --slow seconds and --stuck-rate of them hang for --stuck
+seconds. It also writes runaway answers (--answer-words words). The same calls (spread
+over three nodes) are sent through a ModelRouter:
+    unbounded: no deadline, no output cap (the clients before the budgets)
+    deadline:  the deadline and the max_tokens of the paragraph role (--deadline seconds)
+    hedged:    the same, plus a second request after the p90 latency of the model
+The report gives the per-node p50 / p95 / p99, the timed out calls, the hedge win rate
+and the extra requests sent, computed from the routing decisions.
+
+Run from the repository root:
+    python -m benchmarks.tail_latency_benchmark [--calls 400] [--concurrency 8]
+"""
+import json
+import random
+import asyncio
+import logging
+import argparse
+
+import model_router
+from chain_registry import with_max_tokens
+from model_router import ROLE_BUDGETS, ModelRouter, clear_routing, recent_decisions, summarize_decisions
+from benchmarks.fake_llm import FakeChatModel
+
+NODES = ["next_paragraph_writer", "paragraph_rewriter", "chapter_summary"]
+
+
+async def run(router, calls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    words = []
+
+    async def call(number):
+        async with semaphore:
+            config = {"metadata": {"langgraph_node": NODES[number % len(NODES)]}}
+            try:
+                answer = await router.ainvoke(f"Write paragraph {number}.", config)
+                words.append(len(answer.content.split(" ")))
+            except (RuntimeError, TimeoutError):
+                pass
+
+    await asyncio.gather(*(call(number) for number in range(calls)))
+    return words
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--fast", type=float, default=0.03, help="seconds of most calls")
+    parser.add_argument("--slow", type=float, default=0.4, help="seconds of the slow calls")
+    parser.add_argument("--slow-rate", type=float, default=0.08)
+    parser.add_argument("--stuck", type=float, default=5.0, help="seconds of the hanging calls")
+    parser.add_argument("--stuck-rate", type=float, default=0.02)
+    parser.add_argument("--deadline", type=float, default=1.0, help="deadline of a request (seconds)")
+    parser.add_argument("--answer-words", type=int, default=2000, help="words of the uncapped answers")
+    args = parser.parse_args()
+    # the timed out calls are expected
+    logging.getLogger("model_router").setLevel(logging.ERROR)
+
+    generator = random.Random(11)
+
+    def latency():
+        draw = generator.random()
+        if draw < args.stuck_rate:
+            return args.stuck
+        if draw < args.stuck_rate + args.slow_rate:
+            return args.slow * generator.uniform(0.8, 1.2)
+        return args.fast * generator.uniform(0.8, 1.2)
+
+    fake = FakeChatModel(latency_fn=latency, responder=lambda prompt: " ".join(["word"] * args.answer_words))
+    capped = with_max_tokens(fake, ROLE_BUDGETS["paragraph"][1])
+    report = {"calls": args.calls, "concurrency": args.concurrency, "deadline_s": args.deadline,
+              "max_tokens": ROLE_BUDGETS["paragraph"][1]}
+    for mode, llm, deadline, hedge in [("unbounded", fake, None, False),
+                                       ("deadline", capped, args.deadline, False),
+                                       ("hedged", capped, args.deadline, True)]:
+        clear_routing()
+        model_router.ROUTE_HEDGE = hedge
+        router = ModelRouter("prose", [("openai_llm", llm)], role="paragraph")
+        router.timeout = deadline
+        fake.usage.update(calls=0)
+        words = asyncio.run(run(router, args.calls, args.concurrency))
+        decisions = recent_decisions()
+        report[mode] = {
+            **summarize_decisions(decisions)["prose"],
+            "requests_sent": fake.usage["calls"],
+            "mean_answer_words": round(sum(words) / len(words), 1) if words else None,
+            "nodes": {node: {key: summary[key] for key in ("p50_s", "p95_s", "p99_s", "timeouts", "hedges", "hedge_win_rate")}
+                      for node, summary in summarize_decisions(decisions, "node").items()},
+        }
+        del report[mode]["models"]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import os
+import time
+import logging
+import threading
+from rate_limiter import get_rate_limiter
+from model_router import ROLE_BUDGETS, ROUTES, ModelRouter
+from background_loop import run_async
+
+logger = logging.getLogger(__name__)
+
+# open a connection to the model providers during the warm-up (0 -> the first call opens it)
+WARM_UP_CONNECTIONS = os.getenv("INKREALLM_WARM_UP_CONNECTIONS", "1") == "1"
+# seconds to wait for a provider while opening its connection
+WARM_UP_TIMEOUT = float(os.getenv("INKREALLM_WARM_UP_TIMEOUT", 5))
+# seconds without an answer from the provider before a request fails, retried twice by the
+# client; only for the calls without a role: the chains of the nodes get the deadline of their
+# role (model_router.ROLE_BUDGETS) with no retries, the router fails over to the next model
+LLM_TIMEOUT = float(os.getenv("INKREALLM_LLM_TIMEOUT", 60))
+
+
+# llm_objects, created on first use (the client libraries are imported only then)
+def create_openai_llm():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0.7,
+        max_tokens=None,
+        timeout=LLM_TIMEOUT,
+        max_retries=2,
+        stream_usage=True,
+        rate_limiter=get_rate_limiter("openai_llm"),
+        callbacks=[get_rate_limiter("openai_llm").usage_handler],
+        api_key=os.getenv("OPENAI_API_KEY")
+    )
+
+def create_openai_strict_llm():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        max_tokens=None,
+        timeout=LLM_TIMEOUT,
+        max_retries=2,
+        stream_usage=True,
+        rate_limiter=get_rate_limiter("openai_strict_llm"),
+        callbacks=[get_rate_limiter("openai_strict_llm").usage_handler],
+        api_key=os.getenv("OPENAI_API_KEY")
+    )
+
+def create_gemini_llm():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model="gemini-1.5-pro",
+        temperature=0.7,
+        max_tokens=None,
+        timeout=LLM_TIMEOUT,
+        max_retries=2,
+        rate_limiter=get_rate_limiter("gemini_llm"),
+        callbacks=[get_rate_limiter("gemini_llm").usage_handler],
+        api_key=os.getenv("GEMINI_API_KEY")
+    )
+
+LLM_FACTORIES = {
+    "openai_llm": create_openai_llm,
+    "openai_strict_llm": create_openai_strict_llm,
+    "gemini_llm": create_gemini_llm,
+}
+
+
+def with_max_tokens(llm, max_tokens):
+    """Copy of an LLM client whose answers are capped to <max_tokens> (it shares the connections of the client)."""
+    for field in ("max_tokens", "max_output_tokens"):
+        if field in type(llm).model_fields:
+            return llm.model_copy(update={field: max_tokens})
+    return llm
+
+
+def with_deadline(llm, seconds):
+    """
+    Copy of an OpenAI client whose requests fail after <seconds> without an answer and are not
+    retried (it shares the connections of the client). The other clients (e.g. Gemini, which
+    takes no timeout per request) are returned as they are: the router bounds their calls.
+    """
+    root_client = getattr(llm, "root_client", None)
+    if root_client is None or "request_timeout" not in type(llm).model_fields:
+        return llm
+    update = {"request_timeout": seconds, "max_retries": 0,
+              "root_client": root_client.with_options(timeout=seconds, max_retries=0)}
+    update["client"] = update["root_client"].chat.completions
+    root_async_client = getattr(llm, "root_async_client", None)
+    if root_async_client is not None:
+        update["root_async_client"] = root_async_client.with_options(timeout=seconds, max_retries=0)
+        update["async_client"] = update["root_async_client"].chat.completions
+    return llm.model_copy(update=update)
+
+
+def open_connection(llm):
+    """
+    Open the HTTP connections of an OpenAI client with a cheap request (list the models),
+    so the first LLM call of a session does not pay for the TCP and TLS handshakes.
+    The async client is opened on the shared event loop, where the async graph runs.
+    The clients without an OpenAI root client (e.g. Gemini over gRPC) are skipped.
+
+    Returns:
+        bool: True if the connections were opened
+    """
+    root_client = getattr(llm, "root_client", None)
+    root_async_client = getattr(llm, "root_async_client", None)
+    if root_client is None:
+        return False
+    try:
+        root_client.with_options(timeout=WARM_UP_TIMEOUT, max_retries=0).models.list()
+        if root_async_client is not None:
+            run_async(root_async_client.with_options(timeout=WARM_UP_TIMEOUT, max_retries=0).models.list())
+        return True
+    except Exception as error:
+        logger.warning("could not open a connection for %s: %s", type(llm).__name__, error)
+        return False
+
+
+class ChainRegistry:
+    """
+    Registry of the prebuilt chains of the graph nodes.
+
+    A chain is registered with a function building it (prompt template | LLM) and is
+    built once, on first use, then reused by every call of the node. The LLM clients
+    are created the same way, on first use, from <llm_factories>. The chains call a
+    ModelRouter (see route) instead of a fixed client.
+    override_llms replaces clients (e.g. with a fake model in the benchmarks); the chains
+    already built are dropped and rebuilt with the new clients.
+
+    Args:
+        llm_factories (dict): name -> function creating the LLM client
+    """
+
+    def __init__(self, llm_factories):
+        self.llm_factories = dict(llm_factories)
+        self.builders = {}
+        self.llms = {}
+        self.chains = {}
+        # name -> seconds spent building the chain or creating the client
+        self.build_seconds = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, build):
+        """Register the function building the chain <name>."""
+        with self.lock:
+            self.builders[name] = build
+            self.chains.pop(name, None)
+
+    def llm(self, name):
+        """The LLM client <name>, created on first use."""
+        llm = self.llms.get(name)
+        if llm is not None:
+            return llm
+        with self.lock:
+            if name not in self.llms:
+                start = time.perf_counter()
+                self.llms[name] = self.llm_factories[name]()
+                self.build_seconds[name] = time.perf_counter() - start
+            return self.llms[name]
+
+    def route(self, route, wrap=None, role=None):
+        """
+        Router choosing the model of every call among the models of <route> (see model_router.ROUTES).
+
+        Args:
+            route (str): name of the route
+            wrap (callable): applied to the client of every model (e.g. structured output or cache)
+            role (str): role of the calls, for their deadline and output cap (see model_router.ROLE_BUDGETS)
+
+        Returns:
+            ModelRouter: the router
+        """
+        candidates = []
+        client_deadlines = []
+        for name in ROUTES[route]:
+            llm = self.llm(name)
+            if role:
+                deadline, max_tokens = ROLE_BUDGETS[role]
+                capped = with_max_tokens(llm, max_tokens)
+                llm = with_deadline(capped, deadline)
+                if llm is not capped:
+                    client_deadlines.append(name)
+            candidates.append((name, wrap(llm) if wrap else llm))
+        return ModelRouter(route, candidates, role, client_deadlines)
+
+    def get(self, name):
+        """The chain <name>, built on first use."""
+        chain = self.chains.get(name)
+        if chain is not None:
+            return chain
+        with self.lock:
+            if name not in self.chains:
+                start = time.perf_counter()
+                self.chains[name] = self.builders[name]()
+                self.build_seconds[name] = time.perf_counter() - start
+            return self.chains[name]
+
+    def build_all(self):
+        """Create every client and build every registered chain."""
+        for name in list(self.llm_factories):
+            self.llm(name)
+        for name in list(self.builders):
+            self.get(name)
+
+    def open_connections(self):
+        """Open the connections of the clients created so far, concurrently."""
+        with self.lock:
+            llms = list(self.llms.values())
+        results = [False] * len(llms)
+
+        def open_one(position, llm):
+            results[position] = open_connection(llm)
+        threads = [threading.Thread(target=open_one, args=(position, llm), daemon=True)
+                   for position, llm in enumerate(llms)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(results)
+
+    def override_llms(self, llm=None, **llms):
+        """
+        Replace LLM clients: <llm> replaces all of them, the keyword arguments replace
+        the clients with those names. The chains are rebuilt on their next use.
+        """
+        with self.lock:
+            if llm is not None:
+                llms = {**{name: llm for name in self.llm_factories}, **llms}
+            for name, replacement in llms.items():
+                if name not in self.llm_factories:
+                    raise KeyError(f"unknown LLM {name}")
+                self.llms[name] = replacement
+            self.chains.clear()
+
+    def stats(self):
+        """Clients created, chains built and the milliseconds spent building each of them."""
+        with self.lock:
+            return {
+                "llms": sorted(self.llms),
+                "chains_built": len(self.chains),
+                "chains_registered": len(self.builders),
+                "build_ms": {name: round(seconds * 1000, 2) for name, seconds in self.build_seconds.items()},
+            }
+
+
+chain_registry = ChainRegistry(LLM_FACTORIES)
@@ -0,0 +1,136 @@
+import os
+import asyncio
+import logging
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# describe every character with its own LLM call (0 -> one call for the whole cast)
+CHARACTER_FAN_OUT = os.getenv("INKREALLM_CHARACTER_FAN_OUT", "1") == "1"
+# characters described at the same time
+CHARACTER_WORKERS = int(os.getenv("INKREALLM_CHARACTER_WORKERS", 8))
+# extra attempts for a character whose description fails or is not a JSON object
+CHARACTER_RETRIES = int(os.getenv("INKREALLM_CHARACTER_RETRIES", 2))
+
+_WRAPPER_KEYS = ("character", "characters", "characters_list", "list_of_characters")
+
+def character_attributes(entry):
+    """
+    The attributes of a character entry: the entry itself, or the object it wraps when it
+    has no name (e.g. {"character_attributes": {"name": ...}}, as the descriptions are written).
+    """
+    if not isinstance(entry, dict):
+        return {}
+    if entry.get("name") or entry.get("character_name"):
+        return entry
+    return next((value for value in entry.values() if isinstance(value, dict)), entry)
+
+def split_characters(characters):
+    """
+    Split the output of caracter_extractor in one entry per character.
+
+    Args:
+        characters (dict): the characters_list state key (the parsed extractor response)
+
+    Returns:
+        list: (name, entry) pairs, None if the characters cannot be told apart
+    """
+    # the model wraps the list in a key, e.g. {"character": {"characters": [...]}}
+    while isinstance(characters, dict) and len(characters) == 1:
+        key, value = next(iter(characters.items()))
+        if not isinstance(value, (list, dict)) or (str(key).lower() not in _WRAPPER_KEYS and not isinstance(value, list)):
+            break
+        characters = value
+
+    # a single character
+    if isinstance(characters, dict) and ("name" in characters or "character_name" in characters):
+        characters = [characters]
+
+    entries = []
+    if isinstance(characters, list):
+        for item in characters:
+            if isinstance(item, dict):
+                attributes = character_attributes(item)
+                name = attributes.get("name") or attributes.get("character_name") or next(
+                    (value for value in item.values() if isinstance(value, str)), "")
+            else:
+                name = str(item)
+            entries.append((str(name).strip(), item))
+    elif isinstance(characters, dict):
+        for name, item in characters.items():
+            entries.append((str(name).strip(), item))
+    else:
+        return None
+
+    names = [name for name, _ in entries]
+    if "" in names or len(set(names)) != len(names):
+        return None
+    return entries
+
+def _attributes(name, description):
+    """The attributes of a character description, with its name, as character_description_creator writes them."""
+    # {"character_attributes": {...}} (CharacterDescription) or the attributes themselves
+    if isinstance(description, dict) and len(description) == 1 and isinstance(next(iter(description.values())), dict):
+        description = next(iter(description.values()))
+    attributes = dict(description) if isinstance(description, dict) else {"description": str(description)}
+    if not str(attributes.get("name") or "").strip():
+        attributes = {"name": name, **{key: value for key, value in attributes.items() if key != "name"}}
+    return attributes
+
+def _merge(characters, descriptions):
+    merged = []
+    for (name, entry), description in zip(characters, descriptions):
+        if description is None:
+            # keep what the extractor knew, the user can complete it with the recreator
+            logger.warning("character %s could not be described, keeping the extracted entry", name)
+            description = entry
+        merged.append({"character_attributes": _attributes(name, description)})
+    return {"characters": merged}
+
+def _describe_one(describe, name, entry, retries):
+    for attempt in range(retries + 1):
+        try:
+            description = describe(name, entry)
+            if isinstance(description, dict):
+                return description
+            logger.warning("character %s: description is not a JSON object (attempt %s)", name, attempt + 1)
+        except Exception as error:
+            logger.warning("character %s: description failed (attempt %s): %s", name, attempt + 1, error)
+    return None
+
+async def _adescribe_one(adescribe, name, entry, retries, semaphore):
+    async with semaphore:
+        for attempt in range(retries + 1):
+            try:
+                description = await adescribe(name, entry)
+                if isinstance(description, dict):
+                    return description
+                logger.warning("character %s: description is not a JSON object (attempt %s)", name, attempt + 1)
+            except Exception as error:
+                logger.warning("character %s: description failed (attempt %s): %s", name, attempt + 1, error)
+    return None
+
+def describe_characters(characters, describe, workers=CHARACTER_WORKERS, retries=CHARACTER_RETRIES):
+    """
+    Describe the characters concurrently and merge the descriptions.
+
+    Args:
+        characters (list): (name, entry) pairs from split_characters
+        describe (callable): describe(name, entry) -> dict, one LLM call
+        workers (int): characters described at the same time
+        retries (int): extra attempts for a failed character
+
+    Returns:
+        dict: {"characters": [{"character_attributes": {"name": name, ...}}, ...]} in the order of <characters>,
+            the shape of the whole-cast description (CharactersStructuredInfo) the characters panel renders
+    """
+    with ContextThreadPoolExecutor(max_workers=max(1, min(workers, len(characters)))) as executor:
+        descriptions = list(executor.map(lambda character: _describe_one(describe, *character, retries), characters))
+    return _merge(characters, descriptions)
+
+async def adescribe_characters(characters, adescribe, workers=CHARACTER_WORKERS, retries=CHARACTER_RETRIES):
+    """Async version of describe_characters, adescribe(name, entry) is a coroutine function."""
+    semaphore = asyncio.Semaphore(max(1, workers))
+    descriptions = await asyncio.gather(
+        *(_adescribe_one(adescribe, name, entry, retries, semaphore) for name, entry in characters))
+    return _merge(characters, descriptions)
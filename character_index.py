@@ -0,0 +1,142 @@
+import os
+import re
+import json
+import threading
+from character_fan_out import split_characters, character_attributes
+from story_context import count_tokens
+
+# send the whole record only of the characters mentioned in the current unit and the latest
+# paragraphs, a one-line stub of the others (0 -> every record in every prompt)
+RELEVANT_CHARACTERS = os.getenv("INKREALLM_RELEVANT_CHARACTERS", "1") == "1"
+
+# attributes of a character record holding other names of the character
+_ALIAS_KEYS = ("alias", "aliases", "nickname", "nicknames", "also_known_as", "other_names")
+# attributes of a character record used for its stub, the first one found
+_STUB_KEYS = ("role", "occupation", "profession", "job", "relationship", "relation", "species", "type")
+# longest stub description, in characters
+MAX_STUB_LENGTH = 80
+
+
+class CharacterIndex:
+    """
+    Index from the names and aliases of the characters (character_structured_info) to their records.
+
+    A character is found by its full name, its aliases (the alias/nickname attributes of its
+    record, also inside the character_attributes object of the descriptions) and the parts of its name that no other character shares (e.g. "Mara" for "Mara
+    Quinn"), as whole words. An index built from characters that cannot be told apart (see
+    character_fan_out.split_characters) is not valid and the callers should send the whole
+    character_structured_info.
+
+    Args:
+        character_structured_info (dict): the characters created by the character supervisor
+    """
+
+    def __init__(self, character_structured_info):
+        self.full_text = str(character_structured_info)
+        self.records = {}
+        self.stubs = {}
+        self.pattern = None
+        self.aliases = {}
+        self._full_tokens = None
+        self.valid = False
+
+        characters = split_characters(character_structured_info)
+        if not characters:
+            return
+        parts = {}
+        for name, entry in characters:
+            # the attributes, without the {"character_attributes": ...} wrapper of the descriptions
+            attributes = character_attributes(entry) or entry
+            self.records[name] = attributes
+            self.stubs[name] = self._stub(name, attributes)
+            self.aliases[name] = name
+            for alias in self._aliases(attributes):
+                self.aliases.setdefault(alias, name)
+            for part in re.findall(r"\w+", name):
+                if len(part) > 2 and part[0].isupper():
+                    parts.setdefault(part, set()).add(name)
+        for part, names in parts.items():
+            if len(names) == 1:
+                self.aliases.setdefault(part, next(iter(names)))
+        # the longest alias first, so "Mara Quinn" is matched before "Mara"
+        alternatives = sorted(self.aliases, key=len, reverse=True)
+        self.pattern = re.compile(r"(?<!\w)(?:" + "|".join(re.escape(alias) for alias in alternatives) + r")(?!\w)")
+        self.valid = True
+
+    @staticmethod
+    def _aliases(entry):
+        if not isinstance(entry, dict):
+            return []
+        aliases = []
+        for key, value in entry.items():
+            if str(key).lower() not in _ALIAS_KEYS:
+                continue
+            values = value if isinstance(value, list) else re.split(r"[,;]", str(value))
+            aliases += [str(alias).strip() for alias in values if str(alias).strip()]
+        return aliases
+
+    @staticmethod
+    def _stub(name, entry):
+        if isinstance(entry, dict):
+            for key, value in entry.items():
+                if str(key).lower() in _STUB_KEYS and isinstance(value, str) and value.strip():
+                    description = value.strip()
+                    if len(description) > MAX_STUB_LENGTH:
+                        description = description[:MAX_STUB_LENGTH].rsplit(" ", 1)[0] + "..."
+                    return f"{name} ({description})"
+        return name
+
+    def mentioned(self, *texts):
+        """The names of the characters mentioned in <texts>, in the order of the cast."""
+        if not self.valid:
+            return []
+        found = {self.aliases[match] for text in texts if text for match in self.pattern.findall(text)}
+        return [name for name in self.records if name in found]
+
+    @property
+    def full_tokens(self):
+        """Tokens of the whole character_structured_info, as sent without the index."""
+        if self._full_tokens is None:
+            self._full_tokens = count_tokens(self.full_text)
+        return self._full_tokens
+
+    def render(self, *texts):
+        """
+        The characters information for a prompt about <texts>.
+
+        Args:
+            texts (str): the text the prompt is about (current unit, latest paragraphs...)
+
+        Returns:
+            str: the records of the characters mentioned and a stub line for the others; the
+                whole character_structured_info if the index is not valid or no character is mentioned
+        """
+        mentioned = self.mentioned(*texts)
+        if not mentioned:
+            return self.full_text
+        text = str({name: {key: value for key, value in self.records[name].items() if key != "name"}
+                    if isinstance(self.records[name], dict) else self.records[name] for name in mentioned})
+        others = [self.stubs[name] for name in self.records if name not in mentioned]
+        if others:
+            text += "\n        Other characters (not in this part of the story): " + "; ".join(others)
+        return text
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+# the characters can be recreated by the user a few times, keep only the latest indexes
+MAX_INDEXES = 64
+
+def get_character_index(character_structured_info):
+    """Return the (cached) CharacterIndex of the characters of a story."""
+    try:
+        key = json.dumps(character_structured_info, sort_keys=True, default=str)
+    except (TypeError, ValueError):
+        return CharacterIndex(character_structured_info)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            if len(_indexes) >= MAX_INDEXES:
+                _indexes.pop(next(iter(_indexes)))
+            index = _indexes[key] = CharacterIndex(character_structured_info)
+        return index
@@ -1,50 +1,137 @@
 import os
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
+import time
+import threading
+from uuid import uuid4
 from typing import Annotated
 from typing_extensions import TypedDict
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langchain.tools import tool
 from langgraph.prebuilt import ToolNode
-from langgraph.checkpoint.memory import MemorySaver
 from dotenv import load_dotenv
 from langchain.prompts import PromptTemplate
 from langchain.schema import AIMessage
 from langgraph.errors import NodeInterrupt
-import time
+from langgraph.utils.runnable import RunnableCallable
+from story_context import build_paragraph_context, record_prompt_tokens, count_tokens, RECENT_PARAGRAPHS
+from speculation import SPECULATIVE_WRITING, speculative_writer
+from structure_index import get_structure_index
+from character_fan_out import CHARACTER_FAN_OUT, split_characters, describe_characters, adescribe_characters
+from sqlite_checkpointer import SqliteCheckpointer
+from llm_cache import cached_llm
+from manuscript_store import manuscript_store
+from running_summary import RUNNING_SUMMARY, running_summaries
+from passage_index import PASSAGE_RETRIEVAL, RETRIEVED_PASSAGES, passage_indexes
+from character_index import RELEVANT_CHARACTERS, get_character_index
+from chain_registry import chain_registry, WARM_UP_CONNECTIONS
+from structured_output import validate_structured_output, structured_message, structured_output
 
 load_dotenv(override=True)
 
-memory = MemorySaver()
+# checkpoints of all the threads, kept on disk
+CHECKPOINT_DB = os.getenv("INKREALLM_CHECKPOINT_DB", "checkpoints.sqlite")
+# directory of the saved writings (a run can set another one in config["configurable"]["output_dir"])
+OUTPUT_DIR = os.getenv("INKREALLM_OUTPUT_DIR", ".")
+# the checkpointer and the compiled graph are created on first use (or by warm_up)
+_checkpointer = None
+_graph = None
+_lazy_lock = threading.RLock()
+
+def get_checkpointer():
+    """The checkpointer of all the graphs, opened on first use."""
+    global _checkpointer
+    if _checkpointer is None:
+        with _lazy_lock:
+            if _checkpointer is None:
+                _checkpointer = SqliteCheckpointer(CHECKPOINT_DB)
+    return _checkpointer
+
+def sync_async_node(func, afunc):
+    """
+    Wrap the sync and async implementation of a node, so the graphs can be run
+    both with stream/invoke and with astream/ainvoke.
+    """
+    return RunnableCallable(func, afunc, name=func.__name__, trace=False)
 
-# llm_objects
-openai_llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.7,
-    max_tokens=None,
-    timeout=None,
-    max_retries=2,
-    api_key=os.getenv("OPENAI_API_KEY")
-)
+def stream_config(config):
+    """
+    Copy of <config> for one stream/astream call. With subgraphs=True, LangGraph stores its
+    stream in config["configurable"]: a config reused turn after turn nests one more stream
+    every turn, until the recursion limit of Python.
+    """
+    return {**config, "configurable": dict(config.get("configurable", {}))}
 
-openai_strict_llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0,
-    max_tokens=None,
-    timeout=None,
-    max_retries=2,
-    api_key=os.getenv("OPENAI_API_KEY")
-)
+def thread_manuscript(config):
+    """The manuscript of the thread of <config>, where the accepted text is appended (see manuscript_store.py)."""
+    return manuscript_store.get(config["configurable"]["thread_id"])
 
-gemini_llm = ChatGoogleGenerativeAI(
-    model="gemini-1.5-pro",
-    temperature=0.7,
-    max_tokens=None,
-    timeout=None,
-    max_retries=2,
-    api_key=os.getenv("GEMINI_API_KEY")
-)
+def summary_lines(state):
+    """The summaries of the finished units, one line per unit."""
+    return [line for line in state.get("story_summary", "").split("\n") if line.strip()]
+
+def thread_passages(state, config):
+    """The passage index of the thread of <config> (see passage_index.py), built from its manuscript on first use."""
+    return passage_indexes.get(config["configurable"]["thread_id"], thread_manuscript(config), summary_lines(state))
+
+def unit_texts(state):
+    """
+    The text the paragraph writer and rewriter prompts are about: the name and the summary of
+    the current unit from the structure (without the keys of the entry) and the latest paragraphs.
+    """
+    actual_unit = state.get("actual_unit", [])
+    unit = get_structure_index(state["story_structured_info"]).unit(actual_unit[0].content if actual_unit else "")
+    current_unit = " ".join(str(value) for value in unit.values()) if isinstance(unit, dict) else ""
+    recent = " ".join(element.content for element in state.get("story_content", [])[-RECENT_PARAGRAPHS:])
+    return current_unit, recent
+
+def related_passages(state, config):
+    """
+    The passages of the story (paragraphs and unit summaries) most related to the current unit
+    and to the characters of the latest paragraphs, in story order. The latest paragraphs,
+    already sent verbatim, are left out.
+    """
+    unit_number = state.get("unit_number")
+    if not PASSAGE_RETRIEVAL or not unit_number:
+        return []
+    actual_unit = state.get("actual_unit", [])
+    current_unit, recent = unit_texts(state)
+    involved = get_character_index(state.get("character_structured_info", {})).mentioned(current_unit, recent)
+    exclude = {("paragraph", unit_number, paragraph)
+               for paragraph in range(max(len(actual_unit) - RECENT_PARAGRAPHS, 1), len(actual_unit))}
+    manuscript = thread_manuscript(config)
+    summaries = summary_lines(state)
+    passages = []
+    for key, _ in thread_passages(state, config).search(" ".join([current_unit, *involved]), RETRIEVED_PASSAGES, exclude):
+        if key[0] == "paragraph":
+            passages.append(manuscript.read(key[1], key[2]))
+        elif key[1] <= len(summaries):
+            passages.append(summaries[key[1] - 1])
+    return passages
+
+def characters_information(state, *texts):
+    """
+    The characters information of the paragraph writer and rewriter prompts: the records of the
+    characters mentioned in the current unit, the latest paragraphs and <texts>, a stub line for
+    the others (see character_index.py).
+
+    Returns:
+        tuple: the characters information and the prompt tokens it saves against the whole records
+    """
+    character_structured_info = state["character_structured_info"]
+    if not RELEVANT_CHARACTERS:
+        return str(character_structured_info), 0
+    index = get_character_index(character_structured_info)
+    information = index.render(*unit_texts(state), *texts)
+    if information == index.full_text:
+        return information, 0
+    return information, index.full_tokens - count_tokens(information)
+
+# nodes whose LLM tokens are forwarded to the UI through stream_mode="messages"
+STREAMED_NODES = ("next_paragraph_writer", "paragraph_rewriter")
+
+# The nodes that wait for the user show their draft by appending it to temp_messages before the
+# NodeInterrupt; app1.py sends it back with the same id, so add_messages replaces it instead of
+# adding it twice if the checkpoint was saved after the append.
 
 # SUBGRAPHS
 
@@ -55,22 +142,7 @@ class InfoGathererSubgraphState(TypedDict):
     agent_007_need_answer: bool
     additional_info_gatherer_need_answer: bool
 
-def agent_007(state: InfoGathererSubgraphState):
-    if state.get("agent_007_need_answer") == True:
-        raise NodeInterrupt(
-            f"Question interrupt.")
-    # Count questions by checking message content
-    #(messages must be type AI & Message content is not "FINISH")
-    question_count = sum(1 for msg in state["temp_messages"] 
-                        if hasattr(msg, 'type') and msg.type == 'ai' 
-                        and msg.content != "FINISH")
-    
-    conversation_history = "\n".join([
-        f"{'User' if msg.type == 'human' else 'Assistant'}: {msg.content}" 
-        for msg in state["temp_messages"]
-    ])
-
-    story_info_extraction_template = PromptTemplate.from_template("""
+STORY_INFO_EXTRACTION_TEMPLATE = PromptTemplate.from_template("""
     You are a very talented writer initiating a writing project.
 
     INITIAL STEP: Determine the Type of Writing
@@ -97,14 +169,27 @@ def agent_007(state: InfoGathererSubgraphState):
     
     IMPORTANT: When responding with "FINISH", send ONLY the word "FINISH" without any other text.
 """)
+chain_registry.register("agent_007", lambda: STORY_INFO_EXTRACTION_TEMPLATE | chain_registry.route("fast", role="question"))
 
-    chain = story_info_extraction_template | openai_llm
-    response = chain.invoke({
+def agent_007_request(state: InfoGathererSubgraphState):
+    # Count questions by checking message content
+    #(messages must be type AI & Message content is not "FINISH")
+    question_count = sum(1 for msg in state["temp_messages"] 
+                        if hasattr(msg, 'type') and msg.type == 'ai' 
+                        and msg.content != "FINISH")
+    
+    conversation_history = "\n".join([
+        f"{'User' if msg.type == 'human' else 'Assistant'}: {msg.content}" 
+        for msg in state["temp_messages"]
+    ])
+
+    chain = chain_registry.get("agent_007")
+    return chain, {
         "information": conversation_history,
         "question_count": question_count
-    })
-    time.sleep(1)
-    
+    }
+
+def agent_007_result(response):
     # Create AIMessage
     if response.content == "FINISH":
         return {
@@ -118,13 +203,21 @@ def agent_007(state: InfoGathererSubgraphState):
         "agent_007_need_answer": True
     }
 
-def additional_info_gatherer(state: InfoGathererSubgraphState):
-    if state.get("additional_info_gatherer_need_answer") == True:
+def agent_007(state: InfoGathererSubgraphState):
+    if state.get("agent_007_need_answer") == True:
         raise NodeInterrupt(
-            f"Additional info interrupt.")
-    if state["temp_messages"][-1].content == "":
-        return {"temp_messages": [AIMessage(content="FINISH")]}
-    additional_info_template = PromptTemplate.from_template("""
+            f"Question interrupt.")
+    chain, prompt_values = agent_007_request(state)
+    return agent_007_result(chain.invoke(prompt_values))
+
+async def agent_007_async(state: InfoGathererSubgraphState):
+    if state.get("agent_007_need_answer") == True:
+        raise NodeInterrupt(
+            f"Question interrupt.")
+    chain, prompt_values = agent_007_request(state)
+    return agent_007_result(await chain.ainvoke(prompt_values))
+
+ADDITIONAL_INFO_TEMPLATE = PromptTemplate.from_template("""
     You are a very helpful assistant.
 
     Write ONLY in ENGLISH!
@@ -137,21 +230,54 @@ def additional_info_gatherer(state: InfoGathererSubgraphState):
     a) If the user confirms they have NO additional information respond ONLY with the word: "FINISH"
     b) If the user indicates they DO have additional information ask to provide the specific additional details or information for the writing project                                                                                                            
     """)
-    chain = additional_info_template | openai_llm
-    response = chain.invoke({"previous_answer": state["temp_messages"][-1].content})
-    time.sleep(1)
+chain_registry.register("additional_info_gatherer", lambda: ADDITIONAL_INFO_TEMPLATE | chain_registry.route("fast", role="question"))
+
+def additional_info_gatherer_request(state: InfoGathererSubgraphState):
+    chain = chain_registry.get("additional_info_gatherer")
+    return chain, {"previous_answer": state["temp_messages"][-1].content}
+
+def additional_info_gatherer_result(response):
     if response.content == "FINISH":
         return {"temp_messages": [AIMessage(content=response.content)], "additional_info_gatherer_need_answer": True}
     return {"temp_messages": [AIMessage(content=response.content)], "additional_info_gatherer_need_answer": True}
 
-def info_condenser(state: InfoGathererSubgraphState):
-    story_info_condenser_template = PromptTemplate.from_template("""
+def additional_info_gatherer(state: InfoGathererSubgraphState):
+    if state.get("additional_info_gatherer_need_answer") == True:
+        raise NodeInterrupt(
+            f"Additional info interrupt.")
+    if state["temp_messages"][-1].content == "":
+        return {"temp_messages": [AIMessage(content="FINISH")]}
+    chain, prompt_values = additional_info_gatherer_request(state)
+    return additional_info_gatherer_result(chain.invoke(prompt_values))
+
+async def additional_info_gatherer_async(state: InfoGathererSubgraphState):
+    if state.get("additional_info_gatherer_need_answer") == True:
+        raise NodeInterrupt(
+            f"Additional info interrupt.")
+    if state["temp_messages"][-1].content == "":
+        return {"temp_messages": [AIMessage(content="FINISH")]}
+    chain, prompt_values = additional_info_gatherer_request(state)
+    return additional_info_gatherer_result(await chain.ainvoke(prompt_values))
+
+STORY_INFO_CONDENSER_TEMPLATE = PromptTemplate.from_template("""
     You are a very talented writer.
     Please extract from {information} in a list all the information provided by the user about the writing he want (asked questions and answers).
     Respond with a structure ["question: answer"] as plain text.                                                               
     """)
-    chain = story_info_condenser_template | openai_llm
-    response = chain.invoke({"information": state["temp_messages"]})
+chain_registry.register("info_condenser", lambda: STORY_INFO_CONDENSER_TEMPLATE | chain_registry.route("fast", lambda llm: cached_llm(llm, "info_condenser"), role="story_info"))
+
+def info_condenser_request(state: InfoGathererSubgraphState):
+    chain = chain_registry.get("info_condenser")
+    return chain, {"information": state["temp_messages"]}
+
+def info_condenser(state: InfoGathererSubgraphState):
+    chain, prompt_values = info_condenser_request(state)
+    response = chain.invoke(prompt_values)
+    return {"story_info": [response.content]}
+
+async def info_condenser_async(state: InfoGathererSubgraphState):
+    chain, prompt_values = info_condenser_request(state)
+    response = await chain.ainvoke(prompt_values)
     return {"story_info": [response.content]}
 
 def chatbot_router1(
@@ -189,9 +315,9 @@ def chatbot_router2(
     return "additional_info"
 
 inf_gatherer_subgraph_builder = StateGraph(InfoGathererSubgraphState)
-inf_gatherer_subgraph_builder.add_node("info_asker", agent_007)
-inf_gatherer_subgraph_builder.add_node("additional_info", additional_info_gatherer)
-inf_gatherer_subgraph_builder.add_node("info_condenser", info_condenser)
+inf_gatherer_subgraph_builder.add_node("info_asker", sync_async_node(agent_007, agent_007_async))
+inf_gatherer_subgraph_builder.add_node("additional_info", sync_async_node(additional_info_gatherer, additional_info_gatherer_async))
+inf_gatherer_subgraph_builder.add_node("info_condenser", sync_async_node(info_condenser, info_condenser_async))
 inf_gatherer_subgraph_builder.add_edge(START, "info_asker")
 
 # # After the "info_asker" node, chatbot_router1 decides the next step
@@ -211,8 +337,6 @@ inf_gatherer_subgraph_builder.add_conditional_edges(
     chatbot_router2,
     {"additional_info": "additional_info", "info_condenser": "info_condenser"},
 )
-#Finalizes the state graph, creating a compiled workflow
-inf_gatherer_subgraph = inf_gatherer_subgraph_builder.compile(checkpointer=memory)
 
 
 # STORY WRITER SUBGRAPH
@@ -223,7 +347,9 @@ class StoryWriterSubgraphState(TypedDict):
     character_structured_info: dict
     story_structured_info: dict
     story_content: list
+    story_summary: str
     actual_unit: list
+    unit_number: int
     state_user_input: str
     paragraph_to_change: str
     unit_length: str
@@ -231,73 +357,35 @@ class StoryWriterSubgraphState(TypedDict):
     paragraph_rewriter_has_answer: bool
     characters_changed: bool
     
-def next_paragraph_writer(state: StoryWriterSubgraphState):
-    if state.get("next_paragraph_writer_has_answer") != True:
-        story_content = state.get("story_content", [])
-        unit_length = state.get("unit_length", [])
-        no_previous_paragraphs = len(story_content) - 1
-        
-        next_paragraph_writer_template = PromptTemplate.from_template("""
-        
-        You are an advanced narrative writer tasked with continuing a story with precision and creative depth.
-        Context:
-        - Character Details: {character_structured_info}
-        - Story Structure: {story_structured_info}
-        - Previous Narrative: {story_content}
-        - Current Progress: {no_previous_paragraphs} of {unit_length} paragraphs completed
-        - Current Unit Description: unit description of the current unit from the Writing structure
-        
-        Writing Guidelines:
-        1. Narrative Continuity
-        - Maintain consistent style, tone, and narrative flow
-        - Align with previous paragraphs and story structure
-        - Seamlessly integrate current unit description
-
-        2. Dialogue Formatting
-        - Use em dash (—) for dialogue
-        - Separate dialogue from narrative text
-        - Include dialogue only when narratively necessary
-        - Example:
-        — Do you want something like this? asks Mike.
-        — Then you learn, man! replies Tom.
-        — Mike's encouragement sparked a glimmer of hope.
-
-        3. Character Interaction
-        - Ensure character actions and reactions consistently reflect:
-           - Individual character traits
-           - Current story context
-           - Interpersonal dynamics
-                                                                      
-        Evaluation Criteria:
-        - Narrative progression
-        - Character authenticity
-        - Structural alignment
-        - Stylistic consistency
-
-        Response Protocol. IMPORTANT!:
-        - If <{unit_length}> is bigger than <{no_previous_paragraphs}>:
-           - Write next paragraph
-           - Maintain narrative coherence
-        - If <{no_previous_paragraphs}> is equal or bigger than <{unit_length}>:
-           - Respond ONLY with "FINISH", nothing else!
-
-        """)
-        chain = next_paragraph_writer_template | openai_llm
-        response = chain.invoke({"story_content": story_content,
-                                 "character_structured_info": str(state["character_structured_info"]),
-                                 "story_structured_info": str(state["story_structured_info"]),
-                                 "unit_length": unit_length, "no_previous_paragraphs": no_previous_paragraphs})
-        state['temp_messages'].append(AIMessage(content=response.content))
-        time.sleep(2)
-        raise NodeInterrupt(
-                f"Next paragraph writer interrupt.")
+def commit_paragraph(state: StoryWriterSubgraphState, config, actual_unit):
+    """
+    Append the paragraph just accepted (the last of <actual_unit>) to the manuscript and the
+    passage index of the thread and fold it into the running summary of the unit, in the background.
+    """
+    unit_number = state.get("unit_number")
+    # threads started before the manuscript store have no unit number, story_saver saves their full_story
+    if unit_number:
+        thread_manuscript(config).append(unit_number, len(actual_unit) - 1, actual_unit[-1].content)
+        if PASSAGE_RETRIEVAL:
+            thread_passages(state, config).add(("paragraph", unit_number, len(actual_unit) - 1), actual_unit[-1].content)
+        if RUNNING_SUMMARY:
+            running_summaries.fold(config["configurable"]["thread_id"], unit_number, len(actual_unit) - 1,
+                                   chain_registry.get("unit_summary"),
+                                   {"unit_name": actual_unit[0].content, "paragraph": actual_unit[-1].content}, config)
+
+def paragraph_answer(state: StoryWriterSubgraphState, config):
+    """Handle the user answer to a written (or rewritten) paragraph."""
     user_input = state.get("temp_messages")[-1].content
     response = state.get("temp_messages")[-2]
     story_content = state.get("story_content", [])
     actual_unit = state.get("actual_unit", [])
+    if user_input != "":
+        # rewrite (or end of the unit): the paragraph written ahead for this draft is not needed
+        speculative_writer.discard(response.id)
     if (user_input == "") and (response.content != "FINISH"):
         story_content.append(response)
         actual_unit.append(response)
+        commit_paragraph(state, config, actual_unit)
         return {"story_content": story_content,
                 "actual_unit": actual_unit,
                 "state_user_input": user_input, 
@@ -309,6 +397,7 @@ def next_paragraph_writer(state: StoryWriterSubgraphState):
     elif user_input == "FINISH":
         story_content.append(response)
         actual_unit.append(response)
+        commit_paragraph(state, config, actual_unit)
         return {"temp_messages": [AIMessage(content="FINISH")], 
                 "story_content": story_content,
                 "actual_unit": actual_unit,
@@ -319,65 +408,163 @@ def next_paragraph_writer(state: StoryWriterSubgraphState):
             "paragraph_rewriter_has_answer": False,
             "characters_changed": False}
 
-def paragraph_rewriter(state: StoryWriterSubgraphState):
-    if state.get("paragraph_rewriter_has_answer") != True:
-        user_input = state.get("state_user_input", "")
-        story_content = state.get("story_content", [])
-        paragraph_to_change = state.get("paragraph_to_change", "")    
-        paragraph_rewriter_template = PromptTemplate.from_template("""
-        You are a very talented writer working on a writing.
+NEXT_PARAGRAPH_WRITER_TEMPLATE = PromptTemplate.from_template("""
+    
+    You are an advanced narrative writer tasked with continuing a story with precision and creative depth.
+    Context:
+    - Character Details: {character_structured_info}
+    - Story So Far (summary of the previous units): {story_summary}
+    - Earlier In The Current Unit: {unit_so_far}
+    - Related Earlier Passages: {related_passages}
+    - Previous Narrative (latest paragraphs): {story_content}
+    - Current Progress: {no_previous_paragraphs} of {unit_length} paragraphs completed
+    - Current Unit Description: {current_unit}
+    
+    Writing Guidelines:
+    1. Narrative Continuity
+    - Maintain consistent style, tone, and narrative flow
+    - Align with previous paragraphs and story structure
+    - Seamlessly integrate current unit description
+
+    2. Dialogue Formatting
+    - Use em dash (—) for dialogue
+    - Separate dialogue from narrative text
+    - Include dialogue only when narratively necessary
+    - Example:
+    — Do you want something like this? asks Mike.
+    — Then you learn, man! replies Tom.
+    — Mike's encouragement sparked a glimmer of hope.
+
+    3. Character Interaction
+    - Ensure character actions and reactions consistently reflect:
+       - Individual character traits
+       - Current story context
+       - Interpersonal dynamics
+                                                                  
+    Evaluation Criteria:
+    - Narrative progression
+    - Character authenticity
+    - Structural alignment
+    - Stylistic consistency
+
+    Response Protocol. IMPORTANT!:
+    - If <{unit_length}> is bigger than <{no_previous_paragraphs}>:
+       - Write next paragraph
+       - Maintain narrative coherence
+    - If <{no_previous_paragraphs}> is equal or bigger than <{unit_length}>:
+       - Respond ONLY with "FINISH", nothing else!
 
-        Context:
-            - Characters Information: {character_structured_info}
-            - Writing structure: {story_structured_info}
-            - Previous Paragraphs: {story_content}
-            - User Input: {user_input}
-            - Paragraph to be Changed: {paragraph_to_change}
+    """)
+chain_registry.register("next_paragraph_writer", lambda: NEXT_PARAGRAPH_WRITER_TEMPLATE | chain_registry.route("prose", role="paragraph"))
 
-        Task:
-            - Rewrite the paragraph to be changed based on the requirements from the user input.
+def next_paragraph_writer_request(state: StoryWriterSubgraphState, config, record=True):
+    story_content = state.get("story_content", [])
+    unit_length = state.get("unit_length", [])
+    no_previous_paragraphs = len(story_content) - 1
+    chain = chain_registry.get("next_paragraph_writer")
+    character_information, saved_tokens = characters_information(state)
+    prompt_values = {**build_paragraph_context(state, related_passages(state, config)),
+                     "character_structured_info": character_information,
+                     "unit_length": unit_length, "no_previous_paragraphs": no_previous_paragraphs}
+    if record:
+        record_prompt_tokens("next_paragraph_writer", NEXT_PARAGRAPH_WRITER_TEMPLATE.format(**prompt_values),
+                             no_previous_paragraphs, saved_tokens)
+    return chain, prompt_values
+
+def show_draft(state: StoryWriterSubgraphState, content, config):
+    """
+    Append the draft for the author to temp_messages and, in speculative mode,
+    start writing the paragraph that follows it.
+    """
+    draft = AIMessage(content=content, id=str(uuid4()))
+    state['temp_messages'].append(draft)
+    if SPECULATIVE_WRITING and content != "FINISH":
+        accepted_state = {**state,
+                          "story_content": state.get("story_content", []) + [draft],
+                          "actual_unit": state.get("actual_unit", []) + [draft]}
+        chain, prompt_values = next_paragraph_writer_request(accepted_state, config, record=False)
+        speculative_writer.start(draft.id, chain, prompt_values, count_tokens(str(prompt_values)), config)
+
+def accepted_draft_id(state: StoryWriterSubgraphState):
+    story_content = state.get("story_content", [])
+    return story_content[-1].id if len(story_content) > 1 else None
 
+def next_paragraph_writer(state: StoryWriterSubgraphState, config):
+    if state.get("next_paragraph_writer_has_answer") != True:
+        chain, prompt_values = next_paragraph_writer_request(state, config)
+        response = speculative_writer.take(accepted_draft_id(state), prompt_values)
+        if response is None:
+            response = chain.invoke(prompt_values)
+        show_draft(state, response.content, config)
+        raise NodeInterrupt(
+                f"Next paragraph writer interrupt.")
+    return paragraph_answer(state, config)
 
-        Response Requirements:
-            - The paragraph should be rewritten based on the user input requirements.
-            - For keeping the paragraph attributes, OTHER that those required to be changed, use the characters information, writing structure and previous paragraphs.
-        """)
-        chain = paragraph_rewriter_template | openai_llm
-        response = chain.invoke({"story_content": story_content, 
-                                 "user_input": user_input, "paragraph_to_change": paragraph_to_change,
-                                 "character_structured_info": str(state["character_structured_info"]),
-                                 "story_structured_info": str(state["story_structured_info"])})
-        state['temp_messages'].append(AIMessage(content=response.content))
-        time.sleep(2)
+async def next_paragraph_writer_async(state: StoryWriterSubgraphState, config):
+    if state.get("next_paragraph_writer_has_answer") != True:
+        chain, prompt_values = next_paragraph_writer_request(state, config)
+        response = await speculative_writer.atake(accepted_draft_id(state), prompt_values)
+        if response is None:
+            response = await chain.ainvoke(prompt_values)
+        show_draft(state, response.content, config)
         raise NodeInterrupt(
-                f"Paragraph rewriter interrupt.")
-    user_input = state.get("temp_messages")[-1].content
-    response = state.get("temp_messages")[-2]
+                f"Next paragraph writer interrupt.")
+    return paragraph_answer(state, config)
+
+PARAGRAPH_REWRITER_TEMPLATE = PromptTemplate.from_template("""
+    You are a very talented writer working on a writing.
+
+    Context:
+        - Characters Information: {character_structured_info}
+        - Story So Far (summary of the previous units): {story_summary}
+        - Earlier In The Current Unit: {unit_so_far}
+        - Related Earlier Passages: {related_passages}
+        - Current Unit: {current_unit}
+        - Previous Paragraphs: {story_content}
+        - User Input: {user_input}
+        - Paragraph to be Changed: {paragraph_to_change}
+
+    Task:
+        - Rewrite the paragraph to be changed based on the requirements from the user input.
+
+
+    Response Requirements:
+        - The paragraph should be rewritten based on the user input requirements.
+        - For keeping the paragraph attributes, OTHER that those required to be changed, use the characters information, writing structure and previous paragraphs.
+    """)
+chain_registry.register("paragraph_rewriter", lambda: PARAGRAPH_REWRITER_TEMPLATE | chain_registry.route("prose", role="paragraph"))
+
+def paragraph_rewriter_request(state: StoryWriterSubgraphState, config):
+    user_input = state.get("state_user_input", "")
     story_content = state.get("story_content", [])
-    actual_unit = state.get("actual_unit", [])
-    if (user_input == "") and (response.content != "FINISH"):
-        story_content.append(response)
-        actual_unit.append(response)
-        return {"story_content": story_content,
-                "actual_unit": actual_unit,
-                "state_user_input": user_input, 
-                "next_paragraph_writer_has_answer": False,
-                "characters_changed": False}
-    elif (user_input == "") and (response.content == "FINISH"):
-        return {"temp_messages": [AIMessage(content="FINISH")], 
-                "characters_changed": False}
-    elif (user_input == "FINISH"):
-        story_content.append(response)
-        actual_unit.append(response)
-        return {"temp_messages": [AIMessage(content="FINISH")], 
-                "story_content": story_content,
-                "actual_unit": actual_unit,
-                "state_user_input": user_input,
-                "characters_changed": False}
-    return {"state_user_input": user_input,
-            "paragraph_to_change": response.content,
-            "paragraph_rewriter_has_answer": False,
-            "characters_changed": False}
+    paragraph_to_change = state.get("paragraph_to_change", "")    
+    chain = chain_registry.get("paragraph_rewriter")
+    # the paragraph to change and the user input can mention other characters than the unit
+    character_information, saved_tokens = characters_information(state, str(paragraph_to_change), str(user_input))
+    prompt_values = {**build_paragraph_context(state, related_passages(state, config)),
+                     "user_input": user_input, "paragraph_to_change": paragraph_to_change,
+                     "character_structured_info": character_information}
+    record_prompt_tokens("paragraph_rewriter", PARAGRAPH_REWRITER_TEMPLATE.format(**prompt_values),
+                         len(story_content) - 1, saved_tokens)
+    return chain, prompt_values
+
+def paragraph_rewriter(state: StoryWriterSubgraphState, config):
+    if state.get("paragraph_rewriter_has_answer") != True:
+        chain, prompt_values = paragraph_rewriter_request(state, config)
+        response = chain.invoke(prompt_values)
+        show_draft(state, response.content, config)
+        raise NodeInterrupt(
+                f"Paragraph rewriter interrupt.")
+    return paragraph_answer(state, config)
+
+async def paragraph_rewriter_async(state: StoryWriterSubgraphState, config):
+    if state.get("paragraph_rewriter_has_answer") != True:
+        chain, prompt_values = paragraph_rewriter_request(state, config)
+        response = await chain.ainvoke(prompt_values)
+        show_draft(state, response.content, config)
+        raise NodeInterrupt(
+                f"Paragraph rewriter interrupt.")
+    return paragraph_answer(state, config)
 
 def chatbot_router3(
     state: StoryWriterSubgraphState,
@@ -397,8 +584,8 @@ def chatbot_router3(
     
 
 story_writer_subgraph_builder = StateGraph(StoryWriterSubgraphState)
-story_writer_subgraph_builder.add_node("next_paragraph_writer", next_paragraph_writer)
-story_writer_subgraph_builder.add_node("paragraph_rewriter", paragraph_rewriter)
+story_writer_subgraph_builder.add_node("next_paragraph_writer", sync_async_node(next_paragraph_writer, next_paragraph_writer_async))
+story_writer_subgraph_builder.add_node("paragraph_rewriter", sync_async_node(paragraph_rewriter, paragraph_rewriter_async))
 
 story_writer_subgraph_builder.add_edge(START, "next_paragraph_writer")
 
@@ -414,8 +601,6 @@ story_writer_subgraph_builder.add_conditional_edges(
     chatbot_router3,
     {"next_paragraph_writer": "next_paragraph_writer", "paragraph_rewriter": "paragraph_rewriter", "END": END},
 )
-#Finalizes the state graph, creating a compiled workflow
-story_writer_subgraph = story_writer_subgraph_builder.compile(checkpointer=memory)
 
 
 
@@ -426,6 +611,7 @@ class CharacterSupervisorSubgraphState(TypedDict):
     story_info: Annotated[list, add_messages]
     story_content: Annotated[list, add_messages]
     characters_info: Annotated[list, add_messages]
+    characters_list: dict
     character_structured_info: dict
     character_description_structure: dict
     characters_changed: bool
@@ -441,9 +627,10 @@ class CharactersList(TypedDict):
 class CharactersStructuredInfo(TypedDict):
     characters : Annotated[dict, "List of characters with structured information"]
 
-def character_structure_creator(state: CharacterSupervisorSubgraphState):
-    structured_openai_llm = openai_llm.with_structured_output(CharacterStructure, method="json_mode")
-    character_structure_creator_template = PromptTemplate.from_template("""
+class CharacterDescription(TypedDict):
+    character_attributes: Annotated[dict, "Attributes and traits of one character"]
+
+CHARACTER_STRUCTURE_CREATOR_TEMPLATE = PromptTemplate.from_template("""
     You are a very talented writer.
     Taking into consideration the information provided by the user about the writing attributes he want, from <{story_info}>, 
     please create a set of atributes or traits that you would need in order to define any character that could appear in the writing.
@@ -451,14 +638,26 @@ def character_structure_creator(state: CharacterSupervisorSubgraphState):
     Do not use relations or history, since the list will be populated before starting to write the writing.
     Respond in JSON.
     """)
-    chain = character_structure_creator_template | structured_openai_llm
-    response = chain.invoke({"story_info": state["story_info"]})
-    return {"temp_messages": [AIMessage(content=str(response))], "character_description_structure": [str(response)]}
+chain_registry.register("character_structure_creator", lambda: CHARACTER_STRUCTURE_CREATOR_TEMPLATE | chain_registry.route("structured", lambda llm: llm.with_structured_output(CharacterStructure, method="json_mode"), role="json"))
 
+def character_structure_creator_request(state: CharacterSupervisorSubgraphState):
+    chain = chain_registry.get("character_structure_creator")
+    return chain, {"story_info": state["story_info"]}
 
-def caracter_extractor(state: CharacterSupervisorSubgraphState):
-    structured_openai_llm = openai_llm.with_structured_output(CharactersList, method="json_mode")
-    character_extractor_template = PromptTemplate.from_template("""
+def character_structure_creator_result(response):
+    response = validate_structured_output(response, "character_structure_creator")
+    return {"temp_messages": [structured_message(response)], "character_description_structure": [str(response)]}
+
+def character_structure_creator(state: CharacterSupervisorSubgraphState):
+    chain, prompt_values = character_structure_creator_request(state)
+    return character_structure_creator_result(chain.invoke(prompt_values))
+
+async def character_structure_creator_async(state: CharacterSupervisorSubgraphState):
+    chain, prompt_values = character_structure_creator_request(state)
+    return character_structure_creator_result(await chain.ainvoke(prompt_values))
+
+
+CHARACTER_EXTRACTOR_TEMPLATE = PromptTemplate.from_template("""
     You are a very talented writer.
     Taking into consideration the information provided by the user about the writing, from <{story_info}>, 
     please extract from the information provided by user the characters that appear in the writing.
@@ -467,93 +666,160 @@ def caracter_extractor(state: CharacterSupervisorSubgraphState):
     If there is no characters - respond with an empty list.
     Respond in JSON.
     """)
-    chain = character_extractor_template | structured_openai_llm
-    response = chain.invoke({"story_info": state["story_info"]})
-    return {"temp_messages": [AIMessage(content=str(response))], 
+chain_registry.register("caracter_extractor", lambda: CHARACTER_EXTRACTOR_TEMPLATE | chain_registry.route("structured", lambda llm: llm.with_structured_output(CharactersList, method="json_mode"), role="json"))
+
+def caracter_extractor_request(state: CharacterSupervisorSubgraphState):
+    chain = chain_registry.get("caracter_extractor")
+    return chain, {"story_info": state["story_info"]}
+
+def caracter_extractor_result(response):
+    response = validate_structured_output(response, "caracter_extractor")
+    # characters_info is the text given to the prompts, characters_list the parsed characters
+    return {"temp_messages": [structured_message(response)], 
             "characters_info": [str(response)], 
+            "characters_list": response,
             'characters_changed': True}
 
-def character_description_creator(state: CharacterSupervisorSubgraphState):
+def caracter_extractor(state: CharacterSupervisorSubgraphState):
+    chain, prompt_values = caracter_extractor_request(state)
+    return caracter_extractor_result(chain.invoke(prompt_values))
+
+async def caracter_extractor_async(state: CharacterSupervisorSubgraphState):
+    chain, prompt_values = caracter_extractor_request(state)
+    return caracter_extractor_result(await chain.ainvoke(prompt_values))
+
+def characters_draft(response):
+    """The state update of a characters draft: the JSON shown in the chat and the validated characters."""
+    return {"temp_messages": [structured_message(response, id=str(uuid4()))],
+            "character_structured_info": response}
+
+def characters_answer(state: CharacterSupervisorSubgraphState):
+    """Wait for the user answer to the characters draft, then handle it."""
     if state.get("characters_strcture_has_answer") != True:
-        structured_openai_llm = openai_llm.with_structured_output(CharactersStructuredInfo, method="json_mode")
-        character_description_creator_template = PromptTemplate.from_template("""
-        You are a very talented writer.
-        Taking into consideration the information provided by the user about the writing, from <{story_info}> and the list of characters from <{characters_info}>
-        please describe each character following the structure <{character_info_structure}> for each character in the provided list of characters.
-        In the descriptions, include only values, without types.
-        If there are no characters in the list of characters - return an empty list.
-        The attributes and traits for each character should be taken from the list of characters when the needed information is there, 
-        otherwise, infer them based on the information provided by the user about the writing.
-        Respond in JSON.
-        """)
-        chain = character_description_creator_template | structured_openai_llm
-        response = chain.invoke({"story_info": state["story_info"], 
-                                "characters_info": state["characters_info"],
-                                 "character_info_structure": state["character_description_structure"]}
-                                 )
-        state['temp_messages'].append(AIMessage(content=str(response)))
-        time.sleep(2)
         raise NodeInterrupt(
                 f"Character structure writer interrupt.")
     user_input = state.get("temp_messages")[-1].content
-    response = eval(state.get("temp_messages")[-2].content)
+    # the draft node stored the validated characters, the message is only the chat view
+    response = state.get("character_structured_info") or structured_output(state.get("temp_messages")[-2])
+    if response is None:
+        raise ValueError("the answered message is not a characters draft")
     if (user_input == "") or (user_input == "FINISH"):
-        return {"temp_messages": [AIMessage(content=str(response))],
-                "character_structured_info": response, 
+        return {"temp_messages": [structured_message(response)],
                 "state_user_input": user_input, 
                 "characters_strcture_has_answer": False,
                 "characters_changed": False}
-    return {"temp_messages": [AIMessage(content=str(response))],
+    return {"temp_messages": [structured_message(response)],
             "state_user_input": user_input,
-            "character_structured_info": response,
             "characters_strcture_has_answer": False,
             "characters_changed": True}
 
-def character_description_recreator(state: CharacterSupervisorSubgraphState):
-    if state.get("characters_strcture_has_answer") != True:
-        user_input = state.get("state_user_input", "")
-        structured_openai_llm = openai_llm.with_structured_output(CharactersStructuredInfo, method="json_mode")
-        character_description_recreator_template = PromptTemplate.from_template("""
-        You are a very talented writer working on a writing.
-
-            Context:
-                - Writing Information: {story_info}
-                - Characters Information: {character_structured_info}
-                - User Input: {user_input}
-
-            Task:
-                - Rewrite the Characters Information based on the requirements from the user input. Keep the exact same structure.
-
-
-            Response Requirements:
-                - The Characters Information should be rewritten based on the user input requirements.
-                - For keeping the characters information structure, OTHER that those required to be changed, use the writing information and characters information.
-            Respond in JSON.
-                """)
-        chain = character_description_recreator_template | structured_openai_llm
-        response = chain.invoke({"story_info": state["story_info"], 
-                                "character_structured_info": state["character_structured_info"],
-                                 "user_input": user_input}
-                                 )
-        state['temp_messages'].append(AIMessage(content=str(response)))
-        time.sleep(2)
-        raise NodeInterrupt(
-                f"Character strcture writer interrupt.")
-    user_input = state.get("temp_messages")[-1].content
-    response = eval(state.get("temp_messages")[-2].content)
-    if (user_input == "") or (user_input == "FINISH"):
-        return {"temp_messages": [AIMessage(content=str(response))],
-                "character_structured_info": response, 
-                "state_user_input": user_input, 
-                "characters_strcture_has_answer": False,
-                "characters_changed": False}
-    return {"temp_messages": [AIMessage(content=str(response))],
-            "state_user_input": user_input,
-            "character_structured_info": response,
-            "characters_strcture_has_answer": False,
-            "characters_changed": True}
+CHARACTER_DESCRIPTION_CREATOR_TEMPLATE = PromptTemplate.from_template("""
+    You are a very talented writer.
+    Taking into consideration the information provided by the user about the writing, from <{story_info}> and the list of characters from <{characters_info}>
+    please describe each character following the structure <{character_info_structure}> for each character in the provided list of characters.
+    In the descriptions, include only values, without types.
+    If there are no characters in the list of characters - return an empty list.
+    The attributes and traits for each character should be taken from the list of characters when the needed information is there, 
+    otherwise, infer them based on the information provided by the user about the writing.
+    Respond in JSON.
+    """)
+chain_registry.register("character_description_creator", lambda: CHARACTER_DESCRIPTION_CREATOR_TEMPLATE | chain_registry.route("structured", lambda llm: llm.with_structured_output(CharactersStructuredInfo, method="json_mode"), role="json"))
+
+def character_description_creator_request(state: CharacterSupervisorSubgraphState):
+    chain = chain_registry.get("character_description_creator")
+    return chain, {"story_info": state["story_info"],
+                   "characters_info": state["characters_info"],
+                   "character_info_structure": state["character_description_structure"]}
+
+SINGLE_CHARACTER_DESCRIPTION_TEMPLATE = PromptTemplate.from_template("""
+    You are a very talented writer.
+    Taking into consideration the information provided by the user about the writing, from <{story_info}> and the character <{name}>: <{character}>
+    please describe the character following the structure <{character_info_structure}>.
+    In the description, include only values, without types.
+    The attributes and traits of the character should be taken from the character information when the needed information is there, 
+    otherwise, infer them based on the information provided by the user about the writing.
+    Respond in JSON with the description of this character only.
+    """)
+chain_registry.register("single_character_description", lambda: SINGLE_CHARACTER_DESCRIPTION_TEMPLATE | chain_registry.route("structured", lambda llm: llm.with_structured_output(CharacterDescription, method="json_mode"), role="json"))
+
+def single_character_description_request(state: CharacterSupervisorSubgraphState, name, character):
+    chain = chain_registry.get("single_character_description")
+    return chain, {"story_info": state["story_info"],
+                   "name": name,
+                   "character": character,
+                   "character_info_structure": state["character_description_structure"]}
+
+def characters_to_describe(state: CharacterSupervisorSubgraphState):
+    """The characters described one by one, None when the whole cast is described in one call."""
+    if not CHARACTER_FAN_OUT:
+        return None
+    return split_characters(state.get("characters_list")) or None
+
+def describe_all_characters(state: CharacterSupervisorSubgraphState):
+    characters = characters_to_describe(state)
+    if characters is None:
+        chain, prompt_values = character_description_creator_request(state)
+        return chain.invoke(prompt_values)
+
+    def describe(name, character):
+        chain, prompt_values = single_character_description_request(state, name, character)
+        return chain.invoke(prompt_values)
+    return describe_characters(characters, describe)
+
+async def adescribe_all_characters(state: CharacterSupervisorSubgraphState):
+    characters = characters_to_describe(state)
+    if characters is None:
+        chain, prompt_values = character_description_creator_request(state)
+        return await chain.ainvoke(prompt_values)
+
+    async def adescribe(name, character):
+        chain, prompt_values = single_character_description_request(state, name, character)
+        return await chain.ainvoke(prompt_values)
+    return await adescribe_characters(characters, adescribe)
+
+def character_description_creator(state: CharacterSupervisorSubgraphState):
+    response = validate_structured_output(describe_all_characters(state), "character_description_creator")
+    return characters_draft(response)
+
+async def character_description_creator_async(state: CharacterSupervisorSubgraphState):
+    response = validate_structured_output(await adescribe_all_characters(state), "character_description_creator")
+    return characters_draft(response)
+
+CHARACTER_DESCRIPTION_RECREATOR_TEMPLATE = PromptTemplate.from_template("""
+    You are a very talented writer working on a writing.
+
+        Context:
+            - Writing Information: {story_info}
+            - Characters Information: {character_structured_info}
+            - User Input: {user_input}
+
+        Task:
+            - Rewrite the Characters Information based on the requirements from the user input. Keep the exact same structure.
+
+
+        Response Requirements:
+            - The Characters Information should be rewritten based on the user input requirements.
+            - For keeping the characters information structure, OTHER that those required to be changed, use the writing information and characters information.
+        Respond in JSON.
+            """)
+chain_registry.register("character_description_recreator", lambda: CHARACTER_DESCRIPTION_RECREATOR_TEMPLATE | chain_registry.route("structured", lambda llm: llm.with_structured_output(CharactersStructuredInfo, method="json_mode"), role="json"))
+
+def character_description_recreator_request(state: CharacterSupervisorSubgraphState):
+    user_input = state.get("state_user_input", "")
+    chain = chain_registry.get("character_description_recreator")
+    return chain, {"story_info": state["story_info"],
+                   "character_structured_info": state["character_structured_info"],
+                   "user_input": user_input}
 
+def character_description_recreator(state: CharacterSupervisorSubgraphState):
+    chain, prompt_values = character_description_recreator_request(state)
+    response = validate_structured_output(chain.invoke(prompt_values), "character_description_recreator")
+    return characters_draft(response)
 
+async def character_description_recreator_async(state: CharacterSupervisorSubgraphState):
+    chain, prompt_values = character_description_recreator_request(state)
+    response = validate_structured_output(await chain.ainvoke(prompt_values), "character_description_recreator")
+    return characters_draft(response)
 
 def chatbot_router4(
     state: CharacterSupervisorSubgraphState,
@@ -566,30 +832,26 @@ def chatbot_router4(
     
 
 character_supervisor_subgraph_builder = StateGraph(CharacterSupervisorSubgraphState)
-character_supervisor_subgraph_builder.add_node("character_structure_creator", character_structure_creator)
-character_supervisor_subgraph_builder.add_node("caracter_extractor", caracter_extractor)
-character_supervisor_subgraph_builder.add_node("character_description_creator", character_description_creator)
-character_supervisor_subgraph_builder.add_node("character_description_recreator", character_description_recreator)
+character_supervisor_subgraph_builder.add_node("character_structure_creator", sync_async_node(character_structure_creator, character_structure_creator_async))
+character_supervisor_subgraph_builder.add_node("caracter_extractor", sync_async_node(caracter_extractor, caracter_extractor_async))
+character_supervisor_subgraph_builder.add_node("character_description_creator", sync_async_node(character_description_creator, character_description_creator_async))
+character_supervisor_subgraph_builder.add_node("character_description_recreator", sync_async_node(character_description_recreator, character_description_recreator_async))
+character_supervisor_subgraph_builder.add_node("characters_answer", characters_answer)
 
 character_supervisor_subgraph_builder.add_edge(START, "character_structure_creator")
 character_supervisor_subgraph_builder.add_edge("character_structure_creator", "caracter_extractor")
 character_supervisor_subgraph_builder.add_edge("caracter_extractor", "character_description_creator")
+# every draft is stored, then the user answers it
+character_supervisor_subgraph_builder.add_edge("character_description_creator", "characters_answer")
+character_supervisor_subgraph_builder.add_edge("character_description_recreator", "characters_answer")
 
 
 character_supervisor_subgraph_builder.add_conditional_edges(
-    "character_description_creator",
+    "characters_answer",
     chatbot_router4,
     {"character_description_recreator": "character_description_recreator", "END": END},
 )
 
-character_supervisor_subgraph_builder.add_conditional_edges(
-    "character_description_recreator",
-    chatbot_router4,
-    {"character_description_recreator": "character_description_recreator", "END": END},
-)
-
-#Finalizes the state graph, creating a compiled workflow
-character_supervisor_subgraph= character_supervisor_subgraph_builder.compile(checkpointer=memory)
 
 # STORY STRUCTURE CREATOR SUBGRAPH
 
@@ -605,105 +867,113 @@ class StoryStructureCreatorState(TypedDict):
 class StoryStructure(TypedDict):
     story_structure : Annotated[dict, "Writing Structure"]
 
-def story_structure_creator(state: StoryStructureCreatorState):
+def story_structure_draft(response):
+    """The state update of a story structure draft: the JSON shown in the chat and the validated structure."""
+    return {"temp_messages": [structured_message(response, id=str(uuid4()))],
+            "story_structured_info": response}
+
+def story_structure_answer(state: StoryStructureCreatorState):
+    """Wait for the user answer to the story structure draft, then handle it."""
     if state.get("story_structure_has_answer") != True:
-        structured_openai_llm = openai_llm.with_structured_output(StoryStructure, method="json_mode")
-        story_structure_creator_template = PromptTemplate.from_template("""
-        You are a very talented writer.
-        Taking into consideration the information provided by the user about the writing, from <{story_info}> and the characters information from <{character_structured_info}>
-        please create a structure for the writing. The structure should contain the units of the writing, the type of units depending on the type of writing.
-        For each unit provide a title/name.
-        The structure should be in accordance with the type of the writing and the information about it, 
-        the titles/names and the units length should be in accordance with the writing type, characters information and the writing information.
-        If the writing type cannot be inferred from the information provided by the user, use a generic structure.
-        Respond in JSON. 
-       
-           Guideline examples:
-            1. Novels: Chapters
-            2. Short Stories: Sections
-            3. Poems: Stanzas
-            4. Screenplays: Scenes in 3-act structure
-
-            Respond in JSON:
-            {{
-                "units": [
-                    {{
-                        "unit_type": "Chapter/Section/Stanza/Scene/etc.",
-                        "unit_name": "Unique Unit Name",
-                        "unit_length": "in paragraphs",
-                        "unit_summary": "short summary about what could be written in the unit"                
-                    }}
-                ]
-            }}
-                """)
-        
-        chain = story_structure_creator_template | structured_openai_llm
-        response = chain.invoke({"story_info": state["story_info"], 
-                                 "character_structured_info": state["character_structured_info"]}
-                                 )
-        state['temp_messages'].append(AIMessage(content=str(response)))
-        time.sleep(2)
         raise NodeInterrupt(
                 f"Story structure writer interrupt.")
     user_input = state.get("temp_messages")[-1].content
-    response = eval(state.get("temp_messages")[-2].content)
+    # the draft node stored the validated structure, the message is only the chat view
+    response = state.get("story_structured_info") or structured_output(state.get("temp_messages")[-2])
+    if response is None:
+        raise ValueError("the answered message is not a story structure draft")
     if (user_input == "") or (user_input == "FINISH"):
-        return {"temp_messages": [AIMessage(content=str(response))],
-                "story_structured_info": response, 
+        return {"temp_messages": [structured_message(response)],
                 "state_user_input": user_input, 
                 "story_structure_has_answer": False,
                 "story_structure_changed": False}
-    return {"temp_messages": [AIMessage(content=str(response))],
+    return {"temp_messages": [structured_message(response)],
             "state_user_input": user_input,
-            "story_structured_info": response,
             "story_structure_has_answer": False,
             "story_structure_changed": True}
 
+STORY_STRUCTURE_CREATOR_TEMPLATE = PromptTemplate.from_template("""
+    You are a very talented writer.
+    Taking into consideration the information provided by the user about the writing, from <{story_info}> and the characters information from <{character_structured_info}>
+    please create a structure for the writing. The structure should contain the units of the writing, the type of units depending on the type of writing.
+    For each unit provide a title/name.
+    The structure should be in accordance with the type of the writing and the information about it, 
+    the titles/names and the units length should be in accordance with the writing type, characters information and the writing information.
+    If the writing type cannot be inferred from the information provided by the user, use a generic structure.
+    Respond in JSON. 
+   
+       Guideline examples:
+        1. Novels: Chapters
+        2. Short Stories: Sections
+        3. Poems: Stanzas
+        4. Screenplays: Scenes in 3-act structure
+
+        Respond in JSON:
+        {{
+            "units": [
+                {{
+                    "unit_type": "Chapter/Section/Stanza/Scene/etc.",
+                    "unit_name": "Unique Unit Name",
+                    "unit_length": "in paragraphs",
+                    "unit_summary": "short summary about what could be written in the unit"                
+                }}
+            ]
+        }}
+            """)
+chain_registry.register("story_structure_creator", lambda: STORY_STRUCTURE_CREATOR_TEMPLATE | chain_registry.route("structured", lambda llm: llm.with_structured_output(StoryStructure, method="json_mode"), role="json"))
+
+def story_structure_creator_request(state: StoryStructureCreatorState):
+    chain = chain_registry.get("story_structure_creator")
+    return chain, {"story_info": state["story_info"],
+                   "character_structured_info": state["character_structured_info"]}
+
+def story_structure_creator(state: StoryStructureCreatorState):
+    chain, prompt_values = story_structure_creator_request(state)
+    response = validate_structured_output(chain.invoke(prompt_values), "story_structure_creator")
+    return story_structure_draft(response)
+
+async def story_structure_creator_async(state: StoryStructureCreatorState):
+    chain, prompt_values = story_structure_creator_request(state)
+    response = validate_structured_output(await chain.ainvoke(prompt_values), "story_structure_creator")
+    return story_structure_draft(response)
+
+STORY_STRUCTURE_RECREATOR_TEMPLATE = PromptTemplate.from_template("""
+    You are a very talented writer working on a writing.
+
+        Context:
+            - Writing Information: {story_info}
+            - Characters Information: {character_structured_info}
+            - Story Structure: {story_structured_info}
+            - User Input: {user_input}
+
+        Task:
+            - Rewrite the Story Structure based on the requirements from the user input. Keep the exact same structure.
+
+
+        Response Requirements:
+            - The Story Structure should be rewritten based on the user input requirements.
+            - For keeping the Story Structure, OTHER that those required to be changed, use the writing information and characters information.
+        Respond in JSON.
+            """)
+chain_registry.register("story_structure_recreator", lambda: STORY_STRUCTURE_RECREATOR_TEMPLATE | chain_registry.route("structured", lambda llm: llm.with_structured_output(StoryStructure, method="json_mode"), role="json"))
+
+def story_structure_recreator_request(state: StoryStructureCreatorState):
+    user_input = state.get("state_user_input", "")
+    chain = chain_registry.get("story_structure_recreator")
+    return chain, {"story_info": state["story_info"],
+                   "character_structured_info": state["character_structured_info"],
+                   "story_structured_info": state["story_structured_info"],
+                   "user_input": user_input}
+
 def story_structure_recreator(state: StoryStructureCreatorState):
-    if state.get("story_structure_has_answer") != True:
-        user_input = state.get("state_user_input", "")
-        structured_openai_llm = openai_llm.with_structured_output(StoryStructure, method="json_mode")
-        story_structure_recreator_template = PromptTemplate.from_template("""
-        You are a very talented writer working on a writing.
-
-            Context:
-                - Writing Information: {story_info}
-                - Characters Information: {character_structured_info}
-                - Story Structure: {story_structured_info}
-                - User Input: {user_input}
-
-            Task:
-                - Rewrite the Story Structure based on the requirements from the user input. Keep the exact same structure.
-
-
-            Response Requirements:
-                - The Story Structure should be rewritten based on the user input requirements.
-                - For keeping the Story Structure, OTHER that those required to be changed, use the writing information and characters information.
-            Respond in JSON.
-                """)
-        chain = story_structure_recreator_template | structured_openai_llm
-        response = chain.invoke({"story_info": state["story_info"], 
-                                "character_structured_info": state["character_structured_info"],
-                                "story_structured_info": state["story_structured_info"],
-                                 "user_input": user_input}
-                                 )
-        state['temp_messages'].append(AIMessage(content=str(response)))
-        time.sleep(2)
-        raise NodeInterrupt(
-                f"Story structure rewriter interrupt.")
-    user_input = state.get("temp_messages")[-1].content
-    response = eval(state.get("temp_messages")[-2].content)
-    if (user_input == "") or (user_input == "FINISH"):
-        return {"temp_messages": [AIMessage(content=str(response))],
-                "story_structured_info": response, 
-                "state_user_input": user_input, 
-                "story_structure_has_answer": False,
-                "story_structure_changed": False}
-    return {"temp_messages": [AIMessage(content=str(response))],
-            "state_user_input": user_input,
-            "story_structured_info": response,
-            "story_structure_has_answer": False,
-            "story_structure_changed": True}
+    chain, prompt_values = story_structure_recreator_request(state)
+    response = validate_structured_output(chain.invoke(prompt_values), "story_structure_recreator")
+    return story_structure_draft(response)
+
+async def story_structure_recreator_async(state: StoryStructureCreatorState):
+    chain, prompt_values = story_structure_recreator_request(state)
+    response = validate_structured_output(await chain.ainvoke(prompt_values), "story_structure_recreator")
+    return story_structure_draft(response)
 
 def chatbot_router5(
     state: StoryStructureCreatorState,
@@ -719,26 +989,22 @@ def chatbot_router5(
         return "story_structure_recreator"
     
 story_structure_creator_subgraph_builder = StateGraph(StoryStructureCreatorState)
-story_structure_creator_subgraph_builder.add_node("story_structure_creator", story_structure_creator)
-story_structure_creator_subgraph_builder.add_node("story_structure_recreator", story_structure_recreator)
+story_structure_creator_subgraph_builder.add_node("story_structure_creator", sync_async_node(story_structure_creator, story_structure_creator_async))
+story_structure_creator_subgraph_builder.add_node("story_structure_recreator", sync_async_node(story_structure_recreator, story_structure_recreator_async))
+story_structure_creator_subgraph_builder.add_node("story_structure_answer", story_structure_answer)
 story_structure_creator_subgraph_builder.add_edge(START, "story_structure_creator")
+# every draft is stored, then the user answers it
+story_structure_creator_subgraph_builder.add_edge("story_structure_creator", "story_structure_answer")
+story_structure_creator_subgraph_builder.add_edge("story_structure_recreator", "story_structure_answer")
 
 
 story_structure_creator_subgraph_builder.add_conditional_edges(
-    "story_structure_creator",
+    "story_structure_answer",
     chatbot_router5,
     {"story_structure_recreator": "story_structure_recreator", "END": END},
 )
 
 
-story_structure_creator_subgraph_builder.add_conditional_edges(
-    "story_structure_recreator",
-    chatbot_router5,
-    {"story_structure_recreator": "story_structure_recreator", "END": END},
-)
-
-story_structure_creator_subgraph = story_structure_creator_subgraph_builder.compile(checkpointer=memory)
-
 # MAIN GRAPH
 
 class MainGraphState(TypedDict):
@@ -747,10 +1013,14 @@ class MainGraphState(TypedDict):
     character_structured_info: dict
     story_structured_info: dict
     story_content: list
+    story_summary: str
+    # text of the finished units, only for the threads started before the manuscript store
     full_story: Annotated[list, add_messages]
     actual_unit: list
+    unit_number: int
     unit_length: str
     characters_changed: bool
+    saved_file: str
 
 
 
@@ -767,28 +1037,58 @@ def save_text_to_file(text: str, filename: str) -> None:
 
 tools = [save_text_to_file]
 
-def story_saver(state: MainGraphState):
-    human_messages = [msg.content for msg in state.get("full_story", [])]
-    text_to_save = "\n".join(human_messages)
-    story_saver_template = PromptTemplate.from_template("""
+STORY_SAVER_TEMPLATE = PromptTemplate.from_template("""
     You are a very talented assistant.
     Please give me a name for the file where I will save the writing with the structure <{story_structured_info}>.
     The name should also be the title of the writing. Add the extension .txt at the end of the name.
     Respond in plain text, ONLY the name.                                                       
     """)
-    chain = story_saver_template | gemini_llm
-    response = chain.invoke({"story_structured_info": state["story_structured_info"]})
+chain_registry.register("story_saver", lambda: STORY_SAVER_TEMPLATE | chain_registry.route("filename", lambda llm: cached_llm(llm, "filename"), role="filename"))
+
+def story_saver_request(state: MainGraphState):
+    chain = chain_registry.get("story_saver")
+    return chain, {"story_structured_info": state["story_structured_info"]}
+
+def unique_path(directory, filename):
+    """
+    Path of <filename> in <directory> that does not overwrite an existing writing
+    (e.g. "Title (2).txt" when "Title.txt" exists).
+    """
+    filename = os.path.basename(filename.strip().strip('"').strip("'")) or "writing.txt"
+    stem, extension = os.path.splitext(filename)
+    path = os.path.join(directory, filename)
+    number = 2
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{stem} ({number}){extension}")
+        number += 1
+    return path
+
+def story_saver_result(state: MainGraphState, response, config):
+    # a run can save its writing in its own directory (e.g. the batch runner)
+    output_dir = (config.get("configurable") or {}).get("output_dir") or OUTPUT_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    filename = unique_path(output_dir, str(response.content))
+    if state.get("unit_number"):
+        # the units were appended to the manuscript while they were written
+        thread_manuscript(config).export(filename)
+        return {"messages": AIMessage(content="The writing was saved successfully!"), "saved_file": filename}
+    human_messages = [msg.content for msg in state.get("full_story", [])]
+    text_to_save = "\n".join(human_messages)
     tools[0].run(tool_input={
          "text": text_to_save, 
-         "filename": str(response.content).strip()
+         "filename": filename
      })
-    return {"messages": AIMessage(content="The writing was saved successfully!")}
+    return {"messages": AIMessage(content="The writing was saved successfully!"), "saved_file": filename}
 
-def structure_supervisor(state: MainGraphState):
-    actual_unit = state.get("actual_unit", [])
-    full_story_add = []
-    story_content_add = []
-    next_title_template = PromptTemplate.from_template("""
+def story_saver(state: MainGraphState, config):
+    chain, prompt_values = story_saver_request(state)
+    return story_saver_result(state, chain.invoke(prompt_values), config)
+
+async def story_saver_async(state: MainGraphState, config):
+    chain, prompt_values = story_saver_request(state)
+    return story_saver_result(state, await chain.ainvoke(prompt_values), config)
+
+NEXT_TITLE_TEMPLATE = PromptTemplate.from_template("""
     You are a precise title selection assistant.
 
         Provided title: <{title_last_paragraph}>     
@@ -811,30 +1111,74 @@ def structure_supervisor(state: MainGraphState):
         DO NOT invent titles or provide titles that are before the Provided title in the Story Structure! Follow the Rules and Required checks!
         Respond only with the Selected title or with FINISH in plain text. 
     """)
-    unit_length_template = PromptTemplate.from_template("""
+UNIT_LENGTH_TEMPLATE = PromptTemplate.from_template("""
     You are a very precise assistant.
     Please provide unit_length for the unit with the unit_name <{unit_name}> from the Story Structured Info <{story_structured_info}>. 
     If there is no unit_name or the unit_name is FINISH -> respond with 0.
     The unit_length should be a integer number. Respond in plain text.
     """)
-    next_title_chain = next_title_template | openai_strict_llm
-    unit_length_chain = unit_length_template | openai_llm
-    if isinstance(actual_unit, list) and len(actual_unit) > 0:
-        # summarize
-        chapter_summarization_template = PromptTemplate.from_template("""
-        You are a very talented writer.
-        Please summarize the writing <{actual_unit}> in a few sentences (4 to 6). 
-        Keep it clean and concise, but do not loose the main ideas from the writing. Keep the same language as the writting.
-        Respond in plain text with the structure (in language of the writing): "Previous unit: summary of the writing"
-        """)
-        summarization_chain = chapter_summarization_template | openai_llm
-        summarization_response = summarization_chain.invoke({"actual_unit": actual_unit})
-        actual_summary = summarization_response.content
+CHAPTER_SUMMARIZATION_TEMPLATE = PromptTemplate.from_template("""
+    You are a very talented writer.
+    Please summarize the writing <{actual_unit}> in a few sentences (4 to 6). 
+    Keep it clean and concise, but do not loose the main ideas from the writing. Keep the same language as the writting.
+    Respond in plain text with the structure (in language of the writing): "Previous unit: summary of the writing"
+    """)
+UNIT_SUMMARY_FOLD_TEMPLATE = PromptTemplate.from_template("""
+    You are a very talented writer.
+    Here is the summary of the unit <{unit_name}> so far: <{unit_summary}>
+    Here is the next paragraph of the unit: <{paragraph}>
+    Please update the summary so it also covers the next paragraph, in a few sentences (4 to 6).
+    Keep it clean and concise, but do not loose the main ideas from the writing. Keep the same language as the writting.
+    Respond in plain text with the structure (in language of the writing): "Previous unit: summary of the writing"
+    """)
+chain_registry.register("next_title", lambda: NEXT_TITLE_TEMPLATE | chain_registry.route("strict", lambda llm: cached_llm(llm, "next_title"), role="title"))
+chain_registry.register("unit_length", lambda: UNIT_LENGTH_TEMPLATE | chain_registry.route("fast", lambda llm: cached_llm(llm, "unit_length"), role="unit_length"))
+chain_registry.register("chapter_summary", lambda: CHAPTER_SUMMARIZATION_TEMPLATE | chain_registry.route("fast", lambda llm: cached_llm(llm, "chapter_summary"), role="summary"))
+chain_registry.register("unit_summary", lambda: UNIT_SUMMARY_FOLD_TEMPLATE | chain_registry.route("fast", lambda llm: cached_llm(llm, "unit_summary"), role="summary"))
+
+def structure_supervisor_chains():
+    return chain_registry.get("next_title"), chain_registry.get("unit_length"), chain_registry.get("chapter_summary")
+
+def running_summary_key(state: MainGraphState, config):
+    """Thread, unit number and accepted paragraphs of the finished unit, to take its running summary."""
+    return config["configurable"]["thread_id"], state.get("unit_number"), len(state.get("actual_unit", [])) - 1
+
+def chapter_summary_values(actual_unit):
+    """Prompt values of the summarization of the whole unit (units without a running summary)."""
+    record_prompt_tokens("chapter_summary", CHAPTER_SUMMARIZATION_TEMPLATE.format(actual_unit=actual_unit), len(actual_unit) - 1)
+    return {"actual_unit": actual_unit}
+
+def structure_supervisor_result(state: MainGraphState, actual_summary, next_title, unit_length, config):
+    """
+    Close the finished unit (if any) and start the next one.
+
+    The title of the next unit is appended to the manuscript of the thread, its paragraphs
+    are appended by paragraph_answer when they are accepted.
+
+    Args:
+        state (MainGraphState): the main graph state
+        actual_summary (str): summary of the finished unit, None before the first unit
+        next_title (str): title of the next unit or FINISH
+        unit_length (int | str): length of the next unit in paragraphs
+        config (dict): the config of the run, for the thread id
+    """
+    actual_unit = state.get("actual_unit", [])
+    story_summary = state.get("story_summary", "")
+    unit_number = state.get("unit_number")
+    # threads started before the manuscript store keep the text of their units in full_story
+    legacy_thread = unit_number is None and actual_summary is not None
+    full_story_add = []
+    story_content_add = []
+    if actual_summary is not None:
+        # keep a running summary of the whole story for the paragraph writer
+        story_summary = "\n".join(line for line in [story_summary, actual_summary.replace("\n", " ")] if line)
+        if PASSAGE_RETRIEVAL and unit_number:
+            thread_passages(state, config).add(("summary", unit_number), actual_summary.replace("\n", " "))
         last_paragraph = actual_unit[-1].content
-        title_last_paragraph = actual_unit[0].content
-        # add to full story
-        actual_unit_text = [element.content for element in actual_unit] if len(actual_unit) > 0 else ""
-        full_story_add = "\n".join(actual_unit_text) if isinstance(actual_unit_text, list) else actual_unit_text
+        if legacy_thread:
+            # add to full story
+            actual_unit_text = [element.content for element in actual_unit] if len(actual_unit) > 0 else ""
+            full_story_add = "\n".join(actual_unit_text) if isinstance(actual_unit_text, list) else actual_unit_text
         actual_unit = []
         # create story_content_add that will be appended as HummanMessage
         story_content_add.append('-------summary of the previous chapter-------')
@@ -843,23 +1187,65 @@ def structure_supervisor(state: MainGraphState):
         story_content_add.append("--------last paragraph from the previous chapter--------")
         story_content_add.append(last_paragraph)
         story_content_add.append("--------end of the last paragraph--------\n\n")
-        response = next_title_chain.invoke({"title_last_paragraph": title_last_paragraph, "story_structured_info": state["story_structured_info"]})
-    else:
-        response = next_title_chain.invoke({"title_last_paragraph": "no title", "story_structured_info": state["story_structured_info"]})
-    next_title = response.content
-    unit_length_response = unit_length_chain.invoke({"unit_name": next_title, "story_structured_info": state["story_structured_info"]})
-    unit_length = unit_length_response.content    
     story_content_add.append(next_title)
     story_content_add.append("\n")
     text_story_content = '\n'.join(story_content_add)
 
     if next_title == "" or next_title == "FINISH":
-        return {"messages": AIMessage(content="FINISH"), "full_story": full_story_add, "story_content": story_content_add, "unit_length": str(unit_length)}
+        return {"messages": AIMessage(content="FINISH"), "full_story": full_story_add, "story_content": story_content_add, "story_summary": story_summary, "unit_length": str(unit_length)}
 
     actual_unit.append(AIMessage(content=next_title))
     story_content_add = [AIMessage(content=text_story_content)]
-   
-    return {"messages": AIMessage(content=next_title), "actual_unit": actual_unit, "full_story": full_story_add, "story_content": story_content_add, "unit_length": str(unit_length)}
+    result = {"messages": AIMessage(content=next_title), "actual_unit": actual_unit, "full_story": full_story_add, "story_content": story_content_add, "story_summary": story_summary, "unit_length": str(unit_length)}
+    if not legacy_thread:
+        unit_number = (unit_number or 0) + 1
+        thread_manuscript(config).append(unit_number, 0, next_title)
+        result["unit_number"] = unit_number
+    return result
+
+def structure_supervisor(state: MainGraphState, config):
+    next_title_chain, unit_length_chain, summarization_chain = structure_supervisor_chains()
+    # the next unit and its length are read from the structure, the LLM is used only for malformed structures
+    structure_index = get_structure_index(state["story_structured_info"])
+    actual_unit = state.get("actual_unit", [])
+    actual_summary = None
+    title_last_paragraph = "no title"
+    if isinstance(actual_unit, list) and len(actual_unit) > 0:
+        # the running summary was folded while the unit was written, the whole unit is summarized only without it
+        actual_summary = running_summaries.take(*running_summary_key(state, config)) if RUNNING_SUMMARY else None
+        if actual_summary is None:
+            actual_summary = summarization_chain.invoke(chapter_summary_values(actual_unit)).content
+        title_last_paragraph = actual_unit[0].content
+    next_title = structure_index.next_unit(title_last_paragraph) if structure_index.valid else None
+    if next_title is None:
+        response = next_title_chain.invoke({"title_last_paragraph": title_last_paragraph, "story_structured_info": state["story_structured_info"]})
+        next_title = response.content
+    unit_length = structure_index.unit_length(next_title) if structure_index.valid else None
+    if unit_length is None:
+        unit_length_response = unit_length_chain.invoke({"unit_name": next_title, "story_structured_info": state["story_structured_info"]})
+        unit_length = unit_length_response.content
+    return structure_supervisor_result(state, actual_summary, next_title, unit_length, config)
+
+async def structure_supervisor_async(state: MainGraphState, config):
+    next_title_chain, unit_length_chain, summarization_chain = structure_supervisor_chains()
+    structure_index = get_structure_index(state["story_structured_info"])
+    actual_unit = state.get("actual_unit", [])
+    actual_summary = None
+    title_last_paragraph = "no title"
+    if isinstance(actual_unit, list) and len(actual_unit) > 0:
+        actual_summary = await running_summaries.atake(*running_summary_key(state, config)) if RUNNING_SUMMARY else None
+        if actual_summary is None:
+            actual_summary = (await summarization_chain.ainvoke(chapter_summary_values(actual_unit))).content
+        title_last_paragraph = actual_unit[0].content
+    next_title = structure_index.next_unit(title_last_paragraph) if structure_index.valid else None
+    if next_title is None:
+        response = await next_title_chain.ainvoke({"title_last_paragraph": title_last_paragraph, "story_structured_info": state["story_structured_info"]})
+        next_title = response.content
+    unit_length = structure_index.unit_length(next_title) if structure_index.valid else None
+    if unit_length is None:
+        unit_length_response = await unit_length_chain.ainvoke({"unit_name": next_title, "story_structured_info": state["story_structured_info"]})
+        unit_length = unit_length_response.content
+    return structure_supervisor_result(state, actual_summary, next_title, unit_length, config)
 
 def tools_router1(state: MainGraphState):
     if isinstance(state, list):
@@ -885,30 +1271,67 @@ def chatbot_router6(
         return "story_saver"
     return "story_writer"
 
-graph_builder = StateGraph(MainGraphState)
-graph_builder.add_node("info_gatherer", inf_gatherer_subgraph)
-graph_builder.add_node("character_supervisor", character_supervisor_subgraph)
-graph_builder.add_node("story_structure_creator", story_structure_creator_subgraph)
-graph_builder.add_node("story_writer", story_writer_subgraph)
-graph_builder.add_node("structure_supervisor", structure_supervisor) 
-graph_builder.add_node("story_saver", story_saver)
-tool_node = ToolNode(tools=tools)
-graph_builder.add_node("tools", tool_node)
-graph_builder.add_edge(START, "info_gatherer")
-graph_builder.add_edge("info_gatherer", "character_supervisor")
-graph_builder.add_edge("character_supervisor", "story_structure_creator")
-graph_builder.add_edge("story_structure_creator", "structure_supervisor")
-graph_builder.add_edge("story_writer", "structure_supervisor")
-graph_builder.add_conditional_edges(
-    "story_saver",
-    tools_router1,
-    {"tools": "tools", "END": END},
-)
-graph_builder.add_conditional_edges(
-    "structure_supervisor",
-    chatbot_router6,
-    {"story_writer": "story_writer", "story_saver": "story_saver"},
-)
-graph_builder.add_edge("tools", END)
+def build_graph(checkpointer):
+    """Compile the subgraphs and the main graph with the checkpointer."""
+    graph_builder = StateGraph(MainGraphState)
+    graph_builder.add_node("info_gatherer", inf_gatherer_subgraph_builder.compile(checkpointer=checkpointer))
+    graph_builder.add_node("character_supervisor", character_supervisor_subgraph_builder.compile(checkpointer=checkpointer))
+    graph_builder.add_node("story_structure_creator", story_structure_creator_subgraph_builder.compile(checkpointer=checkpointer))
+    graph_builder.add_node("story_writer", story_writer_subgraph_builder.compile(checkpointer=checkpointer))
+    graph_builder.add_node("structure_supervisor", sync_async_node(structure_supervisor, structure_supervisor_async)) 
+    graph_builder.add_node("story_saver", sync_async_node(story_saver, story_saver_async))
+    tool_node = ToolNode(tools=tools)
+    graph_builder.add_node("tools", tool_node)
+    graph_builder.add_edge(START, "info_gatherer")
+    graph_builder.add_edge("info_gatherer", "character_supervisor")
+    graph_builder.add_edge("character_supervisor", "story_structure_creator")
+    graph_builder.add_edge("story_structure_creator", "structure_supervisor")
+    graph_builder.add_edge("story_writer", "structure_supervisor")
+    graph_builder.add_conditional_edges(
+        "story_saver",
+        tools_router1,
+        {"tools": "tools", "END": END},
+    )
+    graph_builder.add_conditional_edges(
+        "structure_supervisor",
+        chatbot_router6,
+        {"story_writer": "story_writer", "story_saver": "story_saver"},
+    )
+    graph_builder.add_edge("tools", END)
+
+    return graph_builder.compile(checkpointer=checkpointer)
+
+
+def get_graph():
+    """The compiled main graph, built on first use."""
+    global _graph
+    if _graph is None:
+        with _lazy_lock:
+            if _graph is None:
+                _graph = build_graph(get_checkpointer())
+    return _graph
+
+def warm_up(open_connections=WARM_UP_CONNECTIONS):
+    """
+    Prepare everything the first request needs: open the checkpointer, create the LLM
+    clients, build the chains, compile the graphs and (optionally) open the connections
+    to the model providers.
 
-graph = graph_builder.compile(checkpointer=memory)
\ No newline at end of file
+    Returns:
+        dict: seconds spent in every step
+    """
+    steps = {}
+    start = time.perf_counter()
+    get_checkpointer()
+    steps["checkpointer"] = time.perf_counter() - start
+    start = time.perf_counter()
+    chain_registry.build_all()
+    steps["chains"] = time.perf_counter() - start
+    start = time.perf_counter()
+    get_graph()
+    steps["graph"] = time.perf_counter() - start
+    if open_connections:
+        start = time.perf_counter()
+        chain_registry.open_connections()
+        steps["connections"] = time.perf_counter() - start
+    return steps
@@ -0,0 +1,296 @@
+"""
+Queue of story jobs, written by a pool of workers.
+
+The jobs are kept in a SQLite file (INKREALLM_JOB_DB), so the queue survives the process.
+A job is a brief (see batch_runner.py) with a priority: the workers take the queued job
+with the highest priority, then the oldest one, and write it with batch_runner.write_story.
+The answers given to a job are saved after every turn, so a job that was running when
+the process stopped is queued again and goes on from its last checkpoint. A failed job is
+retried from its checkpoint up to INKREALLM_JOB_ATTEMPTS times.
+
+The LLM calls of all the jobs go through the provider gates (rate_limiter.ProviderGate):
+a cap on the calls in flight and on the tokens per minute of every provider, shared
+fairly between the running jobs and by priority.
+
+Run from the repository root:
+    python job_scheduler.py add briefs/ [--priority 5]
+    python job_scheduler.py run [--workers 4] [--output-dir manuscripts] [--watch]
+    python job_scheduler.py stats
+"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import logging
+import threading
+from uuid import uuid4
+import graphs
+from background_loop import run_async
+from batch_runner import BATCH_WORKERS, BriefAuthor, load_briefs, write_story
+from model_router import percentile
+from rate_limiter import provider_gate_stats
+
+logger = logging.getLogger(__name__)
+
+JOB_DB = os.getenv("INKREALLM_JOB_DB", "jobs.sqlite")
+# runs of a job before it is marked as failed
+JOB_ATTEMPTS = int(os.getenv("INKREALLM_JOB_ATTEMPTS", 3))
+# seconds between two looks at an empty queue (run --watch)
+JOB_POLL_SECONDS = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    brief TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    thread_id TEXT NOT NULL,
+    progress TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued REAL NOT NULL,
+    queued_since REAL NOT NULL,
+    wait_seconds REAL NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, id);
+"""
+
+JOB_COLUMNS = ["id", "name", "brief", "priority", "status", "thread_id", "progress", "attempts",
+               "enqueued", "queued_since", "wait_seconds", "started", "finished", "result"]
+
+
+class JobQueue:
+    """
+    Story jobs kept in a SQLite file.
+
+    A job is queued, then running, then done or failed. The time a job spends queued
+    (before every run) is summed in wait_seconds.
+
+    Args:
+        path (str): the SQLite file, created if it does not exist
+    """
+
+    def __init__(self, path=JOB_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = dict(zip(JOB_COLUMNS, row))
+        job["brief"] = json.loads(job["brief"])
+        job["progress"] = json.loads(job["progress"]) if job["progress"] else None
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def add(self, brief, priority=0):
+        """Queue a brief, return the id of the job."""
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (name, brief, priority, thread_id, enqueued, queued_since) VALUES (?, ?, ?, ?, ?, ?)",
+                (brief["name"], json.dumps(brief), priority, f"job-{brief['name']}-{uuid4().hex[:8]}", now, now))
+            return cursor.lastrowid
+
+    def get(self, job_id):
+        with self.lock:
+            return self._job(self.conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def jobs(self, status=None):
+        """The jobs (with a <status>), in queue order."""
+        query = f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs"
+        params = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            params = (status,)
+        with self.lock:
+            rows = self.conn.execute(query + " ORDER BY priority DESC, id", params).fetchall()
+        return [self._job(row) for row in rows]
+
+    def claim(self):
+        """Mark the next queued job as running and return it, None if the queue is empty."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY priority DESC, id LIMIT 1").fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ?, "
+                        "wait_seconds = wait_seconds + (? - queued_since) WHERE id = ?", (now, now, row[0]))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            return None if row is None else self.get(row[0])
+
+    def save_progress(self, job_id, progress):
+        """Save the answers given so far to a running job."""
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def finish(self, job_id, status, result):
+        """Mark a job as done or failed."""
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = ?, finished = ?, result = ? WHERE id = ?",
+                              (status, time.time(), json.dumps(result), job_id))
+
+    def requeue(self, job_id, result=None):
+        """Queue a job again (it goes on from its checkpoint and its saved answers)."""
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = 'queued', queued_since = ?, result = ? WHERE id = ?",
+                              (time.time(), json.dumps(result) if result else None, job_id))
+
+    def recover(self):
+        """Queue again the jobs left running by a process that stopped, return how many."""
+        with self.lock:
+            return self.conn.execute(
+                "UPDATE jobs SET status = 'queued', queued_since = ? WHERE status = 'running'", (time.time(),)).rowcount
+
+    def stats(self):
+        """Queue depth (by status and by priority) and the time the jobs waited in the queue."""
+        now = time.time()
+        with self.lock:
+            by_status = dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            queued_by_priority = dict(self.conn.execute(
+                "SELECT priority, COUNT(*) FROM jobs WHERE status = 'queued' GROUP BY priority").fetchall())
+            oldest = self.conn.execute("SELECT MIN(queued_since) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            waits = [wait for (wait,) in self.conn.execute(
+                "SELECT wait_seconds FROM jobs WHERE started IS NOT NULL ORDER BY wait_seconds").fetchall()]
+        return {
+            "depth": by_status.get("queued", 0),
+            "by_status": by_status,
+            "queued_by_priority": {str(priority): count for priority, count in sorted(queued_by_priority.items(), reverse=True)},
+            "oldest_queued_s": round(now - oldest, 3) if oldest is not None else None,
+            "wait_s": {
+                "jobs": len(waits),
+                "mean": round(sum(waits) / len(waits), 3) if waits else None,
+                "p50": round(percentile(waits, 0.5), 3) if waits else None,
+                "p95": round(percentile(waits, 0.95), 3) if waits else None,
+                "max": round(waits[-1], 3) if waits else None,
+            },
+        }
+
+
+class JobScheduler:
+    """
+    Writes the jobs of a queue with <workers> workers.
+
+    Args:
+        queue (JobQueue): the queue
+        output_dir (str): directory where the writings are saved
+        workers (int): jobs written at the same time
+        max_attempts (int): runs of a job before it is marked as failed
+        keep_checkpoints (bool): keep the threads of the finished jobs in the checkpointer
+    """
+
+    def __init__(self, queue, output_dir, workers=BATCH_WORKERS, max_attempts=JOB_ATTEMPTS, keep_checkpoints=False):
+        self.queue = queue
+        self.output_dir = output_dir
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.keep_checkpoints = keep_checkpoints
+        self.resumed = 0
+
+    async def run_job(self, job):
+        author = BriefAuthor(job["brief"], job["progress"])
+        if job["progress"]:
+            self.resumed += 1
+        result = await write_story(job["brief"], self.output_dir, self.keep_checkpoints,
+                                   thread_id=job["thread_id"], author=author, priority=job["priority"],
+                                   on_turn=lambda author: self.queue.save_progress(job["id"], author.progress()))
+        result["attempt"] = job["attempts"]
+        if result["status"] == "ok":
+            self.queue.finish(job["id"], "done", result)
+        elif job["attempts"] < self.max_attempts:
+            self.queue.requeue(job["id"], result)
+        else:
+            self.queue.finish(job["id"], "failed", result)
+        logger.info("job %s (%s): %s in %.1f s", job["id"], job["name"], result["status"], result["seconds"])
+        return result
+
+    async def run(self, watch=False):
+        """
+        Write the queued jobs, first queuing again the jobs left running by a stopped process.
+
+        Args:
+            watch (bool): keep waiting for new jobs when the queue is empty
+
+        Returns:
+            dict: the jobs written, the time and the stats of the queue and of the provider gates
+        """
+        recovered = self.queue.recover()
+        if recovered:
+            logger.info("%d jobs left running were queued again", recovered)
+        finished = []
+        start = time.perf_counter()
+
+        async def worker():
+            while True:
+                job = self.queue.claim()
+                if job is None:
+                    if not watch:
+                        return
+                    await asyncio.sleep(JOB_POLL_SECONDS)
+                    continue
+                finished.append(await self.run_job(job))
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        wall_seconds = time.perf_counter() - start
+        done = sum(1 for result in finished if result["status"] == "ok")
+        return {
+            "recovered": recovered,
+            "resumed": self.resumed,
+            "runs": len(finished),
+            "done": done,
+            "wall_seconds": round(wall_seconds, 3),
+            "stories_per_hour": round(done / wall_seconds * 3600, 1) if wall_seconds > 0 else None,
+            "queue": self.queue.stats(),
+            "providers": provider_gate_stats(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--db", default=JOB_DB, help="the SQLite file of the queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="queue the briefs of a JSON file or of a directory")
+    add.add_argument("briefs")
+    add.add_argument("--priority", type=int, default=0, help="the jobs with a higher priority are written first")
+    run = commands.add_parser("run", help="write the queued jobs")
+    run.add_argument("--workers", type=int, default=BATCH_WORKERS, help="jobs written at the same time")
+    run.add_argument("--output-dir", default="manuscripts", help="directory of the saved writings")
+    run.add_argument("--watch", action="store_true", help="wait for new jobs when the queue is empty")
+    run.add_argument("--keep-checkpoints", action="store_true", help="keep the threads of the finished jobs in the checkpointer")
+    commands.add_parser("stats", help="print the queue depth and the wait times")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    queue = JobQueue(args.db)
+    if args.command == "add":
+        job_ids = [queue.add(brief, args.priority) for brief in load_briefs(args.briefs)]
+        print(json.dumps({"queued": job_ids}))
+    elif args.command == "stats":
+        print(json.dumps(queue.stats(), indent=2))
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        graphs.warm_up()
+        scheduler = JobScheduler(queue, args.output_dir, args.workers, keep_checkpoints=args.keep_checkpoints)
+        # on the shared event loop, where the warm-up opened the connections of the async clients
+        print(json.dumps(run_async(scheduler.run(args.watch)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import os
+import time
+import sqlite3
+import hashlib
+import warnings
+import threading
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+# chains whose responses are cached (comma separated, empty -> no cache)
+CACHED_CHAINS = [name.strip() for name in os.getenv(
+    "INKREALLM_LLM_CACHE_CHAINS", "next_title,unit_length,chapter_summary,info_condenser,filename").split(",") if name.strip()]
+LLM_CACHE_DB = os.getenv("INKREALLM_LLM_CACHE_DB", "llm_cache.sqlite")
+# the least recently used responses are evicted above this size
+LLM_CACHE_MAX_MB = float(os.getenv("INKREALLM_LLM_CACHE_MB", 64))
+# responses older than this (in seconds) are not used
+LLM_CACHE_TTL_SECONDS = float(os.getenv("INKREALLM_LLM_CACHE_TTL", 7 * 24 * 60 * 60))
+
+
+class ResponseStore:
+    """
+    LLM responses saved in SQLite, keyed by the hash of the model parameters and the prompt.
+
+    The least recently used responses are deleted when the store grows over <max_bytes>
+    and the responses older than <ttl_seconds> are treated as missing.
+
+    Args:
+        path (str): path of the SQLite file
+        max_bytes (int): maximum size of the stored responses
+        ttl_seconds (float): maximum age of a response
+    """
+
+    def __init__(self, path=LLM_CACHE_DB, max_bytes=int(LLM_CACHE_MAX_MB * 1024 ** 2),
+                 ttl_seconds=LLM_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            chain TEXT NOT NULL,
+            value TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            latency REAL NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode()).hexdigest()
+
+    def get(self, key):
+        """Return (value, latency) of a fresh response, None if it is missing or expired."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, latency, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[2] > self.ttl_seconds:
+                self._delete("key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        return row[0], row[1]
+
+    def put(self, key, chain, value, latency):
+        now = time.time()
+        size = len(value.encode())
+        with self.lock:
+            self._delete("key = ?", (key,))
+            self.conn.execute("INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (key, chain, value, size, latency, now, now))
+            self.bytes += size
+            self.evict(now)
+
+    def _delete(self, where, params):
+        freed = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM responses WHERE {where}", params).fetchone()[0]
+        self.conn.execute(f"DELETE FROM responses WHERE {where}", params)
+        self.bytes -= freed
+
+    def evict(self, now=None):
+        """Delete the expired responses and the least recently used ones above max_bytes."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self._delete("created < ?", (now - self.ttl_seconds,))
+            while self.bytes > self.max_bytes:
+                rows = self.conn.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used LIMIT 64").fetchall()
+                if not rows:
+                    break
+                for key, size in rows:
+                    if self.bytes <= self.max_bytes:
+                        break
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.bytes -= size
+
+    def clear(self, chain=None):
+        with self.lock:
+            if chain is None:
+                self._delete("1", ())
+            else:
+                self._delete("chain = ?", (chain,))
+
+
+class ChainResponseCache(BaseCache):
+    """
+    LangChain cache of one chain (set as the cache of the chain's LLM), backed by a ResponseStore.
+
+    Keeps the hits and misses of the chain and the LLM time saved by the hits
+    (the latency of the call that produced each cached response).
+    """
+
+    def __init__(self, store, chain):
+        self.store = store
+        self.chain = chain
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        # key -> time of the miss, to measure the latency of the LLM call
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, prompt, llm_string):
+        key = ResponseStore.key(prompt, llm_string)
+        row = self.store.get(key)
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                if len(self.pending) > 1000:
+                    # calls that failed after the lookup are never updated
+                    self.pending.clear()
+                self.pending[key] = time.perf_counter()
+                return None
+            self.hits += 1
+            self.saved_seconds += row[1]
+        with warnings.catch_warnings():
+            # langchain_core.load.loads is marked as beta
+            warnings.simplefilter("ignore")
+            return loads(row[0])
+
+    def update(self, prompt, llm_string, return_val):
+        key = ResponseStore.key(prompt, llm_string)
+        with self.lock:
+            started = self.pending.pop(key, None)
+        latency = time.perf_counter() - started if started is not None else 0.0
+        self.store.put(key, self.chain, dumps(return_val), latency)
+
+    def clear(self, **kwargs):
+        self.store.clear(self.chain)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                    "saved_seconds": round(self.saved_seconds, 2)}
+
+
+_store = None
+_caches = {}
+_cached_llms = {}
+_cache_lock = threading.Lock()
+
+def cached_llm(llm, chain):
+    """
+    Return the LLM to use in <chain>: a copy of <llm> that caches its responses when
+    the chain is in CACHED_CHAINS, the LLM itself otherwise.
+
+    Args:
+        llm: the chat model
+        chain (str): name of the chain (e.g. "next_title")
+    """
+    global _store
+    if chain not in CACHED_CHAINS:
+        return llm
+    with _cache_lock:
+        cached = _cached_llms.get((id(llm), chain))
+        if cached is None or cached[0] is not llm:
+            if _store is None:
+                _store = ResponseStore()
+            cache = _caches.setdefault(chain, ChainResponseCache(_store, chain))
+            cached = _cached_llms[(id(llm), chain)] = (llm, llm.model_copy(update={"cache": cache}))
+        return cached[1]
+
+def llm_cache_stats():
+    """Hits, misses and saved LLM time per chain, and the size of the cache."""
+    with _cache_lock:
+        stats = {chain: cache.stats() for chain, cache in _caches.items()}
+        if _store is not None:
+            stats["bytes"] = _store.bytes
+    return stats
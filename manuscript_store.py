@@ -0,0 +1,212 @@
+"""
+Append-only store of the manuscripts written by the graph.
+
+Every thread has a manuscript: a text file where the unit titles and the accepted
+paragraphs are appended as they are committed (one per line block, separated by a
+newline, the same text story_saver used to save) and an index file of fixed-size
+records (unit, paragraph, byte offset, byte length). Paragraph 0 of a unit is its title.
+
+Both files are flushed (and fsynced, INKREALLM_MANUSCRIPT_FSYNC) after every append,
+the text before its index record, so a crash loses at most the entry being written:
+on open, the index is cut to its last whole record and the text to the end of the last
+indexed entry. The index is kept in memory (an array of offsets and lengths per unit),
+so any paragraph is read with one slice of a memory map of the text file.
+"""
+import os
+import re
+import mmap
+import struct
+import threading
+from array import array
+
+# directory of the manuscripts of the threads
+MANUSCRIPT_DIR = os.getenv("INKREALLM_MANUSCRIPT_DIR", "manuscript_store")
+# fsync the manuscript after every append (0 -> only flush, faster but a power loss can cut it)
+MANUSCRIPT_FSYNC = os.getenv("INKREALLM_MANUSCRIPT_FSYNC", "1") == "1"
+
+# index record: unit, paragraph, byte offset, byte length
+INDEX_RECORD = struct.Struct("<IIQI")
+SEPARATOR = b"\n"
+
+
+class Manuscript:
+    """
+    The manuscript of a thread: an append-only text file and its offset index.
+
+    Args:
+        path (str): path of the manuscript without extension (<path>.txt and <path>.idx)
+        fsync (bool): fsync the files after every append
+    """
+
+    def __init__(self, path, fsync=MANUSCRIPT_FSYNC):
+        self.text_path = path + ".txt"
+        self.index_path = path + ".idx"
+        self.fsync = fsync
+        # unit -> array of (offset, length) pairs, one pair per paragraph
+        self.units = {}
+        self.last_unit = 0
+        self.entries = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self._map = None
+        self._recover()
+        self.text_file = open(self.text_path, "ab")
+        self.index_file = open(self.index_path, "ab")
+
+    def _recover(self):
+        """Load the index and cut the files after the last whole entry."""
+        index = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as index_file:
+                index = index_file.read()
+        whole = len(index) - len(index) % INDEX_RECORD.size
+        if whole != len(index):
+            os.truncate(self.index_path, whole)
+        for unit, paragraph, offset, length in INDEX_RECORD.iter_unpack(index[:whole]):
+            self.units.setdefault(unit, array("Q")).extend((offset, length))
+            self.last_unit = unit
+            self.entries += 1
+            self.size = offset + length + len(SEPARATOR)
+        if os.path.exists(self.text_path) and os.path.getsize(self.text_path) > self.size:
+            os.truncate(self.text_path, self.size)
+
+    def _count(self, unit):
+        return len(self.units.get(unit, ())) // 2
+
+    def paragraphs(self, unit):
+        """Number of entries (title included) of <unit>."""
+        with self.lock:
+            return self._count(unit)
+
+    def append(self, unit, paragraph, text):
+        """
+        Append paragraph <paragraph> of <unit> (0 for the title of the unit).
+
+        An entry that is already in the manuscript is skipped, so a node that runs again
+        (e.g. after a crash) does not write it twice.
+
+        Returns:
+            bool: True if the entry was appended
+        """
+        with self.lock:
+            if paragraph < self._count(unit):
+                return False
+            if unit < self.last_unit or paragraph != self._count(unit):
+                raise ValueError(f"cannot append paragraph {paragraph} of unit {unit}: the manuscript is at "
+                                 f"unit {self.last_unit}, paragraph {self._count(self.last_unit) - 1}")
+            data = text.encode("utf-8")
+            self._write(self.text_file, data + SEPARATOR)
+            self._write(self.index_file, INDEX_RECORD.pack(unit, paragraph, self.size, len(data)))
+            self.units.setdefault(unit, array("Q")).extend((self.size, len(data)))
+            self.last_unit = unit
+            self.entries += 1
+            self.size += len(data) + len(SEPARATOR)
+            return True
+
+    def _write(self, file, data):
+        file.write(data)
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+    def _mapped(self, end):
+        """Memory map of the text file covering the first <end> bytes."""
+        if self._map is None or len(self._map) < end:
+            if self._map is not None:
+                self._map.close()
+            with open(self.text_path, "rb") as text_file:
+                self._map = mmap.mmap(text_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def read(self, unit, paragraph):
+        """The text of paragraph <paragraph> of <unit> (0 for the title)."""
+        with self.lock:
+            entries = self.units.get(unit)
+            if entries is None or not 0 <= paragraph < len(entries) // 2:
+                raise KeyError(f"no paragraph {paragraph} in unit {unit}")
+            offset, length = entries[2 * paragraph], entries[2 * paragraph + 1]
+            if length == 0:
+                return ""
+            return self._mapped(offset + length)[offset:offset + length].decode("utf-8")
+
+    def read_unit(self, unit):
+        """The title and the paragraphs of <unit>."""
+        return [self.read(unit, paragraph) for paragraph in range(self.paragraphs(unit))]
+
+    def export(self, path):
+        """
+        Write the manuscript to <path>: the entries separated by newlines.
+
+        Returns:
+            str: the path
+        """
+        with self.lock:
+            size = max(self.size - len(SEPARATOR), 0)
+            with open(path, "wb") as output:
+                if size:
+                    output.write(self._mapped(size)[:size])
+        return path
+
+    def stats(self):
+        with self.lock:
+            return {"units": len(self.units), "entries": self.entries, "text_bytes": self.size,
+                    "index_bytes": self.entries * INDEX_RECORD.size}
+
+    def close(self):
+        with self.lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self.text_file.close()
+            self.index_file.close()
+
+
+class ManuscriptStore:
+    """
+    The manuscripts of the threads, in <directory>, opened on first use.
+
+    Args:
+        directory (str): directory of the manuscript files
+        fsync (bool): fsync the manuscripts after every append
+    """
+
+    def __init__(self, directory=MANUSCRIPT_DIR, fsync=MANUSCRIPT_FSYNC):
+        self.directory = directory
+        self.fsync = fsync
+        self.manuscripts = {}
+        self.lock = threading.Lock()
+
+    def path(self, thread_id):
+        return os.path.join(self.directory, re.sub(r"[^A-Za-z0-9_.-]", "_", thread_id))
+
+    def get(self, thread_id):
+        """The manuscript of <thread_id>, created if it does not exist."""
+        with self.lock:
+            manuscript = self.manuscripts.get(thread_id)
+            if manuscript is None:
+                os.makedirs(self.directory, exist_ok=True)
+                manuscript = self.manuscripts[thread_id] = Manuscript(self.path(thread_id), self.fsync)
+            return manuscript
+
+    def delete(self, thread_id):
+        """Close and delete the manuscript of <thread_id>, if any."""
+        with self.lock:
+            manuscript = self.manuscripts.pop(thread_id, None)
+        if manuscript is not None:
+            manuscript.close()
+        for extension in (".txt", ".idx"):
+            try:
+                os.remove(self.path(thread_id) + extension)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            manuscripts = list(self.manuscripts.values())
+        stats = [manuscript.stats() for manuscript in manuscripts]
+        return {"open_manuscripts": len(stats),
+                "text_bytes": sum(item["text_bytes"] for item in stats),
+                "index_bytes": sum(item["index_bytes"] for item in stats)}
+
+
+manuscript_store = ManuscriptStore()
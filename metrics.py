@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain_core.callbacks import BaseCallbackHandler
+from langgraph.errors import GraphInterrupt
+
+# record the node and LLM metrics (0 -> no callback handler is attached to the graph runs)
+METRICS_ENABLED = os.getenv("INKREALLM_METRICS", "1") == "1"
+# serve the metrics in Prometheus text format on http://localhost:<port>/metrics (0 -> no server)
+METRICS_PORT = int(os.getenv("INKREALLM_METRICS_PORT", 0))
+# USD per million prompt / completion tokens, by model name prefix
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gemini-1.5-pro": (1.25, 5.00),
+}
+MODEL_PRICES.update({model: tuple(prices) for model, prices in json.loads(os.getenv("INKREALLM_MODEL_PRICES", "{}")).items()})
+
+_FIELDS = ("node_runs", "node_seconds", "interrupts", "blocked_seconds",
+           "llm_calls", "llm_errors", "llm_retries", "llm_seconds", "ttft_seconds", "ttft_count",
+           "prompt_tokens", "completion_tokens", "cost_usd")
+
+
+def node_path(metadata):
+    """The node of a run as subgraph/node (e.g. story_writer/next_paragraph_writer)."""
+    namespace = metadata.get("langgraph_checkpoint_ns") or metadata.get("langgraph_node", "")
+    return "/".join(part.split(":")[0] for part in namespace.split("|"))
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    model = (model or "").split("/")[-1]
+    for prefix, (prompt_price, completion_price) in MODEL_PRICES.items():
+        if model.startswith(prefix):
+            return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+    return 0.0
+
+
+class MetricsHandler(BaseCallbackHandler):
+    """
+    Callback handler recording, per thread and per node:
+    node runs and wall time, interrupts and the time the thread was blocked in them (until
+    the next run on the thread), LLM calls, errors, retries, latency, time to first token,
+    prompt/completion tokens and estimated cost.
+
+    Pass it in the callbacks of the graph config, it then sees the runs of every node
+    and of every chain called by the nodes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (thread id, node) -> metrics
+        self.metrics = defaultdict(lambda: dict.fromkeys(_FIELDS, 0))
+        # run id -> (thread id, node, start time)
+        self.node_runs = {}
+        # run id -> [thread id, node, start time, model, first token time]
+        self.llm_runs = {}
+        # thread id -> (node, time) of the interrupt the thread is waiting in
+        self.blocked = {}
+
+    def _add(self, thread_id, node, **values):
+        metrics = self.metrics[(thread_id, node)]
+        for key, value in values.items():
+            metrics[key] += value
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        if node is None or kwargs.get("name") != node or node == "__start__":
+            return
+        thread_id = str(metadata.get("thread_id", ""))
+        now = time.perf_counter()
+        with self.lock:
+            self.node_runs[run_id] = (thread_id, node_path(metadata), now)
+            blocked = self.blocked.pop(thread_id, None)
+            if blocked is not None:
+                self._add(thread_id, blocked[0], blocked_seconds=now - blocked[1])
+
+    def _end_node(self, run_id, interrupted):
+        now = time.perf_counter()
+        with self.lock:
+            run = self.node_runs.pop(run_id, None)
+            if run is None:
+                return
+            thread_id, node, start = run
+            self._add(thread_id, node, node_runs=1, node_seconds=now - start, interrupts=int(interrupted))
+            # a subgraph node is interrupted with its inner node, keep the inner one
+            if interrupted and thread_id not in self.blocked:
+                self.blocked[thread_id] = (node, now)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        if run_id in self.node_runs:
+            self._end_node(run_id, False)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        if run_id in self.node_runs:
+            self._end_node(run_id, isinstance(error, GraphInterrupt))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        metadata = metadata or {}
+        parameters = kwargs.get("invocation_params") or {}
+        model = parameters.get("model") or parameters.get("model_name") or ""
+        with self.lock:
+            self.llm_runs[run_id] = [str(metadata.get("thread_id", "")), node_path(metadata),
+                                     time.perf_counter(), model, None]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self.llm_runs.get(run_id)
+        if run is not None and run[4] is None:
+            run[4] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        now = time.perf_counter()
+        with self.lock:
+            run = self.llm_runs.pop(run_id, None)
+        if run is None:
+            return
+        thread_id, node, start, model, first_token = run
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None)
+                if usage:
+                    prompt_tokens += usage.get("input_tokens", 0)
+                    completion_tokens += usage.get("output_tokens", 0)
+                if not model and message is not None:
+                    model = message.response_metadata.get("model_name", "")
+        if not prompt_tokens and response.llm_output:
+            token_usage = response.llm_output.get("token_usage") or {}
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+        with self.lock:
+            self._add(thread_id, node, llm_calls=1, llm_seconds=now - start,
+                      ttft_seconds=(first_token - start) if first_token else 0,
+                      ttft_count=1 if first_token else 0,
+                      prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                      cost_usd=estimate_cost(model, prompt_tokens, completion_tokens))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        now = time.perf_counter()
+        with self.lock:
+            run = self.llm_runs.pop(run_id, None)
+            if run is not None:
+                self._add(run[0], run[1], llm_errors=1, llm_seconds=now - run[2])
+
+    def on_retry(self, retry_state, *, run_id, **kwargs):
+        with self.lock:
+            run = self.llm_runs.get(run_id) or self.node_runs.get(run_id)
+            if run is not None:
+                self._add(run[0], run[1], llm_retries=1)
+
+    def drop_thread(self, thread_id):
+        """Forget the metrics of a thread (e.g. evicted by the SessionRegistry)."""
+        with self.lock:
+            for key in [key for key in self.metrics if key[0] == thread_id]:
+                del self.metrics[key]
+            self.blocked.pop(thread_id, None)
+
+    def snapshot(self, thread_id=None):
+        """
+        The metrics per node, of one thread or summed over all the threads.
+
+        Returns:
+            dict: node -> metrics, with the mean latencies in milliseconds
+        """
+        with self.lock:
+            nodes = defaultdict(lambda: dict.fromkeys(_FIELDS, 0))
+            for (metrics_thread, node), metrics in self.metrics.items():
+                if thread_id is None or metrics_thread == thread_id:
+                    for key, value in metrics.items():
+                        nodes[node][key] += value
+        table = {}
+        for node, metrics in sorted(nodes.items()):
+            table[node] = {
+                "node_runs": metrics["node_runs"],
+                "node_s": round(metrics["node_seconds"], 3),
+                "node_ms_mean": round(metrics["node_seconds"] / metrics["node_runs"] * 1000, 1) if metrics["node_runs"] else None,
+                "interrupts": metrics["interrupts"],
+                "blocked_s": round(metrics["blocked_seconds"], 1),
+                "llm_calls": metrics["llm_calls"],
+                "llm_ms_mean": round(metrics["llm_seconds"] / metrics["llm_calls"] * 1000, 1) if metrics["llm_calls"] else None,
+                "ttft_ms_mean": round(metrics["ttft_seconds"] / metrics["ttft_count"] * 1000, 1) if metrics["ttft_count"] else None,
+                "prompt_tokens": metrics["prompt_tokens"],
+                "completion_tokens": metrics["completion_tokens"],
+                "errors": metrics["llm_errors"],
+                "retries": metrics["llm_retries"],
+                "cost_usd": round(metrics["cost_usd"], 5),
+            }
+        return table
+
+    def prometheus_text(self):
+        """The metrics in Prometheus text exposition format, labelled by thread and node."""
+        counters = [
+            ("inkrea_node_runs_total", "node_runs", "Node runs"),
+            ("inkrea_node_seconds_total", "node_seconds", "Wall time of the node runs"),
+            ("inkrea_node_interrupts_total", "interrupts", "Node runs that stopped in an interrupt"),
+            ("inkrea_interrupt_blocked_seconds_total", "blocked_seconds", "Time the thread waited for the user in the node interrupts"),
+            ("inkrea_llm_calls_total", "llm_calls", "LLM calls"),
+            ("inkrea_llm_errors_total", "llm_errors", "Failed LLM calls"),
+            ("inkrea_llm_retries_total", "llm_retries", "Retried LLM calls"),
+            ("inkrea_llm_seconds_total", "llm_seconds", "Latency of the LLM calls"),
+            ("inkrea_llm_ttft_seconds_total", "ttft_seconds", "Time to first token of the streamed LLM calls"),
+            ("inkrea_llm_ttft_count_total", "ttft_count", "Streamed LLM calls"),
+            ("inkrea_llm_prompt_tokens_total", "prompt_tokens", "Prompt tokens"),
+            ("inkrea_llm_completion_tokens_total", "completion_tokens", "Completion tokens"),
+            ("inkrea_llm_cost_usd_total", "cost_usd", "Estimated cost of the LLM calls in USD"),
+        ]
+        with self.lock:
+            items = [(key, dict(metrics)) for key, metrics in self.metrics.items()]
+        lines = []
+        for name, field, description in counters:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for (thread_id, node), metrics in items:
+                lines.append(f'{name}{{thread="{thread_id}",node="{node}"}} {metrics[field]}')
+        return "\n".join(lines) + "\n"
+
+
+_handler = MetricsHandler() if METRICS_ENABLED else None
+_server = None
+_server_lock = threading.Lock()
+
+def get_metrics_handler():
+    """The process-wide MetricsHandler, None when the metrics are disabled."""
+    return _handler
+
+def graph_callbacks():
+    """Callbacks to pass in the graph config: the metrics handler, if enabled."""
+    return [_handler] if _handler is not None else []
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serve GET /metrics in Prometheus text format from a daemon thread (once per process)."""
+    global _server
+    if _handler is None or not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            class MetricsRequestHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = _handler.prometheus_text().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            _server = ThreadingHTTPServer(("127.0.0.1", port), MetricsRequestHandler)
+            threading.Thread(target=_server.serve_forever, name="inkrea-metrics", daemon=True).start()
+        return _server
@@ -0,0 +1,505 @@
+"""
+Latency-aware routing of the LLM calls between the configured models.
+
+The chains of the nodes do not call a fixed client: they call a ModelRouter for a route
+(a class of nodes), which chooses one of the models eligible for the route from their
+rolling latency and error rate, and fails over to the next one when a call fails.
+The calls of every node role (a paragraph, a title, ...) have a deadline and an output
+cap (ROLE_BUDGETS), and can be hedged: a second request is sent when the first one is
+slower than the p90 of its model, and the first answer is used.
+
+Every call is recorded as a decision (route, node, chosen model, reason, attempts,
+seconds), kept in memory and appended to INKREALLM_ROUTE_LOG as JSON lines, so the
+latency of the routing can be checked offline:
+    python model_router.py route_log.jsonl
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import nullcontext
+from langchain_core.callbacks import BaseCallbackManager
+from langchain_core.runnables import Runnable
+from langchain_core.runnables.config import ensure_config
+from langgraph.pregel.messages import StreamMessagesHandler
+from rate_limiter import PROVIDERS, get_provider_gate
+
+logger = logging.getLogger(__name__)
+
+# models eligible for every route, the preferred one first
+# can be changed with INKREALLM_ROUTE_<ROUTE> in the .env file, e.g. INKREALLM_ROUTE_PROSE=openai_llm,gemini_llm
+DEFAULT_ROUTES = {
+    # short answers: questions, summaries, unit lengths
+    "fast": ["openai_llm", "gemini_llm"],
+    # deterministic answers: the next unit title
+    "strict": ["openai_strict_llm", "openai_llm"],
+    # paragraphs
+    "prose": ["openai_llm", "gemini_llm"],
+    # JSON answers (json_mode)
+    "structured": ["openai_llm"],
+    # the file name of the writing
+    "filename": ["gemini_llm", "openai_llm"],
+}
+ROUTES = {route: [model.strip() for model in os.getenv(f"INKREALLM_ROUTE_{route.upper()}", ",".join(models)).split(",") if model.strip()]
+          for route, models in DEFAULT_ROUTES.items()}
+# fraction of the calls sent to another healthy model, to keep its latency known (0 -> off)
+ROUTE_EXPLORE = float(os.getenv("INKREALLM_ROUTE_EXPLORE", 0))
+# routes whose models are not interchangeable (the temperature 0 client of the titles), never explored
+NO_EXPLORE_ROUTES = ("strict",)
+# JSON lines file of the routing decisions (empty -> only kept in memory)
+ROUTE_LOG = os.getenv("INKREALLM_ROUTE_LOG", "")
+
+# deadline of a request (seconds) and cap of its answer (max_tokens) for every node role
+# can be changed with INKREALLM_ROLE_BUDGETS in the .env file, e.g. INKREALLM_ROLE_BUDGETS={"paragraph": [60, 600]}
+DEFAULT_ROLE_BUDGETS = {
+    # a question of the info gatherer
+    "question": (30, 300),
+    # the condensed story info
+    "story_info": (60, 1500),
+    # one paragraph
+    "paragraph": (90, 800),
+    # characters and story structure (JSON)
+    "json": (180, 8000),
+    # one unit title
+    "title": (20, 60),
+    # the length of a unit (a number)
+    "unit_length": (20, 20),
+    # the summary of a unit
+    "summary": (60, 600),
+    # the file name of the writing
+    "filename": (20, 40),
+}
+ROLE_BUDGETS = {**DEFAULT_ROLE_BUDGETS,
+                **{role: tuple(budget) for role, budget in json.loads(os.getenv("INKREALLM_ROLE_BUDGETS", "{}")).items()}}
+# send a second request when a call is slower than the p90 of its model (async calls only)
+ROUTE_HEDGE = os.getenv("INKREALLM_HEDGE", "0") == "1"
+# the earliest a second request is sent
+HEDGE_MIN_DELAY_SECONDS = 0.05
+
+# calls of a model (per route) used for its latency and error rate, and their maximum age
+STATS_WINDOW = 10
+STATS_MAX_AGE_SECONDS = 300
+# calls needed before the latency or the error rate of a model is trusted
+MIN_SAMPLES = 5
+# error rate above which a model is skipped (until its errors are older than STATS_MAX_AGE_SECONDS)
+MAX_ERROR_RATE = 0.5
+# the preferred model is left only for a model this many times faster (p95)
+SWITCH_RATIO = 1.2
+# decisions kept in memory
+DECISIONS_KEPT = 1000
+
+
+def job_of(config):
+    """
+    The job (thread id) and the priority of the run a chain is called in.
+
+    The nodes call the chains without a config, so the config is the one of the running
+    node (from the context), which holds the thread_id and the priority of the run.
+    """
+    configurable = ensure_config(config).get("configurable") or {}
+    return configurable.get("thread_id"), configurable.get("priority", 0)
+
+
+def without_streaming(config):
+    """The config of a call whose tokens are not streamed to the UI (e.g. a hedge)."""
+    config = ensure_config(config)
+    callbacks = config.get("callbacks")
+    if isinstance(callbacks, BaseCallbackManager):
+        callbacks = callbacks.copy()
+        for handler in list(callbacks.handlers):
+            if isinstance(handler, StreamMessagesHandler):
+                callbacks.remove_handler(handler)
+    elif isinstance(callbacks, list):
+        callbacks = [handler for handler in callbacks if not isinstance(handler, StreamMessagesHandler)]
+    return {**config, "callbacks": callbacks}
+
+
+def muted_when(config, abandoned):
+    """The config of a call whose tokens stop being streamed to the UI once <abandoned> (an Event) is set."""
+    config = ensure_config(config)
+    callbacks = config.get("callbacks")
+    muted = {}
+
+    def mute(handler):
+        if not isinstance(handler, StreamMessagesHandler):
+            return handler
+        if id(handler) not in muted:
+            copy = muted[id(handler)] = StreamMessagesHandler(
+                lambda chunk, stream=handler.stream: None if abandoned.is_set() else stream(chunk))
+            copy.metadata, copy.seen = handler.metadata, handler.seen
+        return muted[id(handler)]
+    if isinstance(callbacks, BaseCallbackManager):
+        callbacks = callbacks.copy()
+        callbacks.handlers = [mute(handler) for handler in callbacks.handlers]
+        callbacks.inheritable_handlers = [mute(handler) for handler in callbacks.inheritable_handlers]
+    elif isinstance(callbacks, list):
+        callbacks = [mute(handler) for handler in callbacks]
+    return {**config, "callbacks": callbacks}
+
+
+def call_with_timeout(function, timeout, input, config, on_done=None, **kwargs):
+    """
+    Call function(input, config, **kwargs) in a thread (with the context of the caller) and
+    wait at most <timeout> seconds for it, for the clients that cannot enforce a deadline
+    themselves (see chain_registry.with_deadline).
+
+    A call still running after the timeout is abandoned: its tokens are no longer streamed
+    to the UI, and <on_done> (e.g. the release of its provider slot) is only called when
+    it ends, so the provider caps still count it.
+    """
+    result = {}
+    context = contextvars.copy_context()
+    abandoned = threading.Event()
+    config = muted_when(config, abandoned)
+
+    def target():
+        try:
+            result["value"] = context.run(function, input, config, **kwargs)
+        except BaseException as error:
+            result["error"] = error
+        finally:
+            if on_done is not None:
+                on_done()
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        abandoned.set()
+        raise TimeoutError(f"no answer after {timeout} s")
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def percentile(values, fraction):
+    """The value under which <fraction> of the sorted <values> are (nearest rank)."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class ModelStats:
+    """
+    Rolling latency and error rate of the calls of a model on a route.
+
+    The last <window> calls younger than <max_age> seconds are kept.
+    """
+
+    def __init__(self, window=STATS_WINDOW, max_age=STATS_MAX_AGE_SECONDS):
+        self.max_age = max_age
+        self.calls = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds, ok):
+        with self.lock:
+            self.calls.append((time.monotonic(), seconds, ok))
+
+    def summary(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.calls and now - self.calls[0][0] > self.max_age:
+                self.calls.popleft()
+            calls = list(self.calls)
+        latencies = sorted(seconds for _, seconds, ok in calls if ok)
+        errors = sum(1 for _, _, ok in calls if not ok)
+        return {
+            "samples": len(calls),
+            "error_rate": round(errors / len(calls), 3) if calls else 0.0,
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p95": percentile(latencies, 0.95),
+        }
+
+
+_model_stats = {}
+_decisions = deque(maxlen=DECISIONS_KEPT)
+_lock = threading.Lock()
+
+
+def get_model_stats(route, model):
+    """The process-wide stats of <model> on <route>, created on first use."""
+    with _lock:
+        if (route, model) not in _model_stats:
+            _model_stats[(route, model)] = ModelStats()
+        return _model_stats[(route, model)]
+
+
+def record_decision(decision):
+    """Keep a decision in memory and append it to ROUTE_LOG."""
+    with _lock:
+        _decisions.append(decision)
+        if ROUTE_LOG:
+            with open(ROUTE_LOG, "a", encoding="utf-8") as log_file:
+                log_file.write(json.dumps(decision) + "\n")
+    if decision["reason"] != "preferred" or len(decision["attempts"]) > 1:
+        logger.info("route %s (%s): %s, %s", decision["route"], decision["node"], decision["model"], decision["reason"])
+
+
+def recent_decisions():
+    with _lock:
+        return list(_decisions)
+
+
+def clear_routing():
+    """Forget the stats and the decisions (e.g. between two runs of a benchmark)."""
+    with _lock:
+        _model_stats.clear()
+        _decisions.clear()
+
+
+class ModelRouter(Runnable):
+    """
+    Chooses the model of every call of a route and fails over to the next one.
+
+    The preferred model (the first one) is used unless another healthy model is
+    SWITCH_RATIO times faster at p95; a model failing more than MAX_ERROR_RATE of its
+    recent calls is skipped. With ROUTE_EXPLORE, that fraction of the calls go to another
+    healthy model so its latency stays known (except on NO_EXPLORE_ROUTES). When a call fails, the next model of the order is called.
+
+    Every attempt holds a slot of the provider gate of its model (see
+    rate_limiter.ProviderGate); the time spent waiting for the slot is not counted in
+    the latency of the model. An attempt gets the deadline of the <role> of the call:
+    a request without an answer by then fails and the next model is called. The clients
+    of <client_deadlines> enforce it on the request itself; the sync calls of the other
+    clients are abandoned in their thread, holding their slot until they end. With
+    ROUTE_HEDGE, an async attempt slower than the p90 of its model sends a second
+    request to the same model (if the gate has a free slot, without streaming its
+    tokens) and the first answer wins; the other request is cancelled.
+
+    Args:
+        route (str): name of the route
+        candidates (list): (model name, runnable calling the model) pairs, the preferred first
+        role (str): role of the calls, for the deadline (see ROLE_BUDGETS)
+    """
+
+    def __init__(self, route, candidates, role=None, client_deadlines=()):
+        self.route = route
+        self.candidates = candidates
+        self.role = role
+        self.timeout = ROLE_BUDGETS[role][0] if role else None
+        # the models whose client enforces the deadline (see chain_registry.with_deadline)
+        self.client_deadlines = set(client_deadlines)
+
+    def order(self):
+        """The models to try, in order, and the reason of the first one."""
+        ranked = []
+        for position, (model, runnable) in enumerate(self.candidates):
+            summary = get_model_stats(self.route, model).summary()
+            known = summary["samples"] >= MIN_SAMPLES
+            healthy = not known or summary["error_rate"] <= MAX_ERROR_RATE
+            score = summary["p95"] if known and summary["p95"] is not None else None
+            ranked.append((healthy, score, position, model, runnable))
+        healthy = [candidate for candidate in ranked if candidate[0]]
+        if not healthy:
+            # every model is failing: try them all, the preferred first
+            return [(model, runnable) for _, _, _, model, runnable in ranked], "all degraded"
+        chosen, reason = healthy[0], "preferred" if healthy[0][2] == 0 else "failover"
+        faster = [candidate for candidate in healthy if candidate[1] is not None]
+        if faster and chosen[1] is not None:
+            fastest = min(faster, key=lambda candidate: candidate[1])
+            if fastest[1] * SWITCH_RATIO < chosen[1]:
+                chosen, reason = fastest, "faster"
+        if len(healthy) > 1 and self.route not in NO_EXPLORE_ROUTES and random.random() < ROUTE_EXPLORE:
+            # the preferred model is probed first, so the route comes back to it when it recovers
+            others = [candidate for candidate in healthy if candidate is not chosen]
+            chosen, reason = others[0] if others[0][2] == 0 else random.choice(others), "explore"
+        rest = sorted((candidate for candidate in ranked if candidate is not chosen),
+                      key=lambda candidate: (not candidate[0], candidate[2]))
+        return [(model, runnable) for _, _, _, model, runnable in [chosen] + rest], reason
+
+    def _aslot(self, model, job, priority):
+        if model not in PROVIDERS:
+            return nullcontext()
+        return get_provider_gate(PROVIDERS[model]).aslot(job, priority)
+
+    def _hedge_delay(self, model):
+        if not ROUTE_HEDGE:
+            return None
+        summary = get_model_stats(self.route, model).summary()
+        if summary["samples"] < MIN_SAMPLES or summary["p90"] is None:
+            return None
+        delay = max(summary["p90"], HEDGE_MIN_DELAY_SECONDS)
+        return delay if self.timeout is None or delay < self.timeout else None
+
+    async def _ainvoke_attempt(self, model, runnable, input, config, kwargs, job):
+        """
+        One attempt on <model>, hedged after the p90 of the model and bounded by the deadline.
+
+        Returns:
+            tuple: the output, whether a second request was sent and whether it won
+        """
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        primary = asyncio.ensure_future(runnable.ainvoke(input, config, **kwargs))
+        tasks = {primary: False}
+        hedge_gate = None
+        try:
+            hedge_delay = self._hedge_delay(model)
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+                gate = get_provider_gate(PROVIDERS[model]) if model in PROVIDERS else None
+                if not done and (gate is None or gate.try_acquire(job)):
+                    hedge_gate = gate
+                    tasks[asyncio.ensure_future(runnable.ainvoke(input, without_streaming(config), **kwargs))] = True
+            pending = set(tasks)
+            error = None
+            while pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"no answer after {self.timeout} s")
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), len(tasks) > 1, tasks[task]
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            if hedge_gate is not None:
+                hedge_gate.release(job)
+
+    def _decision(self, config, reason, attempts, start):
+        return {
+            "time": round(time.time(), 3),
+            "route": self.route,
+            "role": self.role,
+            "node": (ensure_config(config).get("metadata") or {}).get("langgraph_node"),
+            "model": attempts[-1]["model"] if attempts[-1]["ok"] else None,
+            "reason": reason,
+            "attempts": attempts,
+            "seconds": round(time.perf_counter() - start, 4),
+        }
+
+    def invoke(self, input, config=None, **kwargs):
+        job, priority = job_of(config)
+        order, reason = self.order()
+        attempts = []
+        start = time.perf_counter()
+        for model, runnable in order:
+            gate = get_provider_gate(PROVIDERS[model]) if model in PROVIDERS else None
+            if gate is not None:
+                gate.acquire(job, priority)
+            release = (lambda gate=gate: gate.release(job)) if gate is not None else None
+            call_start = time.perf_counter()
+            try:
+                if self.timeout and model not in self.client_deadlines:
+                    # the slot is released when the call ends, even after the deadline
+                    output = call_with_timeout(runnable.invoke, self.timeout, input, config, release, **kwargs)
+                else:
+                    try:
+                        output = runnable.invoke(input, config, **kwargs)
+                    finally:
+                        if release is not None:
+                            release()
+            except Exception as error:
+                self._record(attempts, model, call_start, error)
+                last_error = error
+                continue
+            self._record(attempts, model, call_start)
+            record_decision(self._decision(config, reason, attempts, start))
+            return output
+        record_decision(self._decision(config, reason, attempts, start))
+        raise last_error
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        job, priority = job_of(config)
+        order, reason = self.order()
+        attempts = []
+        start = time.perf_counter()
+        for model, runnable in order:
+            async with self._aslot(model, job, priority):
+                call_start = time.perf_counter()
+                try:
+                    output, hedged, hedge_won = await self._ainvoke_attempt(model, runnable, input, config, kwargs, job)
+                except Exception as error:
+                    self._record(attempts, model, call_start, error)
+                    last_error = error
+                    continue
+            self._record(attempts, model, call_start, hedged=hedged, hedge_won=hedge_won)
+            record_decision(self._decision(config, reason, attempts, start))
+            return output
+        record_decision(self._decision(config, reason, attempts, start))
+        raise last_error
+
+    def _record(self, attempts, model, call_start, error=None, hedged=False, hedge_won=False):
+        seconds = time.perf_counter() - call_start
+        get_model_stats(self.route, model).record(seconds, error is None)
+        attempt = {"model": model, "seconds": round(seconds, 4), "ok": error is None}
+        if hedged:
+            attempt["hedged"] = True
+            attempt["hedge_won"] = hedge_won
+        if error is not None:
+            attempt["error"] = f"{type(error).__name__}: {error}"[:200]
+            logger.warning("route %s: %s failed: %s", self.route, model, attempt["error"])
+        attempts.append(attempt)
+
+
+def router_stats():
+    """Rolling latency and error rate of every model on every route, and the reasons of the decisions kept."""
+    with _lock:
+        stats = dict(_model_stats)
+        decisions = list(_decisions)
+    reasons = {}
+    for decision in decisions:
+        reasons[decision["reason"]] = reasons.get(decision["reason"], 0) + 1
+    return {
+        "routes": {f"{route}/{model}": {key: round(value, 4) if isinstance(value, float) else value
+                                        for key, value in model_stats.summary().items()}
+                   for (route, model), model_stats in sorted(stats.items())},
+        "nodes": summarize_decisions(decisions, "node"),
+        "decisions": len(decisions),
+        "reasons": reasons,
+    }
+
+
+def summarize_decisions(decisions, key="route"):
+    """
+    Latency of the calls of a list of decisions, by route (or by node, role, ...):
+    p50 / p95 / p99 seconds, failed and timed out calls, failovers, hedges and the
+    calls per model.
+    """
+    groups = {}
+    for decision in decisions:
+        groups.setdefault(str(decision.get(key)), []).append(decision)
+    summary = {}
+    for group, group_decisions in sorted(groups.items()):
+        seconds = sorted(decision["seconds"] for decision in group_decisions)
+        attempts = [attempt for decision in group_decisions for attempt in decision["attempts"]]
+        models = {}
+        for decision in group_decisions:
+            models[decision["model"] or "failed"] = models.get(decision["model"] or "failed", 0) + 1
+        hedges = sum(1 for attempt in attempts if attempt.get("hedged"))
+        hedge_wins = sum(1 for attempt in attempts if attempt.get("hedge_won"))
+        summary[group] = {
+            "calls": len(group_decisions),
+            "failed": sum(1 for decision in group_decisions if decision["model"] is None),
+            "timeouts": sum(1 for attempt in attempts if attempt.get("error", "").startswith("TimeoutError")),
+            "failovers": sum(1 for decision in group_decisions if len(decision["attempts"]) > 1),
+            "hedges": hedges,
+            "hedge_win_rate": round(hedge_wins / hedges, 3) if hedges else None,
+            "p50_s": round(percentile(seconds, 0.5), 4),
+            "p95_s": round(percentile(seconds, 0.95), 4),
+            "p99_s": round(percentile(seconds, 0.99), 4),
+            "models": models,
+        }
+    return summary
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("usage: python model_router.py route_log.jsonl [route|node|role]")
+        sys.exit(1)
+    with open(sys.argv[1], encoding="utf-8") as log_file:
+        decisions = [json.loads(line) for line in log_file if line.strip()]
+    print(json.dumps(summarize_decisions(decisions, sys.argv[2] if len(sys.argv) == 3 else "route"), indent=2))
+
+
+if __name__ == "__main__":
+    main()
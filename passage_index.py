@@ -0,0 +1,241 @@
+"""
+In-process BM25 index of the passages of the stories: the accepted paragraphs and the unit summaries.
+
+Every thread has an index, built from its manuscript (see manuscript_store.py) and its
+story summary on first use and then updated as the paragraphs are accepted and the units
+are summarized. The paragraph writer and rewriter send the passages most related to the
+current unit and its characters instead of the whole story.
+
+The postings of a term are two arrays (passage ids, term frequencies) in the order the
+passages were added, scored with numpy views of the arrays. A search scores the rarest
+query terms first (the ones with short postings in a single pass, then term by term). As soon as no passage outside the scored ones can reach
+the top k (its best possible score, the sum of the bounds of the terms left, is below the
+k-th best score; the bound of a term is its score in the shortest passage for each of its
+frequencies), the common terms left only add to the scores of the candidates that can
+still be in the top k, found in their postings by binary search (MaxScore). The results
+are the exact BM25 top k, and the long postings of the common terms are not read.
+"""
+import os
+import re
+import math
+import threading
+from array import array
+import numpy as np
+
+# send the passages of the story most related to the current unit to the paragraph writer and rewriter
+PASSAGE_RETRIEVAL = os.getenv("INKREALLM_PASSAGE_RETRIEVAL", "1") == "1"
+# number of passages sent to the paragraph writer and rewriter
+RETRIEVED_PASSAGES = int(os.getenv("INKREALLM_RETRIEVED_PASSAGES", 3))
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# a search uses the most discriminative (rarest) query terms only
+MAX_QUERY_TERMS = 32
+# terms with up to this many postings are always scored in full, in one pass
+BATCH_POSTINGS = 4096
+
+STOPWORDS = frozenset("""
+    a about above after again against all am an and any are as at be because been before being below
+    between both but by can could did do does doing down during each few for from further had has have
+    having he her here hers herself him himself his how if in into is it its itself just me more most my
+    myself no nor not now of off on once only or other our ours ourselves out over own same she should so
+    some such than that the their theirs them themselves then there these they this those through to too
+    under until up very was we were what when where which while who whom why will with would you your
+    yours yourself yourselves
+    """.split())
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """The lowercase words of <text>, without stopwords and single characters."""
+    return [token for token in TOKEN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+def _top(scores, passages, k):
+    """The <k> passages of <passages> (without duplicates) with the best scores."""
+    if len(passages) <= k:
+        return passages
+    return passages[np.argpartition(-scores[passages], k - 1)[:k]]
+
+
+class PassageIndex:
+    """
+    BM25 index of keyed passages, updated one passage at a time.
+
+    The index keeps the keys of the passages, not their text: the caller reads the text
+    of the passages found from where it is stored.
+    """
+
+    def __init__(self):
+        # passage id -> key, in the order the passages were added
+        self.keys = []
+        self.ids = {}
+        self.lengths = array("I")
+        self.total_length = 0
+        # term -> (passage ids, term frequencies, {frequency: length of the shortest passage with it})
+        self.postings = {}
+        # BM25 length normalization of the passages, computed again when a passage is added
+        self._norms = None
+        self.lock = threading.Lock()
+
+    def add(self, key, text):
+        """
+        Add a passage. A passage whose key is already indexed is skipped.
+
+        Returns:
+            bool: True if the passage was added
+        """
+        terms = tokenize(text)
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        with self.lock:
+            if key in self.ids:
+                return False
+            passage = len(self.keys)
+            self.keys.append(key)
+            self.ids[key] = passage
+            self.lengths.append(len(terms))
+            self.total_length += len(terms)
+            for term, count in counts.items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = (array("I"), array("I"), {})
+                postings[0].append(passage)
+                postings[1].append(count)
+                shortest = postings[2]
+                if len(terms) < shortest.get(count, len(terms) + 1):
+                    shortest[count] = len(terms)
+        return True
+
+    def search(self, query, k, exclude=()):
+        """
+        The <k> passages that match <query> best.
+
+        Args:
+            query (str): the text to match
+            k (int): number of passages
+            exclude (set): keys of passages that must not be returned
+
+        Returns:
+            list: (key, score) pairs, in the order the passages were added
+        """
+        with self.lock:
+            passages = len(self.keys)
+            if passages == 0 or k <= 0:
+                return []
+            postings = self.postings
+            terms = sorted({term for term in tokenize(query) if term in postings},
+                           key=lambda term: len(postings[term][0]))[:MAX_QUERY_TERMS]
+            if not terms:
+                return []
+            # BM25 length normalization of every passage: k1 * (1 - b + b * length / average length)
+            c1 = BM25_K1 * (1 - BM25_B)
+            c2 = BM25_K1 * BM25_B * passages / max(self.total_length, 1)
+            if self._norms is None or len(self._norms) != passages:
+                self._norms = c1 + c2 * np.frombuffer(self.lengths, dtype=np.uint32)
+            norms = self._norms
+            weights, bounds = [], []
+            for term in terms:
+                ids, _, shortest = postings[term]
+                weight = math.log(1 + (passages - len(ids) + 0.5) / (len(ids) + 0.5)) * (BM25_K1 + 1)
+                weights.append(weight)
+                # the most the term adds to the score of a passage
+                bounds.append(weight * max(count / (count + c1 + c2 * length) for count, length in shortest.items()))
+            scores = np.zeros(passages)
+            scores[[self.ids[key] for key in exclude if key in self.ids]] = -np.inf
+            # the rarest terms are scored at once: the terms whose bounds add up to less than the bounds
+            # of the others (the top k cannot be known before them) and the terms with short postings
+            position, scored, remaining = 0, 0.0, sum(bounds)
+            while position < len(terms) and (scored < remaining or len(postings[terms[position]][0]) <= BATCH_POSTINGS):
+                scored += bounds[position]
+                remaining -= bounds[position]
+                position += 1
+            ids = np.concatenate([np.frombuffer(postings[term][0], dtype=np.uint32) for term in terms[:position]])
+            counts = np.concatenate([np.frombuffer(postings[term][1], dtype=np.uint32) for term in terms[:position]])
+            term_weights = np.repeat(weights[:position], [len(postings[term][0]) for term in terms[:position]])
+            scores += np.bincount(ids, weights=term_weights * counts / (counts + norms[ids]), minlength=passages)
+            # the top k so far: the scores only grow, so the next top k is in it or in the postings of the next term
+            top = _top(scores, np.unique(ids), k)
+            while position < len(terms):
+                threshold = scores[top].min() if len(top) == k else 0.0
+                if threshold >= remaining:
+                    # no passage outside the scored ones can enter the top k any more
+                    break
+                ids, counts, _ = postings[terms[position]]
+                ids, counts = np.frombuffer(ids, dtype=np.uint32), np.frombuffer(counts, dtype=np.uint32)
+                scores[ids] += weights[position] * counts / (counts + norms[ids])
+                found = np.minimum(np.searchsorted(ids, top), len(ids) - 1)
+                top = _top(scores, np.concatenate([top[ids[found] != top], ids]), k)
+                remaining -= bounds[position]
+                position += 1
+            if position < len(terms):
+                # the common terms only add to the scores of the passages that can still be in the top k
+                candidates = np.flatnonzero(scores > threshold - remaining)
+                for term, weight, bound in zip(terms[position:], weights[position:], bounds[position:]):
+                    ids, counts, _ = postings[term]
+                    ids, counts = np.frombuffer(ids, dtype=np.uint32), np.frombuffer(counts, dtype=np.uint32)
+                    found = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+                    hits = ids[found] == candidates
+                    found, matched = found[hits], candidates[hits]
+                    scores[matched] += weight * counts[found] / (counts[found] + norms[matched])
+                    remaining -= bound
+                    top = _top(scores, candidates, k)
+                    threshold = scores[top].min() if len(top) == k else 0.0
+                    candidates = candidates[scores[candidates] + remaining > threshold]
+                top = _top(scores, np.union1d(candidates, top), k)
+            top = top[scores[top] > 0]
+            keys = self.keys
+            return [(keys[passage], float(scores[passage])) for passage in sorted(top.tolist())]
+
+    def stats(self):
+        with self.lock:
+            return {"passages": len(self.keys), "terms": len(self.postings),
+                    "postings": sum(len(postings[0]) for postings in self.postings.values())}
+
+
+class PassageIndexes:
+    """The passage indexes of the threads, built on first use."""
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, thread_id, manuscript, summaries):
+        """
+        The passage index of <thread_id>, built from its manuscript and summaries if it does not exist.
+
+        Args:
+            thread_id (str): the thread
+            manuscript (manuscript_store.Manuscript): the manuscript of the thread
+            summaries (list): the summaries of the finished units, in order
+
+        Returns:
+            PassageIndex: the index, with ("paragraph", unit, paragraph) and ("summary", unit) keys
+        """
+        with self.lock:
+            index = self.indexes.get(thread_id)
+            if index is None:
+                index = self.indexes[thread_id] = PassageIndex()
+                for unit in sorted(manuscript.units):
+                    # paragraph 0 of a unit is its title
+                    for paragraph in range(1, manuscript.paragraphs(unit)):
+                        index.add(("paragraph", unit, paragraph), manuscript.read(unit, paragraph))
+                    if unit <= len(summaries):
+                        index.add(("summary", unit), summaries[unit - 1])
+            return index
+
+    def delete(self, thread_id):
+        with self.lock:
+            self.indexes.pop(thread_id, None)
+
+    def stats(self):
+        with self.lock:
+            indexes = list(self.indexes.values())
+        stats = [index.stats() for index in indexes]
+        return {"indexes": len(stats), "passages": sum(item["passages"] for item in stats),
+                "postings": sum(item["postings"] for item in stats)}
+
+
+passage_indexes = PassageIndexes()
@@ -0,0 +1,406 @@
+import os
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.callbacks import BaseCallbackHandler
+
+# default request budgets per llm object (requests per minute)
+# can be changed with <NAME>_RPM in the .env file, e.g. OPENAI_LLM_RPM=500; the tokens per
+# minute are capped once per provider, by its gate (see DEFAULT_PROVIDER_LIMITS)
+DEFAULT_LIMITS = {
+    "openai_llm": 500,
+    "openai_strict_llm": 500,
+    "gemini_llm": 60,
+}
+# default budgets of an llm object without a provider (requests per minute, tokens per minute)
+# can be changed with <NAME>_RPM / <NAME>_TPM in the .env file
+DEFAULT_UNKNOWN_LIMITS = (60, 100000)
+
+# provider of every llm object: the llm objects of a provider share its gate (see ProviderGate)
+PROVIDERS = {
+    "openai_llm": "openai",
+    "openai_strict_llm": "openai",
+    "gemini_llm": "gemini",
+}
+# default caps per provider (calls in flight, tokens per minute, 0 -> no cap)
+# can be changed with <PROVIDER>_CONCURRENCY / <PROVIDER>_TPM in the .env file, e.g. OPENAI_CONCURRENCY=16
+DEFAULT_PROVIDER_LIMITS = {
+    "openai": (32, 400000),
+    "gemini": (8, 1000000),
+}
+
+# the longest a waiting caller sleeps before checking the buckets again
+MAX_SLEEP_SECONDS = 0.5
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """
+    Rate limiter with two token buckets: one for requests and one for LLM tokens.
+
+    Both buckets start full and refill continuously, so a caller only waits when a
+    budget is actually exhausted. The request bucket is charged in acquire(), the
+    token bucket is charged after the call with the real usage (see record_usage),
+    so it can go below zero and make the next callers wait until it refills.
+    The llm objects of a provider have no token bucket: their usage is charged to the
+    token bucket of the provider gate, the only tokens-per-minute cap of the provider.
+
+    Args:
+        name (str): name of the llm object the limiter belongs to
+        requests_per_minute (float): request budget
+        tokens_per_minute (float): prompt + completion token budget (0 -> no cap)
+    """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+        # counters
+        self.calls = 0
+        self.throttled_calls = 0
+        self.throttled_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.tokens_used = 0
+        self.usage_handler = TokenUsageHandler(self)
+
+    def _refill(self, now):
+        elapsed = now - self.last
+        self.last = now
+        self.available_requests = min(self.requests_per_minute,
+                                      self.available_requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.available_tokens = min(self.tokens_per_minute,
+                                        self.available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _consume(self):
+        """Take one request if both budgets allow it, otherwise return the seconds to wait."""
+        with self._lock:
+            self._refill(time.monotonic())
+            tokens_left = not self.tokens_per_minute or self.available_tokens > 0
+            if self.available_requests >= 1 and tokens_left:
+                self.available_requests -= 1
+                return 0.0
+            wait = 0.0
+            if self.available_requests < 1:
+                wait = (1 - self.available_requests) * 60 / self.requests_per_minute
+            if not tokens_left:
+                wait = max(wait, (1 - self.available_tokens) * 60 / self.tokens_per_minute)
+            return wait
+
+    def _record_wait(self, waited):
+        with self._lock:
+            self.calls += 1
+            # ignore the time spent checking the buckets
+            if waited > 1e-3:
+                self.throttled_calls += 1
+                self.throttled_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        start = time.monotonic()
+        while (wait := self._consume()) > 0:
+            if not blocking:
+                return False
+            time.sleep(min(wait, MAX_SLEEP_SECONDS))
+        self._record_wait(time.monotonic() - start)
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        start = time.monotonic()
+        while (wait := self._consume()) > 0:
+            if not blocking:
+                return False
+            await asyncio.sleep(min(wait, MAX_SLEEP_SECONDS))
+        self._record_wait(time.monotonic() - start)
+        return True
+
+    def record_usage(self, tokens):
+        with self._lock:
+            self.available_tokens -= tokens
+            self.tokens_used += tokens
+        if self.name in PROVIDERS:
+            get_provider_gate(PROVIDERS[self.name]).record_usage(tokens)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "calls": self.calls,
+                "throttled_calls": self.throttled_calls,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "max_wait_seconds": round(self.max_wait_seconds, 3),
+                "tokens_used": self.tokens_used,
+            }
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """Callback that charges the token bucket of a limiter with the usage of every LLM call."""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def on_llm_end(self, response, **kwargs):
+        tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    tokens += usage.get("total_tokens", 0)
+                else:
+                    # no usage reported by the provider -> rough estimate from the text
+                    tokens += len(generation.text) // 4
+        self.limiter.record_usage(tokens)
+
+
+class _Waiter:
+    """A caller waiting for a slot of a ProviderGate (woken by an Event or, on an event loop, a Future)."""
+
+    def __init__(self, key, job, loop):
+        self.key = key
+        self.job = job
+        self.granted = False
+        self.start = time.monotonic()
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(True))
+
+
+class ProviderGate:
+    """
+    Concurrency and tokens-per-minute cap shared by all the llm objects of a provider.
+
+    A call holds a slot of the gate while it runs (see model_router.ModelRouter), so at
+    most <max_concurrency> calls are in flight for the provider, and no call starts while
+    the token bucket of the provider is empty (it is charged with the usage of the calls,
+    like the bucket of TokenBucketRateLimiter). When a slot frees, it goes to the waiting
+    call of the job with the highest priority, then of the job with the fewest calls in
+    flight, then to the oldest one: a job starting many calls at once (e.g. the character
+    fan-out) does not starve the other jobs.
+
+    Args:
+        provider (str): name of the provider
+        max_concurrency (int): calls in flight (0 -> no cap)
+        tokens_per_minute (float): prompt + completion token budget (0 -> no cap)
+    """
+
+    def __init__(self, provider, max_concurrency, tokens_per_minute):
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.available_tokens = float(tokens_per_minute)
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.in_flight_by_job = {}
+        self.waiters = []
+        self._sequence = 0
+        # counters
+        self.calls = 0
+        self.waited_calls = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.max_in_flight = 0
+        self.tokens_used = 0
+
+    def _refill(self, now):
+        if self.tokens_per_minute:
+            self.available_tokens = min(self.tokens_per_minute,
+                                        self.available_tokens + (now - self.last) * self.tokens_per_minute / 60)
+        self.last = now
+
+    def _take(self, job):
+        self.in_flight += 1
+        self.in_flight_by_job[job] = self.in_flight_by_job.get(job, 0) + 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.calls += 1
+
+    def _grant(self):
+        """Give the free slots to the waiters, under the lock."""
+        self._refill(time.monotonic())
+        while self.waiters and (not self.max_concurrency or self.in_flight < self.max_concurrency):
+            if self.tokens_per_minute and self.available_tokens <= 0:
+                return
+            waiter = min(self.waiters, key=lambda waiter: (waiter.key[0], self.in_flight_by_job.get(waiter.job, 0), waiter.key[1]))
+            self.waiters.remove(waiter)
+            self._take(waiter.job)
+            waiter.granted = True
+            waited = time.monotonic() - waiter.start
+            if waited > 1e-3:
+                self.waited_calls += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            waiter.wake()
+
+    def _enqueue(self, job, priority, loop):
+        with self._lock:
+            self._sequence += 1
+            waiter = _Waiter((-priority, self._sequence), job, loop)
+            self.waiters.append(waiter)
+            self._grant()
+            return waiter
+
+    def _release(self, job):
+        with self._lock:
+            self.in_flight -= 1
+            if self.in_flight_by_job[job] == 1:
+                del self.in_flight_by_job[job]
+            else:
+                self.in_flight_by_job[job] -= 1
+            self._grant()
+
+    def _abandon(self, waiter):
+        """A waiter stopped waiting (cancelled): give its slot back or leave the queue."""
+        with self._lock:
+            granted = waiter.granted
+            if not granted:
+                self.waiters.remove(waiter)
+        if granted:
+            self._release(waiter.job)
+
+    def acquire(self, job=None, priority=0):
+        """Wait for a slot for a call of <job>. Every acquire must be followed by a release."""
+        waiter = self._enqueue(job, priority, None)
+        try:
+            while not waiter.granted:
+                # the token bucket refills without a release waking the waiters
+                waiter.event.wait(MAX_SLEEP_SECONDS)
+                with self._lock:
+                    self._grant()
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    async def aacquire(self, job=None, priority=0):
+        waiter = self._enqueue(job, priority, asyncio.get_running_loop())
+        try:
+            while not waiter.granted:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), MAX_SLEEP_SECONDS)
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        self._grant()
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def try_acquire(self, job=None):
+        """Take a slot only if one is free and no call is waiting (for optional calls, e.g. hedges)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.waiters or (self.max_concurrency and self.in_flight >= self.max_concurrency):
+                return False
+            if self.tokens_per_minute and self.available_tokens <= 0:
+                return False
+            self._take(job)
+            return True
+
+    def release(self, job=None):
+        self._release(job)
+
+    @contextmanager
+    def slot(self, job=None, priority=0):
+        """Hold a slot of the gate for a call of <job>."""
+        self.acquire(job, priority)
+        try:
+            yield
+        finally:
+            self.release(job)
+
+    @asynccontextmanager
+    async def aslot(self, job=None, priority=0):
+        await self.aacquire(job, priority)
+        try:
+            yield
+        finally:
+            self.release(job)
+
+    def record_usage(self, tokens):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.available_tokens -= tokens
+            self.tokens_used += tokens
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "tokens_per_minute": self.tokens_per_minute,
+                "in_flight": self.in_flight,
+                "waiting": len(self.waiters),
+                "jobs_in_flight": len(self.in_flight_by_job),
+                "max_in_flight": self.max_in_flight,
+                "calls": self.calls,
+                "waited_calls": self.waited_calls,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "max_wait_seconds": round(self.max_wait_seconds, 3),
+                "tokens_used": self.tokens_used,
+            }
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name):
+    """
+    Return the process-wide rate limiter of an llm object, creating it on first use.
+
+    Args:
+        name (str): name of the llm object (e.g. "openai_llm")
+
+    Returns:
+        TokenBucketRateLimiter: the shared limiter
+    """
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            default_rpm, default_tpm = DEFAULT_UNKNOWN_LIMITS
+            rpm = float(os.getenv(f"{name.upper()}_RPM", DEFAULT_LIMITS.get(name, default_rpm)))
+            # the tokens of the llm objects of a provider are only capped by its gate (<PROVIDER>_TPM)
+            tpm = 0 if name in PROVIDERS else float(os.getenv(f"{name.upper()}_TPM", default_tpm))
+            _rate_limiters[name] = TokenBucketRateLimiter(name, rpm, tpm)
+        return _rate_limiters[name]
+
+def rate_limiter_stats():
+    """Counters of all the rate limiters created so far, by llm object name."""
+    with _rate_limiters_lock:
+        limiters = dict(_rate_limiters)
+    return {name: limiter.stats() for name, limiter in limiters.items()}
+
+_provider_gates = {}
+
+def get_provider_gate(provider):
+    """
+    Return the process-wide gate of a provider, creating it on first use.
+
+    Args:
+        provider (str): name of the provider (e.g. "openai")
+
+    Returns:
+        ProviderGate: the shared gate
+    """
+    with _rate_limiters_lock:
+        if provider not in _provider_gates:
+            default_concurrency, default_tpm = DEFAULT_PROVIDER_LIMITS.get(provider, (8, 100000))
+            concurrency = int(os.getenv(f"{provider.upper()}_CONCURRENCY", default_concurrency))
+            tpm = float(os.getenv(f"{provider.upper()}_TPM", default_tpm))
+            _provider_gates[provider] = ProviderGate(provider, concurrency, tpm)
+        return _provider_gates[provider]
+
+def provider_gate_stats():
+    """Counters of all the provider gates created so far, by provider name."""
+    with _rate_limiters_lock:
+        gates = dict(_provider_gates)
+    return {provider: gate.stats() for provider, gate in gates.items()}
@@ -0,0 +1,152 @@
+import os
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from background_loop import get_event_loop, background_config
+from story_context import record_prompt_tokens
+
+logger = logging.getLogger(__name__)
+
+# fold every accepted paragraph into a running summary of its unit, in the background
+# (0 -> the whole unit is summarized when it ends)
+RUNNING_SUMMARY = os.getenv("INKREALLM_RUNNING_SUMMARY", "1") == "1"
+# running summaries of abandoned sessions are dropped above this number
+MAX_RUNNING_SUMMARIES = 256
+
+
+class RunningSummaries:
+    """
+    Running summaries of the units being written, keyed by thread and unit number.
+
+    When a paragraph is accepted, a background task folds it into the summary of the unit
+    so far (after the fold of the previous paragraph, so the folds of a unit run in order),
+    with a prompt made of the summary and the new paragraph only. At the end of the unit,
+    structure_supervisor takes the summary, already written or one fold away, instead of
+    sending the whole unit to the summarization chain. A unit whose folds are missing (e.g.
+    it was started by another process) or failed is summarized the old way.
+    """
+
+    def __init__(self, max_summaries=MAX_RUNNING_SUMMARIES):
+        self.max_summaries = max_summaries
+        # (thread id, unit number) -> (paragraphs folded, future of the summary)
+        self.summaries = OrderedDict()
+        self.lock = threading.Lock()
+        self.folds = 0
+        self.hits = 0
+        self.misses = 0
+        self.wait_seconds = 0.0
+
+    async def _fold(self, previous, chain, prompt_values, paragraph_number, config):
+        summary = await asyncio.wrap_future(previous) if previous is not None else ""
+        prompt = await chain.first.ainvoke({**prompt_values, "unit_summary": summary or "-"}, config)
+        # the tokens of the prompt sent to the model
+        record_prompt_tokens("unit_summary", prompt.to_string(), paragraph_number)
+        return (await chain.last.ainvoke(prompt, config)).content
+
+    def fold(self, thread_id, unit_number, paragraph_number, chain, prompt_values, config=None):
+        """
+        Fold paragraph <paragraph_number> (1 for the first one) of the unit into its running summary, in the background.
+
+        Args:
+            thread_id (str): thread of the story
+            unit_number (int): number of the unit in the story
+            paragraph_number (int): number of the accepted paragraph in the unit
+            chain: the fold chain (prompt template | model), called with <prompt_values> and the summary so far (unit_summary)
+            prompt_values (dict): the prompt values of the paragraph
+            config (dict): the config of the node accepting the paragraph (see background_loop.background_config)
+        """
+        key = (thread_id, unit_number)
+        dropped = []
+        with self.lock:
+            folded, previous = self.summaries.get(key, (0, None))
+            if paragraph_number <= folded:
+                # already folded, the node ran again
+                return
+            if paragraph_number != folded + 1:
+                # the earlier paragraphs were not folded here: the unit is summarized when it ends
+                self.summaries.pop(key, None)
+                return
+            future = asyncio.run_coroutine_threadsafe(
+                self._fold(previous, chain, prompt_values, paragraph_number, background_config(config, "unit_summary")), get_event_loop())
+            self.summaries[key] = (paragraph_number, future)
+            self.summaries.move_to_end(key)
+            self.folds += 1
+            while len(self.summaries) > self.max_summaries:
+                dropped.append(self.summaries.popitem(last=False)[1][1])
+        for future in dropped:
+            future.cancel()
+
+    def _take(self, thread_id, unit_number, paragraphs):
+        with self.lock:
+            folded, future = self.summaries.pop((thread_id, unit_number), (0, None))
+            if future is None or folded != paragraphs:
+                self.misses += 1
+                future, stale = None, future
+            else:
+                stale = None
+        if stale is not None:
+            stale.cancel()
+        return future
+
+    def _result(self, future, waited):
+        try:
+            summary = future.result()
+        except Exception as error:
+            logger.warning("running summary failed: %s", error)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.wait_seconds += waited
+        return summary
+
+    def take(self, thread_id, unit_number, paragraphs):
+        """
+        Return the running summary of a finished unit, waiting for its last fold if needed.
+
+        Args:
+            thread_id (str): thread of the story
+            unit_number (int): number of the unit in the story
+            paragraphs (int): number of paragraphs accepted in the unit
+
+        Returns:
+            str: the summary, None if the unit was not folded up to its last paragraph
+        """
+        future = self._take(thread_id, unit_number, paragraphs)
+        if future is None:
+            return None
+        start = time.perf_counter()
+        try:
+            future.result()
+        except Exception:
+            pass
+        return self._result(future, time.perf_counter() - start)
+
+    async def atake(self, thread_id, unit_number, paragraphs):
+        """Async version of take."""
+        future = self._take(thread_id, unit_number, paragraphs)
+        if future is None:
+            return None
+        start = time.perf_counter()
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            pass
+        return self._result(future, time.perf_counter() - start)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": RUNNING_SUMMARY,
+                "folds": self.folds,
+                "units_summarized": self.hits,
+                "units_without_summary": self.misses,
+                "in_progress": len(self.summaries),
+                "wait_ms_mean": round(self.wait_seconds / self.hits * 1000, 1) if self.hits else None,
+            }
+
+
+running_summaries = RunningSummaries()
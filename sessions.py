@@ -0,0 +1,101 @@
+import os
+import time
+import threading
+from uuid import uuid4
+from collections import OrderedDict
+
+# at most this many threads are kept, the least recently used are evicted first
+MAX_THREADS = int(os.getenv("INKREALLM_MAX_THREADS", 100))
+# threads idle for longer than this (in seconds) are evicted
+THREAD_TTL_SECONDS = float(os.getenv("INKREALLM_THREAD_TTL", 6 * 60 * 60))
+# the checkpoint bytes of the live threads shown by stats() are measured again after this many seconds
+SIZE_REFRESH_SECONDS = 60
+
+
+class SessionRegistry:
+    """
+    Registry of the graph threads of the writing sessions served by this process.
+
+    Every session gets its own thread id. The threads idle for longer than <ttl_seconds>
+    and, above <max_threads>, the least recently used ones are deleted from the checkpointer.
+
+    Args:
+        checkpointer: the checkpointer the graphs were compiled with (needs delete_thread)
+        max_threads (int): maximum number of live threads
+        ttl_seconds (float): maximum idle time of a thread
+        on_evict (callable): called with the id of every evicted thread
+    """
+
+    def __init__(self, checkpointer, max_threads=MAX_THREADS, ttl_seconds=THREAD_TTL_SECONDS, on_evict=None):
+        self.checkpointer = checkpointer
+        self.on_evict = on_evict
+        self.max_threads = max_threads
+        self.ttl_seconds = ttl_seconds
+        # thread id -> last time it was used, least recently used first
+        self.threads = OrderedDict()
+        self.evicted = 0
+        # (time measured, checkpoint bytes of the live threads)
+        self._checkpoint_bytes = None
+        self.lock = threading.Lock()
+        # threads saved by a previous process can still be resumed until they expire
+        if hasattr(checkpointer, "thread_ids"):
+            now = time.monotonic()
+            for thread_id in checkpointer.thread_ids():
+                self.threads[thread_id] = now
+        self.evict()
+
+    def new_thread(self):
+        thread_id = str(uuid4())
+        self.touch(thread_id)
+        return thread_id
+
+    def is_live(self, thread_id):
+        with self.lock:
+            return thread_id in self.threads
+
+    def touch(self, thread_id):
+        """Mark the thread as used now and evict the idle ones."""
+        with self.lock:
+            self.threads[thread_id] = time.monotonic()
+            self.threads.move_to_end(thread_id)
+        self.evict()
+
+    def evict(self):
+        """Delete the expired threads and the least recently used ones above max_threads."""
+        to_delete = []
+        with self.lock:
+            now = time.monotonic()
+            while self.threads:
+                thread_id, last_used = next(iter(self.threads.items()))
+                if len(self.threads) > self.max_threads or now - last_used > self.ttl_seconds:
+                    self.threads.pop(thread_id)
+                    to_delete.append(thread_id)
+                else:
+                    break
+            self.evicted += len(to_delete)
+        for thread_id in to_delete:
+            self.checkpointer.delete_thread(thread_id)
+            if self.on_evict is not None:
+                self.on_evict(thread_id)
+        return to_delete
+
+    def stats(self, refresh=False):
+        """
+        Live and evicted threads and the checkpoint bytes of the live threads.
+
+        The bytes are measured (an SQLite query on the live threads only) at most every
+        SIZE_REFRESH_SECONDS, or when <refresh> is set: stats() is rendered on every rerun.
+        """
+        with self.lock:
+            live_threads = list(self.threads)
+            evicted = self.evicted
+            cached = self._checkpoint_bytes
+        stats = {"live_threads": len(live_threads), "evicted_threads": evicted}
+        if hasattr(self.checkpointer, "thread_sizes"):
+            if refresh or cached is None or time.monotonic() - cached[0] > SIZE_REFRESH_SECONDS:
+                sizes = self.checkpointer.thread_sizes(live_threads)
+                cached = (time.monotonic(), sum(sizes.get(thread_id, 0) for thread_id in live_threads))
+                with self.lock:
+                    self._checkpoint_bytes = cached
+            stats["checkpoint_bytes"] = cached[1]
+        return stats
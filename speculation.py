@@ -0,0 +1,144 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from background_loop import get_event_loop, background_config
+from story_context import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# write the next paragraph while the author reads the current one (opt-in, it costs tokens)
+SPECULATIVE_WRITING = os.getenv("INKREALLM_SPECULATIVE", "0") == "1"
+# speculations of abandoned sessions are dropped above this number
+MAX_SPECULATIONS = 256
+
+
+class SpeculativeWriter:
+    """
+    Paragraphs written ahead of time, keyed by the id of the draft the author is reviewing.
+
+    When a draft is shown, the next paragraph is requested in the background as if the
+    draft was accepted. If the author accepts it, the writer finds the request already
+    running (or finished) with the same prompt and uses its response. If the author asks
+    for a rewrite, the request is cancelled and its tokens are counted as wasted.
+    """
+
+    def __init__(self, max_speculations=MAX_SPECULATIONS):
+        self.max_speculations = max_speculations
+        # draft id -> (prompt values, prompt tokens, future of the response)
+        self.speculations = OrderedDict()
+        self.lock = threading.Lock()
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0
+        self.wasted_tokens = 0
+
+    def start(self, draft_id, chain, prompt_values, prompt_tokens, config=None):
+        """
+        Request the next paragraph in the background, as if the draft <draft_id> was accepted.
+
+        The request runs with the callbacks and the thread of the node run <config>, reported
+        as the speculative_paragraph node, and a priority below the calls of the run, so the
+        calls the author waits for get the provider slots first.
+        """
+        config = background_config(config, "speculative_paragraph", priority_offset=-1)
+        future = asyncio.run_coroutine_threadsafe(chain.ainvoke(prompt_values, config), get_event_loop())
+        with self.lock:
+            self.speculations[draft_id] = (prompt_values, prompt_tokens, future)
+            self.started += 1
+            dropped = []
+            while len(self.speculations) > self.max_speculations:
+                dropped.append(self.speculations.popitem(last=False)[1])
+        for speculation in dropped:
+            self._waste(speculation)
+
+    def _waste(self, speculation):
+        _, prompt_tokens, future = speculation
+        future.cancel()
+        tokens = prompt_tokens
+        if future.done() and not future.cancelled() and future.exception() is None:
+            response = future.result()
+            usage = getattr(response, "usage_metadata", None)
+            tokens = usage["total_tokens"] if usage else prompt_tokens + count_tokens(str(response.content))
+        with self.lock:
+            self.wasted_tokens += tokens
+
+    def discard(self, draft_id):
+        """The author did not accept the draft: cancel the speculation made for it."""
+        with self.lock:
+            speculation = self.speculations.pop(draft_id, None)
+            if speculation is not None:
+                self.cancelled += 1
+        if speculation is not None:
+            self._waste(speculation)
+
+    def _take(self, draft_id, prompt_values):
+        with self.lock:
+            speculation = self.speculations.pop(draft_id, None)
+        if speculation is None:
+            return None
+        if speculation[0] != prompt_values:
+            # the state changed since the speculation was made (e.g. the characters were edited)
+            with self.lock:
+                self.misses += 1
+            self._waste(speculation)
+            return None
+        return speculation[2]
+
+    def _hit(self, future):
+        try:
+            response = future.result()
+        except Exception as error:
+            logger.warning("speculative paragraph failed: %s", error)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return response
+
+    def take(self, draft_id, prompt_values):
+        """
+        Return the response written ahead for the accepted draft <draft_id>.
+
+        Args:
+            draft_id (str): id of the accepted draft
+            prompt_values (dict): the prompt values of the writer for the current state
+
+        Returns:
+            the LLM response, None if there is no speculation for these prompt values
+        """
+        future = self._take(draft_id, prompt_values)
+        if future is None:
+            return None
+        return self._hit(future)
+
+    async def atake(self, draft_id, prompt_values):
+        """Async version of take."""
+        future = self._take(draft_id, prompt_values)
+        if future is None:
+            return None
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            pass
+        return self._hit(future)
+
+    def stats(self):
+        with self.lock:
+            finished = self.hits + self.misses + self.cancelled
+            return {
+                "enabled": SPECULATIVE_WRITING,
+                "started": self.started,
+                "hits": self.hits,
+                "misses": self.misses,
+                "cancelled": self.cancelled,
+                "in_flight": len(self.speculations),
+                "hit_rate": round(self.hits / finished, 3) if finished else None,
+                "wasted_tokens": self.wasted_tokens,
+            }
+
+
+speculative_writer = SpeculativeWriter()
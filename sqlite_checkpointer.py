@@ -0,0 +1,451 @@
+import os
+import random
+import hashlib
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from langchain_core.messages import BaseMessage
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+# store every message once, by the digest of its bytes, and only the digests in the checkpoints
+INTERN_MESSAGES = os.getenv("INKREALLM_INTERN_MESSAGES", "1") == "1"
+# messages serialized in fewer bytes are kept inline (a reference costs 59 bytes)
+INTERN_MIN_BYTES = 128
+# interned messages kept in memory for the reads, the least recently used are dropped first
+INTERN_CACHE_SIZE = 4096
+# threads whose stored digests are remembered, the least recently written are dropped first
+# (a dropped thread inserts its messages again, the rows already stored are ignored)
+INTERN_KNOWN_THREADS = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    type TEXT NOT NULL,
+    blob BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT,
+    value BLOB,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE TABLE IF NOT EXISTS interned (
+    digest BLOB PRIMARY KEY,
+    type TEXT NOT NULL,
+    blob BLOB
+);
+CREATE TABLE IF NOT EXISTS interned_refs (
+    thread_id TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (thread_id, digest)
+);
+"""
+
+
+@dataclass(frozen=True)
+class Interned:
+    """Reference to a message of the interned table, in place of the message in a serialized value."""
+    digest: bytes
+
+
+class SqliteCheckpointer(BaseCheckpointSaver):
+    """
+    Checkpoint saver that keeps the checkpoints in a SQLite file.
+
+    Works as a drop-in replacement of MemorySaver in compile(checkpointer=...).
+    Like MemorySaver, the channel values are stored once per channel version, so a
+    checkpoint only adds the channels that changed. Nothing is kept in memory except
+    the writes of the running super-step: they are buffered and written together with
+    the next checkpoint in one transaction (or before any read).
+
+    With <intern_messages>, the messages in the channel values and in the writes are
+    content-addressed: every message is stored once in the interned table, keyed by the
+    digest of its serialized bytes, and the stored values only hold the digests. A
+    paragraph kept in story_content, actual_unit and temp_messages, of the parent graph
+    and of the subgraph, in every checkpoint after it was written, is then stored once.
+    The digests are resolved when a checkpoint is read: a message is fetched and
+    deserialized the first time it is needed, then copied from an LRU cache.
+
+    Args:
+        path (str): the SQLite file, created if it does not exist
+        intern_messages (bool): store the messages once, by digest
+    """
+
+    def __init__(self, path, *, serde=None, intern_messages=INTERN_MESSAGES):
+        super().__init__(serde=serde)
+        self.path = path
+        self.intern_messages = intern_messages
+        # thread id -> digests already stored and referenced by the thread, least recently written first
+        self._thread_digests = OrderedDict()
+        # digest -> message, the interned messages read last
+        self._interned_cache = OrderedDict()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            # keep the page cache small and constant (8 MB)
+            self.conn.execute("PRAGMA cache_size=-8000")
+            self.conn.executescript(SCHEMA)
+        self._pending_writes = []
+        # (thread id, interned messages) of the buffered writes
+        self._pending_interned = []
+
+    def _flush(self):
+        """Write the buffered writes of the current super-step."""
+        if not self._pending_writes:
+            return
+        for thread_id, interned in self._pending_interned:
+            self._store_interned(thread_id, interned)
+        self._pending_interned = []
+        # like MemorySaver: a task write is saved once, the special writes (errors, interrupts) are replaced
+        for conflict, rows in (("IGNORE", [row for row in self._pending_writes if row[4] >= 0]),
+                               ("REPLACE", [row for row in self._pending_writes if row[4] < 0])):
+            self.conn.executemany(
+                f"INSERT OR {conflict} INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value, task_path) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        self._pending_writes = []
+
+    def flush(self):
+        with self.lock:
+            if not self._pending_writes:
+                return
+            self.conn.execute("BEGIN")
+            try:
+                self._flush()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                # the interned messages of the transaction were not stored
+                self._thread_digests.clear()
+                raise
+
+    def _intern(self, value, interned):
+        """<value> with its messages replaced by Interned references, the messages added to <interned>."""
+        if isinstance(value, BaseMessage):
+            type_, blob = self.serde.dumps_typed(value)
+            if len(blob) < INTERN_MIN_BYTES:
+                return value
+            digest = hashlib.blake2b(blob, digest_size=16).digest()
+            interned[digest] = (type_, blob)
+            return Interned(digest)
+        if isinstance(value, list):
+            return [self._intern(item, interned) for item in value]
+        if isinstance(value, dict):
+            return {key: self._intern(item, interned) for key, item in value.items()}
+        return value
+
+    def _dumps(self, value, interned):
+        """Serialize a channel value or a write, interning its messages into <interned>."""
+        if self.intern_messages:
+            value = self._intern(value, interned)
+        return self.serde.dumps_typed(value)
+
+    def _store_interned(self, thread_id, interned):
+        """Insert the interned messages not yet stored for the thread (in the open transaction)."""
+        known = self._thread_digests.get(thread_id)
+        if known is None:
+            known = self._thread_digests[thread_id] = set()
+            if len(self._thread_digests) > INTERN_KNOWN_THREADS:
+                self._thread_digests.popitem(last=False)
+        else:
+            self._thread_digests.move_to_end(thread_id)
+        new = [(digest, type_, blob) for digest, (type_, blob) in interned.items() if digest not in known]
+        if not new:
+            return
+        self.conn.executemany("INSERT OR IGNORE INTO interned (digest, type, blob) VALUES (?, ?, ?)", new)
+        self.conn.executemany("INSERT OR IGNORE INTO interned_refs (thread_id, digest) VALUES (?, ?)",
+                              [(thread_id, digest) for digest, _, _ in new])
+        known.update(digest for digest, _, _ in new)
+
+    def _interned_message(self, digest):
+        """A copy of the interned message <digest>, deserialized on first use and kept in the LRU cache."""
+        message = self._interned_cache.get(digest)
+        if message is None:
+            type_, blob = self.conn.execute("SELECT type, blob FROM interned WHERE digest = ?", (digest,)).fetchone()
+            message = self._interned_cache[digest] = self.serde.loads_typed((type_, blob))
+            if len(self._interned_cache) > INTERN_CACHE_SIZE:
+                self._interned_cache.popitem(last=False)
+        else:
+            self._interned_cache.move_to_end(digest)
+        # the cached message is never handed out, a node could change it
+        return message.model_copy()
+
+    def _resolve(self, value):
+        if isinstance(value, Interned):
+            return self._interned_message(value.digest)
+        if isinstance(value, list):
+            return [self._resolve(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self._resolve(item) for key, item in value.items()}
+        return value
+
+    def _loads(self, type_, blob):
+        """Deserialize a channel value or a write, resolving its Interned references."""
+        value = self.serde.loads_typed((type_, blob))
+        if type_ == "empty" or b"Interned" not in blob:
+            return value
+        return self._resolve(value)
+
+    def _load_blobs(self, thread_id, checkpoint_ns, versions):
+        channel_values = {}
+        for channel, version in versions.items():
+            row = self.conn.execute(
+                "SELECT type, blob FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, str(version)),
+            ).fetchone()
+            if row and row[0] != "empty":
+                channel_values[channel] = self._loads(row[0], row[1])
+        return channel_values
+
+    def _load_writes(self, thread_id, checkpoint_ns, checkpoint_id):
+        rows = self.conn.execute(
+            "SELECT task_id, channel, type, value FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return [(task_id, channel, self._loads(type_, value)) for task_id, channel, type_, value in rows]
+
+    def _make_tuple(self, thread_id, checkpoint_ns, row):
+        checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        checkpoint = self.serde.loads_typed((type_, checkpoint))
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint={
+                **checkpoint,
+                "channel_values": self._load_blobs(thread_id, checkpoint_ns, checkpoint["channel_versions"]),
+            },
+            metadata=self._loads(metadata_type, metadata),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id else None
+            ),
+            pending_writes=self._load_writes(thread_id, checkpoint_ns, checkpoint_id),
+        )
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        with self.lock:
+            self.flush()
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self.conn.execute(
+                    "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints "
+                    "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = self.conn.execute(
+                    "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints "
+                    "WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+            if row is None:
+                return None
+            return self._make_tuple(thread_id, checkpoint_ns, row)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+                 "FROM checkpoints")
+        conditions, parameters = [], []
+        if config:
+            conditions.append("thread_id = ?")
+            parameters.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                conditions.append("checkpoint_ns = ?")
+                parameters.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id = ?")
+                parameters.append(checkpoint_id)
+        if before and (before_checkpoint_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id < ?")
+            parameters.append(before_checkpoint_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY checkpoint_id DESC"
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute(query, parameters).fetchall()
+        for thread_id, checkpoint_ns, *row in rows:
+            if limit is not None and limit <= 0:
+                break
+            with self.lock:
+                checkpoint_tuple = self._make_tuple(thread_id, checkpoint_ns, row)
+            if filter and not all(checkpoint_tuple.metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            yield checkpoint_tuple
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        checkpoint = checkpoint.copy()
+        values = checkpoint.pop("channel_values")
+        blobs = []
+        interned = {}
+        for channel, version in new_versions.items():
+            type_, blob = self._dumps(values[channel], interned) if channel in values else ("empty", b"")
+            blobs.append((thread_id, checkpoint_ns, channel, str(version), type_, blob))
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        # the metadata has the writes of the step, with the messages the nodes returned
+        metadata_type, serialized_metadata = self._dumps(get_checkpoint_metadata(config, metadata), interned)
+        with self.lock:
+            # one transaction per super-step: its writes, the new channel values and the checkpoint
+            self.conn.execute("BEGIN")
+            try:
+                self._flush()
+                self._store_interned(thread_id, interned)
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO blobs (thread_id, checkpoint_ns, channel, version, type, blob) VALUES (?, ?, ?, ?, ?, ?)",
+                    blobs,
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, "
+                    "type, checkpoint, metadata_type, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                     type_, serialized_checkpoint, metadata_type, serialized_metadata),
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                # the interned messages of the transaction were not stored
+                self._thread_digests.clear()
+                raise
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        interned = {}
+        for idx, (channel, value) in enumerate(writes):
+            type_, blob = self._dumps(value, interned)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx),
+                         channel, type_, blob, task_path))
+        with self.lock:
+            self._pending_interned.append((thread_id, interned))
+            self._pending_writes.extend(rows)
+
+    def delete_thread(self, thread_id):
+        with self.lock:
+            self.flush()
+            self.conn.execute("BEGIN")
+            try:
+                for table in ("checkpoints", "blobs", "writes"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+                # the messages of the thread that no other thread references
+                digests = [row[0] for row in self.conn.execute(
+                    "SELECT digest FROM interned_refs WHERE thread_id = ?", (thread_id,))]
+                self.conn.execute("DELETE FROM interned_refs WHERE thread_id = ?", (thread_id,))
+                self.conn.executemany(
+                    "DELETE FROM interned WHERE digest = ? AND NOT EXISTS (SELECT 1 FROM interned_refs WHERE digest = ?)",
+                    [(digest, digest) for digest in digests])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self._thread_digests.pop(thread_id, None)
+
+    def thread_ids(self):
+        """The ids of all the threads that have checkpoints."""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT DISTINCT thread_id FROM checkpoints")]
+
+    def thread_sizes(self, thread_ids=None):
+        """
+        Bytes of checkpoint state (checkpoints, channel values, writes and interned messages) stored for every thread.
+
+        Args:
+            thread_ids (list): the threads to measure (found through the thread_id primary keys),
+                None for every thread of the database (a scan of all the tables)
+
+        Returns:
+            dict: thread id -> bytes
+        """
+        if thread_ids is None:
+            groups = [None]
+        else:
+            thread_ids = list(thread_ids)
+            # at most 500 parameters per query, below the SQLite limit
+            groups = [thread_ids[start:start + 500] for start in range(0, len(thread_ids), 500)]
+        sizes = {}
+        with self.lock:
+            self.flush()
+            for group in groups:
+                where = "" if group is None else " WHERE {} IN (" + ", ".join("?" * len(group)) + ")"
+                rows = self.conn.execute(
+                    "SELECT thread_id, SUM(size) FROM ("
+                    "SELECT thread_id, LENGTH(checkpoint) + LENGTH(metadata) AS size FROM checkpoints"
+                    + where.format("thread_id") +
+                    " UNION ALL SELECT thread_id, LENGTH(blob) FROM blobs" + where.format("thread_id") +
+                    " UNION ALL SELECT thread_id, LENGTH(value) FROM writes" + where.format("thread_id") +
+                    " UNION ALL SELECT interned_refs.thread_id, LENGTH(interned.blob) FROM interned_refs "
+                    "JOIN interned ON interned.digest = interned_refs.digest" + where.format("interned_refs.thread_id") +
+                    ") GROUP BY thread_id",
+                    [] if group is None else group * 4,
+                ).fetchall()
+                sizes.update({thread_id: size or 0 for thread_id, size in rows})
+        return sizes
+
+    # the async versions run the sync ones in a worker thread, so the event loop is not blocked by SQLite
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        checkpoint_tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint_tuple in checkpoint_tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def get_next_version(self, current, channel):
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
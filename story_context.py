@@ -0,0 +1,132 @@
+import os
+import re
+import logging
+from collections import deque
+from structure_index import get_structure_index
+
+logger = logging.getLogger(__name__)
+
+# how many of the latest paragraphs are sent verbatim to the writer
+RECENT_PARAGRAPHS = int(os.getenv("INKREALLM_CONTEXT_PARAGRAPHS", 3))
+# token budget for the story context (summary + earlier paragraphs + related passages + recent paragraphs + current unit)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("INKREALLM_CONTEXT_TOKENS", 3000))
+
+# prompt tokens of the latest calls: {"node", "prompt_tokens", "paragraphs"}
+prompt_token_log = deque(maxlen=1000)
+
+_encoding = None
+
+def count_tokens(text):
+    """
+    Count the tokens of a text with the gpt-4o tokenizer.
+    Falls back to an estimate (4 characters per token) when tiktoken cannot be loaded.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False
+    if _encoding is False:
+        return (len(text) + 3) // 4
+    return len(_encoding.encode(text, disallowed_special=()))
+
+def first_sentence(text):
+    match = re.match(r"\s*(.+?[.!?])(\s|$)", text, re.DOTALL)
+    return (match.group(1) if match else text).strip()
+
+def find_unit(story_structured_info, unit_name):
+    """
+    Return the entry of the unit with the given name from the story structure, as text.
+
+    Args:
+        story_structured_info (dict): the structure created by story_structure_creator
+        unit_name (str): name of the unit being written
+
+    Returns:
+        str: the unit entry, or the whole structure if the unit cannot be found
+    """
+    unit = get_structure_index(story_structured_info).unit(unit_name)
+    return str(unit) if unit is not None else str(story_structured_info)
+
+def build_paragraph_context(state, passages=(), recent_paragraphs=RECENT_PARAGRAPHS, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """
+    Build a bounded context for the paragraph writer nodes.
+
+    The context is made of the running summary of the previous units, the first sentence of
+    the earlier paragraphs of the current unit, the passages of the story related to the
+    current unit, the last <recent_paragraphs> paragraphs verbatim and the current unit's entry
+    from the story structure. When it does not fit in <max_tokens>, the earlier paragraphs,
+    then the related passages, then the recent ones (down to one) and then the oldest part of
+    the summary are dropped.
+
+    Args:
+        state (StoryWriterSubgraphState): the story writer state
+        passages (list): related passages of the story, in story order (see passage_index.py)
+        recent_paragraphs (int): number of paragraphs sent verbatim
+        max_tokens (int): token budget for the context
+
+    Returns:
+        dict: story_summary, unit_so_far, related_passages, story_content and current_unit prompt values
+    """
+    story_content = [element.content for element in state.get("story_content", [])]
+    actual_unit = state.get("actual_unit", [])
+    unit_name = actual_unit[0].content if len(actual_unit) > 0 else ""
+
+    recent = story_content[-recent_paragraphs:] if recent_paragraphs > 0 else []
+    earlier = story_content[:len(story_content) - len(recent)]
+    # the first element of story_content is the unit header (previous unit summary & title)
+    earlier_sentences = [first_sentence(paragraph) for paragraph in earlier[1:]]
+    summary_lines = [line for line in state.get("story_summary", "").split("\n") if line.strip()]
+    # a retrieved unit summary is already in the story summary
+    passages = [passage for passage in passages if passage not in summary_lines]
+    current_unit = find_unit(state.get("story_structured_info", {}), unit_name)
+
+    # count every piece once and drop pieces until the context fits
+    total = count_tokens(current_unit)
+    parts = [summary_lines, earlier_sentences, recent, passages]
+    sizes = [[count_tokens(piece) for piece in part] for part in parts]
+    total += sum(sum(part_sizes) for part_sizes in sizes)
+    while total > max_tokens:
+        if earlier_sentences:
+            earlier_sentences.pop(0)
+            total -= sizes[1].pop(0)
+        elif passages:
+            passages.pop(0)
+            total -= sizes[3].pop(0)
+        elif len(recent) > 1:
+            recent.pop(0)
+            total -= sizes[2].pop(0)
+        elif len(summary_lines) > 1:
+            summary_lines.pop(0)
+            total -= sizes[0].pop(0)
+        else:
+            break
+
+    return {
+        "story_summary": "\n".join(summary_lines) if summary_lines else "This is the first unit.",
+        "unit_so_far": " ".join(earlier_sentences) if earlier_sentences else "-",
+        "related_passages": "\n\n".join(passages) if passages else "-",
+        "story_content": "\n\n".join(recent),
+        "current_unit": current_unit,
+    }
+
+def record_prompt_tokens(node, prompt, paragraphs, saved_tokens=0):
+    """
+    Count the tokens of a rendered prompt and keep them in prompt_token_log.
+
+    Args:
+        node (str): the node that sends the prompt
+        prompt (str): the rendered prompt
+        paragraphs (int): number of paragraphs written so far in the unit
+        saved_tokens (int): tokens left out of the prompt (the records of the characters not mentioned)
+
+    Returns:
+        int: the number of prompt tokens
+    """
+    prompt_tokens = count_tokens(prompt)
+    prompt_token_log.append({"node": node, "prompt_tokens": prompt_tokens, "paragraphs": paragraphs,
+                             "saved_tokens": saved_tokens})
+    logger.info("%s prompt: %s tokens, %s saved (%s paragraphs written)", node, prompt_tokens, saved_tokens, paragraphs)
+    return prompt_tokens
@@ -0,0 +1,235 @@
+import os
+import threading
+from collections import OrderedDict
+from structured_output import STRUCTURED_OUTPUT_KEY
+
+# accepted paragraphs rendered together in one markdown element of the story panel
+PARAGRAPHS_PER_BLOCK = int(os.getenv("INKREALLM_PARAGRAPHS_PER_BLOCK", 20))
+# older chat messages rendered together in one markdown element of the history panel
+MESSAGES_PER_BLOCK = int(os.getenv("INKREALLM_MESSAGES_PER_BLOCK", 20))
+# characters / structure messages whose markdown is kept, per process
+MARKDOWN_CACHE_SIZE = int(os.getenv("INKREALLM_MARKDOWN_CACHE_SIZE", 256))
+
+# (panel, message id) -> markdown, least recently used first
+_markdown_cache = OrderedDict()
+_markdown_cache_lock = threading.Lock()
+
+
+def generate_dynamic_markdown(data):
+    lines = ["### Character Information\n"]
+
+    # Find the key containing the list of characters dynamically
+    characters_key = next((key for key, value in data.items() if isinstance(value, list)), None)
+    if not characters_key:
+        return "No character data found."
+
+    # Process each character in the dynamically found list
+    for char in data[characters_key]:
+        # Dynamically find the 'character_attributes' key
+        attributes_key = next((key for key in char if isinstance(char[key], dict)), None)
+        if not attributes_key:
+            continue  # Skip this character if 'character_attributes' is not found
+
+        attributes = char[attributes_key]
+
+        # Dynamically extract the character's name (if it exists)
+        name = attributes.get("name", "Unknown")
+        lines.append(f"## {name}")
+
+        # Iterate through the character's attributes
+        for key, value in attributes.items():
+            # Handle nested dictionaries (e.g., 'appearance') and lists (e.g., 'skills')
+            if isinstance(value, dict):
+                lines.append(f"- **{key.replace('_', ' ').capitalize()}**:")
+                for sub_key, sub_value in value.items():
+                    lines.append(f"  - {sub_key.replace('_', ' ').capitalize()}: {sub_value}")
+            elif isinstance(value, list):
+                lines.append(f"- **{key.replace('_', ' ').capitalize()}**: {', '.join(value)}")
+            else:
+                lines.append(f"- **{key.replace('_', ' ').capitalize()}**: {value}")
+        lines.append("")  # Add spacing between characters
+
+    return "\n".join(lines) + "\n"
+
+
+def generate_dynamic_markdown_story(data):
+    """
+    Generate a Markdown representation of writing units from a structured dictionary.
+
+    Args:
+        data (dict): A dictionary containing unit information
+
+    Returns:
+        str: A Markdown-formatted string describing the writing's units
+    """
+
+    parts = ["### Character Information\n\n"]
+    # Find the key containing the list of units dynamically
+    units_key = next((key for key, value in data.items() if isinstance(value, list)), None)
+    if not units_key:
+        return "No unit data found."
+
+    # Process each chapter in the dynamically found list
+    for index, unit in enumerate(data[units_key], 1):
+        # Extract chapter details
+        chapter_name = unit.get('unit_name', f'Chapter {index}')
+        chapter_length = unit.get('unit_length', 'Unknown length')
+        chapter_summary = unit.get('unit_summary', 'No summary available')
+
+        # Create Markdown for each chapter
+        parts.append(f"## {chapter_name}\n\n**Length:** {chapter_length}\n\n**Summary:** {chapter_summary}\n\n")
+
+    return "".join(parts)
+
+
+def _cached_markdown(panel, data, message, render):
+    if not data:
+        return None
+    # the structured message showing <data> in the chat identifies it from one rerun to the next
+    if message is None or message.id is None or not message.additional_kwargs.get(STRUCTURED_OUTPUT_KEY):
+        return render(data)
+    key = (panel, message.id)
+    with _markdown_cache_lock:
+        if key in _markdown_cache:
+            _markdown_cache.move_to_end(key)
+            return _markdown_cache[key]
+    markdown = render(data)
+    with _markdown_cache_lock:
+        _markdown_cache[key] = markdown
+        while len(_markdown_cache) > MARKDOWN_CACHE_SIZE:
+            _markdown_cache.popitem(last=False)
+    return markdown
+
+
+def characters_markdown(data, message=None):
+    """
+    Markdown of the characters panel, rendered once per structured message showing the
+    characters in the chat (the reruns showing the same message hit the cache).
+
+    Args:
+        data (dict): character_structured_info
+        message: the last message of the character supervisor
+
+    Returns:
+        str: the markdown of the characters, None if there are no characters yet
+    """
+    return _cached_markdown("characters", data, message, generate_dynamic_markdown)
+
+
+def structure_markdown(data, message=None):
+    """Markdown of the story structure panel (story_structured_info), rendered once per structured message showing it."""
+    return _cached_markdown("structure", data, message, generate_dynamic_markdown_story) or ""
+
+
+class StoryView:
+    """
+    Incremental markdown of the story content panel.
+
+    The accepted paragraphs are only appended to story_content, so the view keeps the
+    markdown of the paragraphs already rendered, grouped in blocks of <block_size>
+    paragraphs, and only renders the new ones. The blocks that are complete never change,
+    so the elements showing them are the same from one rerun to the next. When
+    story_content is not an extension of what was rendered (another thread, a rewritten
+    history) the view is rebuilt.
+
+    Args:
+        block_size (int): paragraphs per markdown block
+    """
+
+    def __init__(self, block_size=PARAGRAPHS_PER_BLOCK):
+        self.block_size = block_size
+        self.ids = []
+        self.blocks = []
+        self.open_block = []
+
+    def _extends(self, story_content):
+        # the ids of the first and of the last rendered paragraphs are enough to tell
+        # an appended paragraph from another story
+        if len(story_content) < len(self.ids):
+            return False
+        if not self.ids:
+            return True
+        return story_content[0].id == self.ids[0] and story_content[len(self.ids) - 1].id == self.ids[-1]
+
+    def update(self, story_content):
+        """
+        Render the paragraphs of story_content that are not rendered yet.
+
+        Args:
+            story_content (list): the story_content messages of the graph state
+
+        Returns:
+            list: the markdown blocks of the whole story
+        """
+        if not self._extends(story_content):
+            self.__init__(self.block_size)
+        for message in story_content[len(self.ids):]:
+            self.ids.append(message.id)
+            self.open_block.append(message.content)
+            if len(self.open_block) == self.block_size:
+                self.blocks.append("\n\n".join(self.open_block))
+                self.open_block = []
+        return self.blocks + (["\n\n".join(self.open_block)] if self.open_block else [])
+
+
+class HistoryView:
+    """
+    Incremental chat history of the active message list (messages, temp_messages).
+
+    The messages are only appended to the list (a draft echoed back replaces the last
+    message), so the view converts only the messages added since the last update. The
+    older messages are grouped in complete blocks of <block_size> messages, each kept as
+    one markdown text that never changes; only the messages of the latest block are
+    shown as chat messages. When the list is not an extension of what was converted
+    (another subgraph, another thread) the view is rebuilt.
+
+    Args:
+        block_size (int): messages per markdown block
+    """
+
+    def __init__(self, block_size=MESSAGES_PER_BLOCK):
+        self.block_size = block_size
+        self.ids = []
+        self.blocks = []
+        self.open_block = []
+
+    def _extends(self, messages):
+        if len(messages) < len(self.ids):
+            return False
+        if not self.ids:
+            return True
+        return messages[0].id == self.ids[0] and messages[len(self.ids) - 1].id == self.ids[-1]
+
+    @staticmethod
+    def _entry(message):
+        return {"role": "user" if message.type == "human" else "assistant", "content": message.content, "id": message.id}
+
+    @staticmethod
+    def _block_markdown(entries):
+        return "\n\n".join(f"**{'You' if entry['role'] == 'user' else 'InkreaLLM'}:** {entry['content']}"
+                             for entry in entries if entry["content"])
+
+    def update(self, messages):
+        """
+        Convert the messages that are not converted yet.
+
+        Args:
+            messages (list): the active message list of the graph state
+
+        Returns:
+            tuple: the markdown blocks of the older messages and the {"role", "content", "id"}
+                entries of the latest messages
+        """
+        messages = [message for message in messages if hasattr(message, "content")]
+        if not self._extends(messages) or any(message.id is None for message in messages[len(self.ids):]):
+            self.__init__(self.block_size)
+        elif self.open_block:
+            # the last message can be replaced by its echo (same id, new content)
+            self.open_block[-1] = self._entry(messages[len(self.ids) - 1])
+        for message in messages[len(self.ids):]:
+            self.ids.append(message.id)
+            self.open_block.append(self._entry(message))
+            if len(self.open_block) == self.block_size:
+                self.blocks.append(self._block_markdown(self.open_block))
+                self.open_block = []
+        return self.blocks, self.open_block
@@ -0,0 +1,119 @@
+import re
+import json
+import threading
+
+class StructureIndex:
+    """
+    Index over the units of a story structure (story_structured_info["units"]).
+
+    Keeps the ordered unit titles, their lengths parsed to integers and the position of
+    every title, so the next unit and the unit length are looked up locally.
+    An index built from a malformed structure (no list of units, units without a name
+    or a length, duplicated names) is not valid and the callers should fall back to the LLM.
+
+    Args:
+        story_structured_info (dict): the structure created by story_structure_creator
+    """
+
+    def __init__(self, story_structured_info):
+        self.units = []
+        self.titles = []
+        self.lengths = []
+        self.positions = {}
+        self.valid = False
+
+        units = self._find_units(story_structured_info)
+        if not units:
+            return
+        for unit in units:
+            if not isinstance(unit, dict):
+                return
+            title = str(unit.get("unit_name", "")).strip()
+            length = self._parse_length(unit.get("unit_length"))
+            if title == "" or length is None or title in self.positions:
+                return
+            self.positions[title] = len(self.titles)
+            self.units.append(unit)
+            self.titles.append(title)
+            self.lengths.append(length)
+        self.valid = True
+
+    @staticmethod
+    def _find_units(story_structured_info):
+        if not isinstance(story_structured_info, dict):
+            return None
+        if isinstance(story_structured_info.get("units"), list):
+            return story_structured_info["units"]
+        # the model can nest the structure (e.g. {"story_structure": {"units": [...]}})
+        # or use another key for the list of units
+        for value in story_structured_info.values():
+            if isinstance(value, list):
+                return value
+            if isinstance(value, dict):
+                units = StructureIndex._find_units(value)
+                if units:
+                    return units
+        return None
+
+    @staticmethod
+    def _parse_length(unit_length):
+        if isinstance(unit_length, int):
+            return unit_length
+        match = re.search(r"\d+", str(unit_length))
+        return int(match.group()) if match else None
+
+    def position(self, title):
+        """Position of the unit in the structure, None if the title is not in the structure."""
+        return self.positions.get(str(title).strip())
+
+    def next_unit(self, title=None):
+        """
+        Return the title of the unit after <title>.
+
+        Args:
+            title (str): the title of the current unit, None (or "no title") before the first unit
+
+        Returns:
+            str: the next title, "FINISH" after the last unit, None if the title is unknown
+        """
+        if title is None or str(title).strip() in ("", "no title"):
+            position = -1
+        else:
+            position = self.position(title)
+            if position is None:
+                return None
+        if position + 1 >= len(self.titles):
+            return "FINISH"
+        return self.titles[position + 1]
+
+    def unit_length(self, title):
+        """Length in paragraphs of the unit, 0 for FINISH, None if the title is unknown."""
+        if str(title).strip() in ("", "FINISH"):
+            return 0
+        position = self.position(title)
+        return self.lengths[position] if position is not None else None
+
+    def unit(self, title):
+        """The structure entry of the unit, None if the title is unknown."""
+        position = self.position(title)
+        return self.units[position] if position is not None else None
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+# the structure can be recreated by the user a few times, keep only the latest indexes
+MAX_INDEXES = 64
+
+def get_structure_index(story_structured_info):
+    """Return the (cached) StructureIndex of a story structure."""
+    try:
+        key = json.dumps(story_structured_info, sort_keys=True, default=str)
+    except (TypeError, ValueError):
+        return StructureIndex(story_structured_info)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            if len(_indexes) >= MAX_INDEXES:
+                _indexes.pop(next(iter(_indexes)))
+            index = _indexes[key] = StructureIndex(story_structured_info)
+        return index
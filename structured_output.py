@@ -0,0 +1,102 @@
+import json
+from langchain.schema import AIMessage
+
+# additional_kwargs key marking the messages whose content is the JSON of a structured output
+STRUCTURED_OUTPUT_KEY = "structured_output"
+
+# the list the renderers and the nodes read from the output of the structured chains:
+# chain -> (key of the list, keys every item needs, whether the list can be empty)
+EXPECTED_SHAPES = {
+    "character_description_creator": ("characters", ("name",), True),
+    "character_description_recreator": ("characters", ("name",), True),
+    "story_structure_creator": ("units", ("unit_name", "unit_length"), False),
+    "story_structure_recreator": ("units", ("unit_name", "unit_length"), False),
+}
+
+
+def _check_items(items, chain_name, key, required):
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            raise ValueError(f"{chain_name}: {key} item {number} is a {type(item).__name__}, expected a JSON object")
+        if key == "characters":
+            # {"character_attributes": {"name": ...}}: the characters panel reads the first object of the item
+            item = next((value for value in item.values() if isinstance(value, dict)), None)
+            if item is None:
+                raise ValueError(f"{chain_name}: character {number} has no attributes object")
+        missing = [field for field in required if not str(item.get(field) or "").strip()]
+        if missing:
+            raise ValueError(f"{chain_name}: {key} item {number} has no {', '.join(missing)}")
+
+
+def validate_structured_output(response, chain_name):
+    """
+    Check the parsed output of a structured chain (json_mode) before it is stored in the state.
+
+    The characters and the story structure must hold the list the characters and structure
+    panels and the nodes read (see EXPECTED_SHAPES); a list wrapped in one more object
+    (e.g. {"story_structure": {"units": [...]}}) is unwrapped and characters keyed by name
+    are turned into that list.
+
+    Args:
+        response: the output of the chain
+        chain_name (str): name of the chain, for the error message
+
+    Returns:
+        dict: the response, in the shape the renderers read
+
+    Raises:
+        ValueError: the response does not have the expected shape
+    """
+    if not isinstance(response, dict):
+        raise ValueError(f"{chain_name} returned a {type(response).__name__}, expected a JSON object")
+    if chain_name not in EXPECTED_SHAPES:
+        return response
+    key, required, can_be_empty = EXPECTED_SHAPES[chain_name]
+    while len(response) == 1 and key not in response and isinstance(next(iter(response.values())), dict):
+        response = next(iter(response.values()))
+    # the renderers take the first list of the object
+    items = next((value for value in response.values() if isinstance(value, list)), None)
+    by_name = response.get(key, response)
+    if items is None and key == "characters" and by_name and isinstance(by_name, dict) \
+            and all(isinstance(value, dict) for value in by_name.values()):
+        # {"characters": {name: attributes}} (the annotation of CharactersStructuredInfo is a dict)
+        response = {key: [{"character_attributes": {"name": name, **attributes}} for name, attributes in by_name.items()]}
+        items = response[key]
+    if items is None:
+        raise ValueError(f"{chain_name} returned no list of {key} (expected {{\"{key}\": [...]}}), "
+                         f"got the keys {list(response)}")
+    if not items and not can_be_empty:
+        raise ValueError(f"{chain_name} returned an empty list of {key}")
+    _check_items(items, chain_name, key, required)
+    return response
+
+
+def structured_message(response, id=None):
+    """
+    Message showing a structured output in the chat.
+
+    The content is the JSON text shown to the user and additional_kwargs only marks the
+    message as structured: the nodes store the object itself in its state key
+    (character_structured_info, story_structured_info) and never read it back from the
+    message.
+
+    Args:
+        response (dict): the parsed output of the chain
+        id (str): id of the message
+
+    Returns:
+        AIMessage: the message
+    """
+    return AIMessage(content=json.dumps(response, ensure_ascii=False),
+                     additional_kwargs={STRUCTURED_OUTPUT_KEY: True}, id=id)
+
+
+def structured_output(message):
+    """
+    The object held by a message of the checkpoints saved before the structured outputs
+    had their state keys, None for any other message (the text is never parsed).
+    """
+    if message is None:
+        return None
+    marker = getattr(message, "additional_kwargs", {}).get(STRUCTURED_OUTPUT_KEY)
+    return marker if isinstance(marker, dict) else None